@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import tempfile
+import statistics
+
+import EaglePub
+
+# Named build configurations, expressed as create_eaglecraft_epub options.
+# "cache-warm" is measured on a second build over a cache primed by a first.
+BUILD_MODES = {
+    "stream": {"input_mode": "stream"},
+    "mmap": {"input_mode": "mmap"},
+    "text": {"input_mode": "text"},
+    "extract-assets": {"extract_assets": True},
+    "split-scripts": {"split_scripts": True},
+    "parallel-deflate": {"deflate_workers": 0},
+    "cache-cold": {"cache": True},
+    "cache-warm": {"cache": True},
+}
+DEFAULT_MODES = ("stream", "mmap", "text")
+
+MARKUP_WORDS = ("block", "grass", "stone", "torch", "chest", "creeper", "world", "render", "chunk", "player")
+
+
+def markup_block(rng, size):
+    lines = []
+    total = 0
+    while total < size:
+        n = rng.randrange(100000)
+        line = (f'<div class="c{n % 97}"><span id="s{n}">{rng.choice(MARKUP_WORDS)} '
+                f'{rng.choice(MARKUP_WORDS)}</span></div>\n')
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode("ascii")
+
+
+def script_block(rng, size):
+    # Minified-looking code: short identifiers, numbers, lots of repetition.
+    lines = []
+    total = 0
+    while total < size:
+        n = rng.randrange(1000000)
+        line = (f"function f{n}(a,b){{var x=a*{n % 251}+b|0;if(x>{n % 4096})return ${n % 53}(x,a);"
+                f"return x^{n % 65521};}}\n")
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode("ascii")
+
+
+def base64_block(rng, size):
+    # A data: URI holding half noise, half repeated runs, roughly like
+    # textures and sound in an EPK bundle.
+    raw_size = size * 3 // 4
+    noise = rng.getrandbits(raw_size // 2 * 8).to_bytes(raw_size // 2, "little")
+    runs = bytes([rng.randrange(256)]) * (raw_size - len(noise))
+    payload = EaglePub.b64encode(noise + runs)
+    return b'var asset="data:application/octet-stream;base64,' + payload + b'";\n'
+
+
+def write_synthetic_html(path, size_mb, base64_fraction=0.3, script_fraction=0.5, seed=0):
+    if base64_fraction + script_fraction > 1:
+        raise ValueError("base64_fraction + script_fraction must not exceed 1")
+
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+    written = 0
+    block_size = 1024 * 1024
+    blob_size = 4 * 1024 * 1024
+    budgets = {
+        "base64": int(target * base64_fraction),
+        "script": int(target * script_fraction),
+    }
+    budgets["markup"] = target - budgets["base64"] - budgets["script"]
+
+    with open(path, "wb") as f:
+        f.write(b'<!DOCTYPE html>\n<html><head><meta charset="utf-8"/><title>synthetic eaglercraft</title></head>\n<body>\n')
+
+        # Interleave the three kinds of content the way a single-file build
+        # mixes them, rather than writing three homogeneous slabs.
+        while any(budgets.values()):
+            for kind in ("markup", "script", "base64"):
+                size = min(budgets[kind], blob_size if kind == "base64" else block_size)
+                if size <= 0:
+                    continue
+                if kind == "markup":
+                    data = markup_block(rng, size)
+                elif kind == "script":
+                    data = b"<script>\n" + script_block(rng, size) + b"</script>\n"
+                else:
+                    data = b"<script>\n" + base64_block(rng, size) + b"</script>\n"
+                f.write(data)
+                written += len(data)
+                budgets[kind] = max(0, budgets[kind] - len(data))
+
+        f.write(b"</body></html>\n")
+
+    return written
+
+
+def run_build(input_path, output_path, options):
+    # One child process per build so ru_maxrss is the peak of that build only.
+    command = [sys.executable, os.path.abspath(__file__), "--run-build", input_path, output_path,
+               json.dumps(options)]
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - started
+
+    return {
+        "ok": status == 0,
+        "wall_s": round(wall, 4),
+        "cpu_s": round(usage.ru_utime + usage.ru_stime, 4),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "output_bytes": os.path.getsize(output_path) if status == 0 else None,
+    }
+
+
+def run_mode(input_path, workdir, mode):
+    options = dict(BUILD_MODES[mode])
+    if options.get("cache"):
+        options["cache_dir"] = os.path.join(workdir, f"cache-{mode}")
+        if mode == "cache-warm":
+            run_build(input_path, os.path.join(workdir, f"{mode}-prime.epub"), options)
+    return run_build(input_path, os.path.join(workdir, f"{mode}.epub"), options)
+
+
+def run_suite(sizes, base64_fractions, script_fraction, modes, repeat):
+    results = []
+    for size_mb in sizes:
+        for base64_fraction in base64_fractions:
+            script_share = min(script_fraction, 1 - base64_fraction)
+            scenario = {"size_mb": size_mb, "base64_fraction": base64_fraction, "script_fraction": script_share}
+
+            with tempfile.TemporaryDirectory() as workdir:
+                input_path = os.path.join(workdir, "eaglecraft.html")
+                input_bytes = write_synthetic_html(input_path, size_mb, base64_fraction, script_share)
+
+                for mode in modes:
+                    runs = [run_mode(input_path, workdir, mode) for _ in range(repeat)]
+                    result = dict(scenario, mode=mode, input_bytes=input_bytes, ok=all(r["ok"] for r in runs))
+                    for metric in ("wall_s", "cpu_s", "peak_rss_mb"):
+                        result[metric] = statistics.median(r[metric] for r in runs)
+                    result["output_bytes"] = runs[-1]["output_bytes"]
+                    results.append(result)
+                    print_result(result, file=sys.stderr)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def result_key(result):
+    return (result["size_mb"], result["base64_fraction"], result["script_fraction"], result["mode"])
+
+
+def compare_runs(baseline, current, tolerance):
+    # A regression is a metric that grew by more than `tolerance` (a
+    # fraction) over the baseline for the same scenario and mode.
+    previous = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+        for metric in ("wall_s", "cpu_s", "peak_rss_mb", "output_bytes"):
+            if before.get(metric) and result.get(metric) and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append({
+                    "scenario": result_key(result),
+                    "metric": metric,
+                    "baseline": before[metric],
+                    "current": result[metric],
+                    "change": round(result[metric] / before[metric] - 1, 3),
+                })
+    return regressions
+
+
+def print_result(result, file=sys.stdout):
+    output_mb = result["output_bytes"] / 1024 / 1024 if result["output_bytes"] else 0
+    print(f"{result['size_mb']:>6} MB  b64 {result['base64_fraction']:<4} {result['mode']:<17} "
+          f"{result['wall_s']:>8.3f} s wall {result['cpu_s']:>8.3f} s cpu {result['peak_rss_mb']:>8.1f} MB peak "
+          f"{output_mb:>8.2f} MB epub{'' if result['ok'] else '  FAILED'}", file=file)
+
+
+def run_build_child(input_path, output_path, options_json):
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        ok = EaglePub.create_eaglecraft_epub(input_path, output_path, **json.loads(options_json))
+    sys.exit(0 if ok else 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark EaglePub build modes on synthetic game HTML.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 10],
+                        help="synthetic input sizes in MB, 1 to 200 (default: %(default)s)")
+    parser.add_argument("--base64", type=float, nargs="+", default=[0.0, 0.5], dest="base64_fractions",
+                        help="fractions of each input made of base64 data: URIs (default: %(default)s)")
+    parser.add_argument("--script", type=float, default=0.4, dest="script_fraction",
+                        help="fraction made of script; the rest is markup (default: %(default)s)")
+    parser.add_argument("--modes", nargs="+", choices=sorted(BUILD_MODES), default=list(DEFAULT_MODES))
+    parser.add_argument("--repeat", type=int, default=1, help="runs per mode; medians are reported")
+    parser.add_argument("--json", metavar="PATH", help="write machine-readable results to PATH ('-' for stdout)")
+    parser.add_argument("--compare", metavar="BASELINE.json",
+                        help="exit non-zero if any metric regressed against a previous --json run")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed growth before --compare flags a regression (default: %(default)s)")
+    parser.add_argument("--generate", metavar="PATH", help="only write one synthetic input of --sizes[0] MB")
+    parser.add_argument("--run-build", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_build:
+        run_build_child(*args.run_build)
+
+    if args.generate:
+        write_synthetic_html(args.generate, args.sizes[0], args.base64_fractions[0], args.script_fraction)
+        return
+
+    if not all(1 <= size <= 200 for size in args.sizes):
+        parser.error("--sizes must be between 1 and 200 MB")
+
+    report = run_suite(args.sizes, args.base64_fractions, args.script_fraction, args.modes, args.repeat)
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare_runs(json.load(f), report, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression['scenario']} {regression['metric']}: "
+                  f"{regression['baseline']} -> {regression['current']} (+{regression['change']:.1%})",
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+import os
+import io
+import sys
+import json
+import time
+import struct
+import hashlib
+import argparse
+import zipfile
+import zlib
+
+import EaglePub
+
+DELTA_FORMAT = "eaglepub-delta"
+DELTA_VERSION = 1
+MANIFEST_NAME = "delta.json"
+
+# Matching: runs are compared a block at a time, a probe of PROBE_SIZE bytes
+# is searched for to find where the old member continues after a change, and
+# the search skips ahead by a doubling step while nothing matches so that
+# wholly new content costs a handful of searches, not one per byte. Beyond
+# SEARCH_WINDOW, one PROBE_SIZE block every INDEX_STRIDE bytes of the old
+# member is indexed, so far moves are found without rescanning the member.
+COMPARE_BLOCK = 64 * 1024
+PROBE_SIZE = 64
+MIN_PROBE_STEP = 1024
+MAX_PROBE_STEP = 64 * 1024
+SEARCH_WINDOW = 4 * 1024 * 1024
+INDEX_STRIDE = 1024
+
+COPY_OP = b"C"
+LITERAL_OP = b"L"
+
+
+def common_prefix(a, a_start, b, b_start, limit):
+    # Length of the common run of a[a_start:] and b[b_start:], compared a
+    # block at a time and narrowed down by halving once a block differs.
+    limit = min(limit, len(a) - a_start, len(b) - b_start)
+    length = 0
+    step = COMPARE_BLOCK
+    while length < limit:
+        size = min(step, limit - length)
+        if a[a_start + length:a_start + length + size] == b[b_start + length:b_start + length + size]:
+            length += size
+        elif size == 1:
+            break
+        else:
+            step = size // 2
+    return length
+
+
+def common_suffix(a, a_end, b, b_end, limit):
+    limit = min(limit, a_end, b_end)
+    length = 0
+    step = COMPARE_BLOCK
+    while length < limit:
+        size = min(step, limit - length)
+        if a[a_end - length - size:a_end - length] == b[b_end - length - size:b_end - length]:
+            length += size
+        elif size == 1:
+            break
+        else:
+            step = size // 2
+    return length
+
+
+def index_blocks(old):
+    # First offset of each indexed block, keyed by its content.
+    index = {}
+    for offset in range(0, len(old) - PROBE_SIZE + 1, INDEX_STRIDE):
+        index.setdefault(old[offset:offset + PROBE_SIZE], offset)
+    return index
+
+
+def find_indexed(index, new, pos):
+    # A run of at least INDEX_STRIDE + PROBE_SIZE common bytes holds an
+    # indexed block starting within INDEX_STRIDE bytes of where it starts.
+    for shift in range(min(INDEX_STRIDE, len(new) - pos - PROBE_SIZE + 1)):
+        found = index.get(new[pos + shift:pos + shift + PROBE_SIZE])
+        if found is not None:
+            return pos + shift, found
+    return pos, -1
+
+
+def diff_bytes(old, new):
+    # Greedy copy/literal delta of `new` against `old`: follow the old data
+    # while it matches, and after a change search for where it resumes.
+    delta = io.BytesIO()
+    literal = 0
+    pos = 0
+    cursor = 0
+    step = MIN_PROBE_STEP
+    index = None
+
+    def flush_literal(end):
+        if end > literal:
+            delta.write(LITERAL_OP + struct.pack("<Q", end - literal))
+            delta.write(new[literal:end])
+
+    while pos < len(new):
+        length = common_prefix(old, cursor, new, pos, len(new))
+        if length < PROBE_SIZE:
+            probe = new[pos:pos + PROBE_SIZE]
+            found = -1
+            if len(probe) == PROBE_SIZE:
+                # Near the last match first: edits rarely move content far.
+                found = old.find(probe, max(0, cursor - SEARCH_WINDOW), cursor + SEARCH_WINDOW)
+                if found < 0:
+                    if index is None:
+                        index = index_blocks(old)
+                    pos, found = find_indexed(index, new, pos)
+            if found < 0:
+                pos += step
+                step = min(step * 2, MAX_PROBE_STEP)
+                continue
+            # The skip may have overshot the start of the match.
+            back = common_suffix(old, found, new, pos, pos - literal)
+            cursor = found - back
+            pos -= back
+            length = common_prefix(old, cursor, new, pos, len(new))
+
+        flush_literal(pos)
+        delta.write(COPY_OP + struct.pack("<QQ", cursor, length))
+        pos += length
+        cursor += length
+        literal = pos
+        step = MIN_PROBE_STEP
+
+    flush_literal(len(new))
+    return delta.getvalue()
+
+
+def apply_delta(old, delta):
+    out = bytearray()
+    pos = 0
+    while pos < len(delta):
+        op = delta[pos:pos + 1]
+        if op == COPY_OP:
+            offset, length = struct.unpack_from("<QQ", delta, pos + 1)
+            if offset + length > len(old):
+                raise ValueError("delta copies past the end of its source")
+            out += old[offset:offset + length]
+            pos += 17
+        elif op == LITERAL_OP:
+            (length,) = struct.unpack_from("<Q", delta, pos + 1)
+            out += delta[pos + 9:pos + 9 + length]
+            pos += 9 + length
+        else:
+            raise ValueError(f"bad delta op {op!r} at {pos}")
+    return bytes(out)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in EaglePub.iter_file_chunks(f):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_payload(archive_file, zinfo):
+    # The compressed bytes as stored. The local header's extra field may
+    # differ from the central directory's, so its lengths are read here.
+    archive_file.seek(zinfo.header_offset)
+    header = archive_file.read(30)
+    if header[:4] != b"PK\x03\x04":
+        raise ValueError(f"{zinfo.filename}: bad local header")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    archive_file.seek(zinfo.header_offset + 30 + name_length + extra_length)
+    return archive_file.read(zinfo.compress_size)
+
+
+def compress_content(content, deflate, totals):
+    chunks = EaglePub.iter_file_chunks(io.BytesIO(content))
+    if deflate is None:
+        return EaglePub.stored_chunks(chunks, totals)
+    if deflate["block_bytes"]:
+        return EaglePub.parallel_deflate_chunks(chunks, deflate["level"], totals, os.cpu_count() or 1,
+                                                deflate["block_bytes"])
+    return EaglePub.deflate_chunks(chunks, deflate["level"], totals)
+
+
+def reproduces(content, payload, deflate):
+    # Compares as it compresses, so a wrong guess usually fails within the
+    # first few kilobytes.
+    pieces = compress_content(content, deflate, {})
+    offset = 0
+    try:
+        for piece in pieces:
+            if payload[offset:offset + len(piece)] != piece:
+                return False
+            offset += len(piece)
+    finally:
+        pieces.close()
+    return offset == len(payload)
+
+
+def deflate_candidates(name, size):
+    # The settings the default EaglePub policy picks for this member first,
+    # serial and in parallel blocks, then every other level.
+    rules = [EaglePub.parse_compression_rule(rule) for rule in EaglePub.DEFAULT_COMPRESSION_POLICY]
+    _, level = EaglePub.choose_compression(rules, name, size)
+    block_bytes = EaglePub.DEFAULT_BUILD_OPTIONS["deflate_block_bytes"]
+    levels = [level or EaglePub.DEFAULT_COMPRESS_LEVEL]
+    levels += [other for other in range(9, 0, -1) if other not in levels]
+    for level in levels:
+        yield {"level": level, "block_bytes": None}
+        yield {"level": level, "block_bytes": block_bytes}
+
+
+def find_deflate(zinfo, content, payload):
+    if zinfo.compress_type == zipfile.ZIP_STORED:
+        return None, True
+    for deflate in deflate_candidates(zinfo.filename, zinfo.file_size):
+        if reproduces(content, payload, deflate):
+            return deflate, True
+    return None, False
+
+
+def member_entry(zinfo):
+    return {
+        "name": zinfo.filename,
+        "compress_type": zinfo.compress_type,
+        "date_time": list(zinfo.date_time),
+        "create_system": zinfo.create_system,
+        "external_attr": zinfo.external_attr,
+        "crc": zinfo.CRC,
+        "file_size": zinfo.file_size,
+        "compress_size": zinfo.compress_size,
+    }
+
+
+def make_patch(old_path, new_path, patch_path):
+    started = time.perf_counter()
+    counts = {"copy": 0, "delta": 0, "raw": 0, "add": 0}
+    manifest = {
+        "format": DELTA_FORMAT,
+        "version": DELTA_VERSION,
+        "old": {"sha256": file_sha256(old_path), "size": os.path.getsize(old_path)},
+        "new": {"sha256": file_sha256(new_path), "size": os.path.getsize(new_path)},
+        "members": [],
+    }
+
+    with zipfile.ZipFile(old_path) as old_zip, open(old_path, "rb") as old_file, \
+            zipfile.ZipFile(new_path) as new_zip, open(new_path, "rb") as new_file, \
+            zipfile.ZipFile(patch_path, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as patch:
+        old_members = {zinfo.filename: zinfo for zinfo in old_zip.infolist()}
+        by_content = {}
+        for zinfo in old_zip.infolist():
+            by_content.setdefault((zinfo.CRC, zinfo.file_size), zinfo)
+
+        for index, zinfo in enumerate(new_zip.infolist()):
+            entry = member_entry(zinfo)
+            payload = read_payload(new_file, zinfo)
+            # Same content under another name (a moved asset) beats the
+            # previous version of the same name.
+            source = by_content.get((zinfo.CRC, zinfo.file_size)) or old_members.get(zinfo.filename)
+            entry["source"] = source.filename if source is not None else None
+
+            if source is not None and source.compress_type == zinfo.compress_type \
+                    and source.CRC == zinfo.CRC and read_payload(old_file, source) == payload:
+                entry["op"] = "copy"
+            else:
+                content = new_zip.read(zinfo)
+                deflate, found = find_deflate(zinfo, content, payload)
+                if found:
+                    # Deltas between contents, recompressed on apply.
+                    old_content = old_zip.read(source) if source is not None else b""
+                    entry["op"] = "delta" if source is not None else "add"
+                    entry["deflate"] = deflate
+                    data = diff_bytes(old_content, content)
+                else:
+                    # Compressed in a way this tool cannot redo (custom block
+                    # size, another zip tool): delta the compressed bytes.
+                    old_payload = read_payload(old_file, source) if source is not None else b""
+                    entry["op"] = "raw"
+                    data = diff_bytes(old_payload, payload)
+                entry["data"] = f"members/{index}.delta"
+                patch.writestr(entry["data"], data)
+            counts[entry["op"]] += 1
+            manifest["members"].append(entry)
+
+        counts["removed"] = len(set(old_members) - {entry["name"] for entry in manifest["members"]})
+        patch.writestr(MANIFEST_NAME, json.dumps(manifest, indent=1))
+
+    return {
+        "seconds": time.perf_counter() - started,
+        "counts": counts,
+        "patch_bytes": os.path.getsize(patch_path),
+        "new_bytes": manifest["new"]["size"],
+    }
+
+
+def apply_patch(old_path, patch_path, output):
+    started = time.perf_counter()
+    temp_path = f"{output}.tmp"
+
+    with zipfile.ZipFile(patch_path) as patch:
+        manifest = json.loads(patch.read(MANIFEST_NAME))
+        if manifest.get("format") != DELTA_FORMAT or manifest.get("version") != DELTA_VERSION:
+            raise ValueError(f"{patch_path} is not an EagleDelta patch this version can apply")
+        if file_sha256(old_path) != manifest["old"]["sha256"]:
+            raise ValueError(f"{old_path} is not the book this patch was made against")
+
+        try:
+            with zipfile.ZipFile(old_path) as old_zip, open(old_path, "rb") as old_file, \
+                    zipfile.ZipFile(temp_path, "w") as epub:
+                for entry in manifest["members"]:
+                    write_patched_member(epub, entry, old_zip, old_file, patch)
+            if file_sha256(temp_path) != manifest["new"]["sha256"]:
+                raise ValueError("patched book does not match the one the patch was made for")
+            os.replace(temp_path, output)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    return {"seconds": time.perf_counter() - started, "members": len(manifest["members"])}
+
+
+def write_patched_member(epub, entry, old_zip, old_file, patch):
+    zinfo = EaglePub.new_zipinfo(entry["name"], entry["compress_type"], tuple(entry["date_time"]))
+    zinfo.create_system = entry["create_system"]
+    zinfo.external_attr = entry["external_attr"]
+    source = old_zip.getinfo(entry["source"]) if entry["source"] is not None else None
+
+    if entry["op"] == "copy":
+        payload = read_payload(old_file, source)
+    elif entry["op"] == "raw":
+        payload = apply_delta(read_payload(old_file, source) if source is not None else b"",
+                          patch.read(entry["data"]))
+    else:
+        content = apply_delta(old_zip.read(source) if source is not None else b"", patch.read(entry["data"]))
+        if zlib.crc32(content) != entry["crc"]:
+            raise ValueError(f"{entry['name']}: CRC mismatch after patching")
+        payload = b"".join(compress_content(content, entry["deflate"], {}))
+
+    with EaglePub.RawMemberWriter(epub, zinfo, entry["crc"], entry["file_size"], len(payload)) as member:
+        member.write(payload)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Make and apply per-member binary patches between EPUB releases.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    make = commands.add_parser("make", help="write a patch that turns OLD into NEW")
+    make.add_argument("old", help="the EPUB devices already have")
+    make.add_argument("new", help="the new release")
+    make.add_argument("-o", "--output", required=True, help="patch file to write")
+    apply = commands.add_parser("apply", help="rebuild NEW from OLD and a patch")
+    apply.add_argument("old", help="the EPUB the patch was made against")
+    apply.add_argument("patch", help="patch file from 'make'")
+    apply.add_argument("-o", "--output", required=True, help="EPUB to write")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "make":
+            report = make_patch(args.old, args.new, args.output)
+            # A patch is only worth shipping if it rebuilds the release
+            # byte for byte.
+            check_path = f"{args.output}.check.epub"
+            try:
+                apply_patch(args.old, args.output, check_path)
+            finally:
+                if os.path.exists(check_path):
+                    os.remove(check_path)
+            counts = report["counts"]
+            print(f"Patch {args.output}: {counts['copy']} copied, {counts['delta']} delta, {counts['raw']} raw, "
+                  f"{counts['add']} added, {counts['removed']} removed member(s)")
+            print(f"{report['patch_bytes'] / 1024:.1f} KB for a {report['new_bytes'] / 1024 / 1024:.2f} MB book "
+                  f"({report['patch_bytes'] / report['new_bytes']:.2%}), made in {report['seconds']:.2f} s")
+        else:
+            report = apply_patch(args.old, args.patch, args.output)
+            print(f"Wrote {args.output} ({report['members']} members) in {report['seconds']:.2f} s")
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,224 @@
 import os
+import io
 import zipfile
+import zlib
+import struct
+import time
+import binascii
+import hashlib
+import itertools
+import functools
+import collections
+import concurrent.futures
+import mimetypes
+import fnmatch
+import tempfile
 from base64 import b64encode
 import datetime
 import uuid
 import html
-import shutil
+import posixpath
+import urllib.parse
+import xml.parsers.expat
+import xml.etree.ElementTree as ElementTree
+import json
+import mmap
+import re
+import argparse
+import contextlib
+import importlib.util
+import cProfile
+import tracemalloc
+import sys
 
-def create_eaglecraft_epub():
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
-    output_dir = os.path.expanduser("~/Documents/eaglepub")
-    os.makedirs(output_dir, exist_ok=True)
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-    mimetype_path = os.path.join(output_dir, "mimetype")
-    meta_inf_path = os.path.join(output_dir, "META-INF")
-    oebps_path = os.path.join(output_dir, "OEBPS")
+DEFAULT_INPUT_PATH = "eaglecraft.html"
+DEFAULT_EPUB_PATH = "~/Documents/eaglecraft_book.epub"
+GAME_HTML_FILENAME = "eaglecraft_fixed.html"
+DEFAULT_TITLE = "Eaglecraft - Apple Books"
+DEFAULT_CREATOR = "WereWolf"
 
-    os.makedirs(meta_inf_path, exist_ok=True)
-    os.makedirs(oebps_path, exist_ok=True)
+DEFAULT_COMPRESS_LEVEL = 6
+DEFLATE_WINDOW_SIZE = 32 * 1024
+INJECT_CHUNK_SIZE = 1024 * 1024
+MAX_HEAD_TAG_LENGTH = 4096
+MAX_HEAD_SNIFF_BYTES = 4 * INJECT_CHUNK_SIZE
+HEAD_TAG_RE = re.compile(rb"<head(?:\s[^<>]*)?>", re.IGNORECASE)
+TEXT_HEAD_TAG_RE = re.compile(r"<head(?:\s[^<>]*)?>", re.IGNORECASE)
 
-    with open(mimetype_path, "w", encoding="utf-8") as f:
-        f.write("application/epub+zip")
+DATA_URI_RE = re.compile(rb"data:([\w.+-]+/[\w.+-]+)?((?:;[\w.+-]+=[\w.+-]+)*);base64,", re.IGNORECASE)
+# Line-wrapped data URIs are common; browsers drop ASCII whitespace before
+# decoding, so a run may contain it.
+BASE64_WHITESPACE = b" \t\n\f\r"
+BASE64_RUN_RE = re.compile(rb"[A-Za-z0-9+/ \t\n\f\r]*((?:=[ \t\n\f\r]*){0,2})")
+MAX_DATA_URI_PREFIX = 256
+ASSET_SPOOL_SIZE = 8 * 1024 * 1024
+ASSET_DIR = "assets"
+BUNDLE_DIR = "bundles"
+SCRIPT_DIR = "scripts"
+SCRIPT_SCAN_RE = re.compile(rb"<!--|<script\b([^<>]*)>", re.IGNORECASE)
+SCRIPT_END_RE = re.compile(rb"</script[\s/>]", re.IGNORECASE)
+SCRIPT_ATTR_RE = re.compile(rb"""([^\s=/>]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>]+))?""")
+DOCUMENT_WRITE_RE = re.compile(rb"document\.write")
+CLASSIC_SCRIPT_TYPES = (b"", b"text/javascript", b"application/javascript", b"text/ecmascript",
+                        b"application/ecmascript", b"application/x-javascript")
+LAZY_SCRIPT_TYPE = b"text/eaglepub-lazy"
+ASSET_EXTENSIONS = {
+    "application/octet-stream": ".bin",
+    "audio/ogg": ".ogg",
+    "text/javascript": ".js",
+}
 
-    container_xml = """<?xml version="1.0" encoding="UTF-8"?>
+MEMBER_MEDIA_TYPES = {
+    ".xhtml": "application/xhtml+xml",
+    ".opf": "application/oebps-package+xml",
+    ".ncx": "application/x-dtbncx+xml",
+    ".xml": "application/xml",
+    ".html": "text/html",
+}
+
+# Tried in order after any --route rules; packaged bundles always win.
+DEFAULT_ROUTES = (
+    "ws://*=websocket",
+    "wss://*=websocket",
+    "http://*=remote",
+    "https://*=remote",
+    "//*=remote",
+    "*=local",
+)
+ROUTE_ACTIONS = ("local", "remote", "websocket", "stub")
+
+# WebGL context attributes and backbuffer scale per device class. "auto"
+# picks one from the user agent; "compatible" is the original fixed setup.
+GRAPHICS_PROFILES = {
+    "iphone-low-power": {
+        "label": "iPhone (low power)",
+        "render_scale": 0.5,
+        "context": {"antialias": False, "preserveDrawingBuffer": False, "powerPreference": "low-power"},
+    },
+    "ipad": {
+        "label": "iPad",
+        "render_scale": 0.75,
+        "context": {"antialias": False, "preserveDrawingBuffer": False, "powerPreference": "default"},
+    },
+    "mac": {
+        "label": "Mac",
+        "render_scale": 1.0,
+        "context": {"antialias": True, "preserveDrawingBuffer": False, "powerPreference": "high-performance"},
+    },
+    "compatible": {
+        "label": "Compatible",
+        "render_scale": 1.0,
+        "context": {"antialias": False, "preserveDrawingBuffer": True, "powerPreference": "default"},
+    },
+}
+
+# First matching rule wins. Conditions: a glob on the member name, type:GLOB
+# on its media type, size<N / size>=N (K/M suffixes allowed), joined by "&".
+# Actions: stored, deflate, deflate:LEVEL.
+DEFAULT_COMPRESSION_POLICY = (
+    "*.png=stored",
+    "*.jpg=stored",
+    "*.jpeg=stored",
+    "*.gif=stored",
+    "*.webp=stored",
+    "*.ogg=stored",
+    "*.oga=stored",
+    "*.mp3=stored",
+    "*.m4a=stored",
+    "*.woff=stored",
+    "*.woff2=stored",
+    "*.epk=stored",
+    "*.epk.*=stored",
+    "size<256=stored",
+    "type:application/*xml&size<1M=deflate:9",
+    "type:text/*&size<1M=deflate:9",
+    "*=deflate:6",
+)
+COMPRESSION_SIZE_RE = re.compile(r"size(<|>=)(\d+)([KM]?)$", re.IGNORECASE)
+
+CONTAINER_PATH = "META-INF/container.xml"
+OPF_PATH = "OEBPS/content.opf"
+NCX_PATH = "OEBPS/toc.ncx"
+CONTAINER_NS = "urn:oasis:names:tc:opendocument:xmlns:container"
+OPF_NS = "http://www.idpf.org/2007/opf"
+DC_NS = "http://purl.org/dc/elements/1.1/"
+NCX_NS = "http://www.daisy.org/z3986/2005/ncx/"
+XML_MEMBER_SUFFIXES = (".xhtml", ".xml", ".opf", ".ncx")
+# Manifest items every book has: id -> (href, media type, required property).
+REQUIRED_MANIFEST_ITEMS = {
+    "nav": ("nav.xhtml", "application/xhtml+xml", "nav"),
+    "index": ("index.xhtml", "application/xhtml+xml", None),
+    "game": (GAME_HTML_FILENAME, "text/html", None),
+    "ncx": ("toc.ncx", "application/x-dtbncx+xml", None),
+}
+REPRODUCIBLE_EPOCH = 315532800  # 1980-01-01T00:00:00Z, the earliest time a zip entry can hold
+CACHE_FORMAT_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or "~/.cache", "eaglepub")
+CACHE_SETTLE_SECONDS = 2
+CACHE_STALE_LOCK_SECONDS = 30
+
+PROFILE_STAGES = ("read", "inject", "extract assets", "split scripts", "render templates", "compress", "write",
+                  "cache")
+DEBUG_REGION_RE = re.compile(r"^[ \t]*(?://|<!--) @debug-start.*?@debug-end.*?$\n?", re.DOTALL | re.MULTILINE)
+JS_WORD_RE = re.compile(r"[\w$]+")
+JS_REGEX_AFTER = {"return", "typeof", "case", "do", "else", "in", "of", "new", "delete", "void", "throw",
+                  "instanceof", "yield", "await"}
+CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
+EMBEDDED_CODE_RE = re.compile(r"(<(script|style)\b[^>]*>)(.*?)(</\2>)", re.DOTALL | re.IGNORECASE)
+CDATA_RE = re.compile(r"<!\[CDATA\[(.*)\]\]>", re.DOTALL)
+INPUT_MODES = ("stream", "mmap", "text")
+LOG_LEVELS = ("debug", "info", "warn", "error")
+
+DEFAULT_BUILD_OPTIONS = {
+    "title": DEFAULT_TITLE,
+    "creator": DEFAULT_CREATOR,
+    "identifier": None,
+    "input_mode": "stream",
+    "extract_assets": False,
+    "extract_assets_min_bytes": 64 * 1024,
+    "split_scripts": False,
+    "split_scripts_min_bytes": 256 * 1024,
+    "lazy_scripts": (),
+    "bundles": (),
+    "bundle_part_bytes": 16 * 1024 * 1024,
+    "compression_policy": DEFAULT_COMPRESSION_POLICY,
+    "compression_report": False,
+    "deflate_workers": 1,
+    "deflate_block_bytes": 1024 * 1024,
+    "cache": False,
+    "cache_dir": DEFAULT_CACHE_DIR,
+    "cache_max_bytes": 1024 * 1024 * 1024,
+    "profile": None,
+    "release": False,
+    "log_buffer_size": 500,
+    "log_level": "debug",
+    "storage_prefix": "eaglepub:",
+    "storage_flush_ms": 250,
+    "response_cache_bytes": 32 * 1024 * 1024,
+    "routes": DEFAULT_ROUTES,
+    "request_timeout_ms": 15000,
+    "graphics_profile": "auto",
+    "graphics_profiles": GRAPHICS_PROFILES,
+    "perf_hud": False,
+    "perf_hud_frames": 600,
+    "preload_game": True,
+    "launch_timeout_ms": 30000,
+    "reproducible": False,
+    "validate": False,
+}
+
+
+CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
 <container version="1.0"
     xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
   <rootfiles>
@@ -30,243 +227,1044 @@ def create_eaglecraft_epub():
   </rootfiles>
 </container>"""
 
-    with open(os.path.join(meta_inf_path, "container.xml"), "w", encoding="utf-8") as f:
-        f.write(container_xml)
+APPLE_LOG_JS = """
+    // Bounded ring buffer: logging is O(1) and overwrites the oldest entry
+    // once full. The panel is redrawn at most once per animation frame, and
+    // only while it is shown, by appending the new lines and trimming old ones.
+    function createAppleLog(config, panelId, contentId) {
+        const levels = { debug: 0, info: 1, warn: 2, error: 3 };
+        const colors = { debug: '#888', info: '#0f0', warn: '#fa0', error: '#f44' };
+        const size = Math.max(1, config.size | 0);
+        const minLevel = levels[config.level] !== undefined ? levels[config.level] : levels.debug;
+        const entries = new Array(size);
+        let written = 0;
+        let rendered = 0;
+        let scheduled = false;
+
+        function panelVisible() {
+            const panel = panelId && document.getElementById(panelId);
+            return !!panel && panel.style.display === 'block';
+        }
+
+        function flush() {
+            scheduled = false;
+            const content = contentId && document.getElementById(contentId);
+            if (!content || !panelVisible()) {
+                return;
+            }
+
+            const fragment = document.createDocumentFragment();
+            for (let i = Math.max(rendered, written - size); i < written; i++) {
+                const entry = entries[i % size];
+                const line = document.createElement('div');
+                line.style.color = colors[entry.type];
+                line.style.marginBottom = '2px';
+                line.textContent = `[${new Date(entry.time).toLocaleTimeString()}] ${entry.message}`;
+                fragment.appendChild(line);
+            }
+            content.appendChild(fragment);
+            while (content.childNodes.length > size) {
+                content.removeChild(content.firstChild);
+            }
+            content.scrollTop = content.scrollHeight;
+            rendered = written;
+        }
+
+        function scheduleFlush() {
+            if (scheduled || written === rendered || !panelVisible()) {
+                return;
+            }
+            scheduled = true;
+            if (window.requestAnimationFrame) {
+                window.requestAnimationFrame(flush);
+            } else {
+                setTimeout(flush, 16);
+            }
+        }
+
+        function appleLog(message, type = 'info') {
+            if (levels[type] === undefined) {
+                type = 'info';
+            }
+            if (levels[type] < minLevel) {
+                return;
+            }
+            entries[written % size] = { time: Date.now(), type: type, message: String(message) };
+            written++;
+            scheduleFlush();
+        }
+
+        appleLog.flush = scheduleFlush;
+        appleLog.entries = function() {
+            const first = Math.max(0, written - size);
+            const result = [];
+            for (let i = first; i < written; i++) {
+                result.push(entries[i % size]);
+            }
+            return result;
+        };
+        return appleLog;
+    }
+"""
+
+
+PERF_HUD_JS = """
+    // Frame-time HUD, only injected into --perf-hud builds. Every
+    // requestAnimationFrame callback is wrapped, but recording a frame is a
+    // subtraction and a few typed-array writes; the overlay text is redrawn
+    // twice a second. Tap the overlay to dump the histogram to the debug log.
+    (function() {
+        const nativeRAF = window.requestAnimationFrame && window.requestAnimationFrame.bind(window);
+        if (!nativeRAF) {
+            return;
+        }
+
+        // 0.5 ms buckets up to 100 ms; slower frames share the last one. The
+        // histogram always describes the last `frames` frames: each new frame
+        // evicts the oldest from the ring and from its bucket.
+        const bucketMs = 0.5;
+        const buckets = new Uint32Array(201);
+        const recent = new Float32Array(Math.max(1, EAGLEPUB_CONFIG.perf_hud.frames | 0));
+        let count = 0;
+        let total = 0;
+        let lastFrame = 0;
+        let longTasks = 0;
+        let longTaskMs = 0;
+        let longTaskSource = 'frames over 50 ms';
+        let overlay = null;
+
+        function bucketOf(ms) {
+            return Math.min(buckets.length - 1, Math.floor(ms / bucketMs));
+        }
+
+        function record(ms) {
+            const slot = count % recent.length;
+            if (count >= recent.length) {
+                buckets[bucketOf(recent[slot])]--;
+                total -= recent[slot];
+            }
+            recent[slot] = ms;
+            buckets[bucketOf(ms)]++;
+            total += ms;
+            count++;
+            if (longTaskSource !== 'longtask' && ms > 50) {
+                longTasks++;
+                longTaskMs += ms;
+            }
+        }
+
+        window.requestAnimationFrame = function(callback) {
+            return nativeRAF(function(time) {
+                // Games often queue several callbacks per frame; they all see
+                // the same timestamp, and only the first is counted.
+                if (time !== lastFrame) {
+                    if (lastFrame) {
+                        record(time - lastFrame);
+                    }
+                    lastFrame = time;
+                }
+                callback(time);
+            });
+        };
+
+        // A hidden page stops animation frames; don't count the gap.
+        document.addEventListener('visibilitychange', function() {
+            lastFrame = 0;
+        });
+
+        try {
+            if (window.PerformanceObserver && (PerformanceObserver.supportedEntryTypes || []).indexOf('longtask') !== -1) {
+                new PerformanceObserver(function(list) {
+                    list.getEntries().forEach(function(entry) {
+                        longTasks++;
+                        longTaskMs += entry.duration;
+                    });
+                }).observe({ entryTypes: ['longtask'] });
+                longTaskSource = 'longtask';
+            }
+        } catch (e) {
+            // Keep counting long frames instead.
+        }
+
+        function percentile(p) {
+            const samples = Math.min(count, recent.length);
+            const rank = Math.max(1, Math.ceil(samples * p));
+            let seen = 0;
+            for (let i = 0; i < buckets.length; i++) {
+                seen += buckets[i];
+                if (seen >= rank) {
+                    return (i + 1) * bucketMs;
+                }
+            }
+            return 0;
+        }
+
+        function snapshot() {
+            const samples = Math.min(count, recent.length);
+            const memory = window.performance && window.performance.memory;
+            return {
+                frames: samples,
+                fps: total > 0 ? samples * 1000 / total : 0,
+                p50: percentile(0.5),
+                p95: percentile(0.95),
+                p99: percentile(0.99),
+                long_tasks: longTasks,
+                long_task_ms: Math.round(longTaskMs),
+                long_task_source: longTaskSource,
+                heap_mb: memory ? memory.usedJSHeapSize / 1048576 : null
+            };
+        }
+
+        function summary(stats) {
+            let text = `${stats.fps.toFixed(1)} fps  p50 ${stats.p50.toFixed(1)}  p95 ${stats.p95.toFixed(1)}  ` +
+                `p99 ${stats.p99.toFixed(1)} ms  long ${stats.long_tasks}`;
+            if (stats.heap_mb !== null) {
+                text += `  heap ${stats.heap_mb.toFixed(0)} MB`;
+            }
+            return text;
+        }
+
+        function dump() {
+            const stats = snapshot();
+            const peak = Math.max.apply(null, buckets) || 1;
+            appleLog(`Perf over ${stats.frames} frames: ${summary(stats)} (${stats.long_task_source})`);
+            for (let i = 0; i < buckets.length; i++) {
+                if (buckets[i]) {
+                    const range = i === buckets.length - 1 ? `>= ${i * bucketMs} ms` : `${i * bucketMs}-${(i + 1) * bucketMs} ms`;
+                    appleLog(`  ${range}: ${buckets[i]} ${'#'.repeat(Math.ceil(buckets[i] * 30 / peak))}`);
+                }
+            }
+            return stats;
+        }
+
+        function draw() {
+            if (!overlay) {
+                if (!document.body) {
+                    return;
+                }
+                overlay = document.createElement('div');
+                overlay.style.cssText = 'position:fixed;left:4px;top:4px;z-index:2147483647;padding:2px 5px;' +
+                    'background:rgba(0,0,0,0.6);color:#0f0;font:10px monospace;white-space:pre;cursor:pointer';
+                overlay.title = 'Tap to dump the frame-time histogram to the debug log';
+                overlay.addEventListener('click', dump);
+                document.body.appendChild(overlay);
+            }
+            if (!document.hidden) {
+                overlay.textContent = summary(snapshot());
+            }
+        }
+
+        setInterval(draw, 500);
+
+        window.eaglepubPerf = {
+            snapshot: snapshot,
+            dump: dump,
+            reset: function() {
+                buckets.fill(0);
+                count = 0;
+                total = 0;
+                lastFrame = 0;
+                longTasks = 0;
+                longTaskMs = 0;
+            }
+        };
+    })();
+"""
 
-    try:
-        with open("eaglecraft.html", "r", encoding="utf-8") as html_file:
-            raw_html = html_file.read()
-    except FileNotFoundError:
-        print("Error: eaglecraft.html file not found!")
-        print("Please ensure eaglecraft.html exists in the current directory.")
-        return False
-    except Exception as e:
-        print(f"Error reading eaglecraft.html: {e}")
-        return False
 
-    browser_api_fixes = """
+BROWSER_API_FIXES = """
 <script type="text/javascript">
 
 (function() {
     'use strict';
-    
-    function flushPendingLogs() {
-        const logContent = document.getElementById('log-content');
-        if (window.pendingLogs && window.pendingLogs.length > 0 && logContent) {
-            window.pendingLogs.forEach(log => {
-                const color = log.type === 'error' ? '#f44' : log.type === 'warn' ? '#fa0' : '#0f0';
-                logContent.innerHTML += `<div style="color: ${color}; margin-bottom: 2px;">[${log.timestamp}] ${log.message}</div>`;
-            });
-            logContent.scrollTop = logContent.scrollHeight;
-            window.pendingLogs = [];
+
+    const EAGLEPUB_CONFIG = __EAGLEPUB_CONFIG__;
+
+    // @debug-start
+__APPLE_LOG_JS__
+    // In the game iframe, log into the launcher's buffer so messages reach
+    // its panel. Loaded on its own, keep a local buffer instead.
+    const appleLog = (function() {
+        try {
+            if (window.parent !== window && typeof window.parent.appleLog === 'function') {
+                return window.parent.appleLog;
+            }
+        } catch (e) {
+            // Cross-origin parent; fall through.
+        }
+        return createAppleLog(EAGLEPUB_CONFIG.log || {});
+    })();
+    // @debug-end
+
+    // Boot milestones for the launcher, which shows the game on its first
+    // frame and keeps them for the startup trace. Times are wall-clock so the
+    // launcher can map them onto its own clock; each milestone is posted
+    // once per page load, and is also a performance.mark for Web Inspector.
+    const milestones = {};
+
+    function postMilestone(name) {
+        if (milestones[name] !== undefined) {
+            return;
+        }
+        const clock = window.performance;
+        milestones[name] = clock && clock.timeOrigin ? clock.timeOrigin + clock.now() : Date.now();
+        try {
+            if (clock && clock.mark) {
+                clock.mark(`eaglepub:${name}`);
+            }
+        } catch (e) {
+            // Marks are only a convenience.
+        }
+        try {
+            if (window.parent !== window) {
+                window.parent.postMessage({ eaglepub: 'milestone', name: name, time: milestones[name] }, '*');
+            }
+        } catch (e) {
+            // No launcher to tell.
+        }
+    }
+
+    const OriginalXHR = window.XMLHttpRequest;
+    const packagedResources = EAGLEPUB_CONFIG.resources || {};
+
+    function requestUrl(request) {
+        return typeof request === 'string' ? request : (request && request.url) || String(request);
+    }
+
+    function resolvePackaged(request) {
+        const url = requestUrl(request);
+        const path = url.split(/[?#]/)[0];
+        const name = path.substring(path.lastIndexOf('/') + 1);
+        return packagedResources[url] || packagedResources[path] || packagedResources[name] || null;
+    }
+
+    function readPackagedPart(href) {
+        return new Promise((resolve, reject) => {
+            const xhr = new OriginalXHR();
+            xhr.open('GET', href, true);
+            xhr.responseType = 'arraybuffer';
+            xhr.onload = function() {
+                if (xhr.status === 0 || xhr.status === 200) {
+                    resolve(xhr.response);
+                } else {
+                    reject(new Error(`HTTP ${xhr.status} for ${href}`));
+                }
+            };
+            xhr.onerror = function() {
+                reject(new Error(`Failed to read packaged ${href}`));
+            };
+            xhr.send();
+        });
+    }
+
+    function readPackagedPartSync(href) {
+        // Synchronous requests cannot ask for an arraybuffer; the
+        // x-user-defined charset maps each byte to one character instead.
+        const xhr = new OriginalXHR();
+        xhr.open('GET', href, false);
+        xhr.overrideMimeType('text/plain; charset=x-user-defined');
+        xhr.send();
+        if (xhr.status !== 0 && xhr.status !== 200) {
+            throw new Error(`HTTP ${xhr.status} for ${href}`);
+        }
+        const text = xhr.responseText || '';
+        const bytes = new Uint8Array(text.length);
+        for (let i = 0; i < text.length; i++) {
+            bytes[i] = text.charCodeAt(i) & 0xff;
+        }
+        return bytes.buffer;
+    }
+
+    function joinPackagedParts(resource, buffers) {
+        const bundle = new Uint8Array(resource.size);
+        let offset = 0;
+        buffers.forEach(buffer => {
+            bundle.set(new Uint8Array(buffer), offset);
+            offset += buffer.byteLength;
+        });
+        appleLog(`Packaged bundle assembled: ${resource.href} (${resource.parts.length} parts, ${offset} bytes)`);
+        return bundle.buffer;
+    }
+
+    function readPackaged(resource) {
+        if (!resource.parts) {
+            return readPackagedPart(resource.href);
         }
+
+        // Large bundles are split at build time; read the parts only once the
+        // game asks for the bundle and stitch them into one buffer.
+        return Promise.all(resource.parts.map(readPackagedPart)).then(buffers => joinPackagedParts(resource, buffers));
+    }
+
+    function readPackagedSync(resource) {
+        return joinPackagedParts(resource, resource.parts.map(readPackagedPartSync));
     }
-    
+
     appleLog('Apple Books Eaglecraft port loaded');
-    
-    if (document.readyState === 'loading') {
-        document.addEventListener('DOMContentLoaded', flushPendingLogs);
-    } else {
-        flushPendingLogs();
+
+    // Backing store for the IndexedDB fallback. Records live in memory and
+    // are mirrored to localStorage, one key per record, so a reload keeps
+    // worlds and settings. Writes are coalesced: however often a record
+    // changes before the debounced flush, it is written once.
+    function createShimStorage(config) {
+        const prefix = config.prefix || 'eaglepub:';
+        const flushDelay = config.flush_ms === undefined ? 250 : config.flush_ms;
+        const BINARY = '\\u0000bin';
+        const stores = new Map();
+        const dirty = new Map();
+        let flushTimer = null;
+        const backend = (function() {
+            try {
+                const candidate = window.localStorage;
+                candidate.setItem(prefix + '\\u0001probe', '1');
+                candidate.removeItem(prefix + '\\u0001probe');
+                return candidate;
+            } catch (e) {
+                appleLog('localStorage unavailable, IndexedDB data will not persist', 'warn');
+                return null;
+            }
+        })();
+
+        // Binary data is packed 15 bits per UTF-16 code unit, offset past
+        // the control characters and below the surrogates. That is 2.5x
+        // denser than base64 and JSON.stringify never needs to escape it.
+        function packBytes(bytes) {
+            const units = [];
+            let buffer = 0;
+            let bits = 0;
+            for (let i = 0; i < bytes.length; i++) {
+                buffer = (buffer << 8) | bytes[i];
+                bits += 8;
+                if (bits >= 15) {
+                    bits -= 15;
+                    units.push(0x800 + ((buffer >> bits) & 0x7fff));
+                    buffer &= (1 << bits) - 1;
+                }
+            }
+            if (bits) {
+                units.push(0x800 + ((buffer << (15 - bits)) & 0x7fff));
+            }
+            let text = '';
+            for (let i = 0; i < units.length; i += 8192) {
+                text += String.fromCharCode.apply(null, units.slice(i, i + 8192));
+            }
+            return text;
+        }
+
+        function unpackBytes(text, length) {
+            const bytes = new Uint8Array(length);
+            let buffer = 0;
+            let bits = 0;
+            let out = 0;
+            for (let i = 0; i < text.length && out < length; i++) {
+                buffer = (buffer << 15) | (text.charCodeAt(i) - 0x800);
+                bits += 15;
+                while (bits >= 8 && out < length) {
+                    bits -= 8;
+                    bytes[out++] = (buffer >> bits) & 0xff;
+                }
+                buffer &= (1 << bits) - 1;
+            }
+            return bytes;
+        }
+
+        function encodeValue(value) {
+            return JSON.stringify(value, function(key, item) {
+                if (item instanceof ArrayBuffer) {
+                    return { [BINARY]: packBytes(new Uint8Array(item)), n: item.byteLength, t: 'ArrayBuffer' };
+                }
+                if (ArrayBuffer.isView(item)) {
+                    const bytes = new Uint8Array(item.buffer, item.byteOffset, item.byteLength);
+                    return { [BINARY]: packBytes(bytes), n: item.byteLength, t: item.constructor.name };
+                }
+                return item;
+            });
+        }
+
+        function decodeValue(text) {
+            return JSON.parse(text, function(key, item) {
+                if (item && typeof item === 'object' && typeof item[BINARY] === 'string') {
+                    const bytes = unpackBytes(item[BINARY], item.n);
+                    if (item.t === 'ArrayBuffer') {
+                        return bytes.buffer;
+                    }
+                    const View = window[item.t] || Uint8Array;
+                    return View === Uint8Array ? bytes : new View(bytes.buffer);
+                }
+                return item;
+            });
+        }
+
+        function encodeKey(key) {
+            return key === undefined ? 'undefined' : JSON.stringify(key);
+        }
+
+        function load(storeKey) {
+            const records = new Map();
+            if (!backend) {
+                return records;
+            }
+            const start = prefix + storeKey + '\\u0001';
+            for (let i = 0; i < backend.length; i++) {
+                const name = backend.key(i);
+                if (name && name.startsWith(start)) {
+                    try {
+                        records.set(name.substring(start.length), decodeValue(backend.getItem(name)));
+                    } catch (e) {
+                        appleLog(`Skipping unreadable IndexedDB record ${name}`, 'warn');
+                    }
+                }
+            }
+            appleLog(`Loaded ${records.size} IndexedDB record(s) for ${storeKey}`);
+            return records;
+        }
+
+        function flush() {
+            if (flushTimer !== null) {
+                clearTimeout(flushTimer);
+                flushTimer = null;
+            }
+            if (!backend || dirty.size === 0) {
+                dirty.clear();
+                return;
+            }
+            dirty.forEach((record, name) => {
+                try {
+                    if (record.deleted) {
+                        backend.removeItem(name);
+                    } else {
+                        backend.setItem(name, encodeValue(record.value));
+                    }
+                } catch (e) {
+                    appleLog(`Could not persist ${name}: ${e.message}`, 'error');
+                }
+            });
+            appleLog(`Flushed ${dirty.size} IndexedDB record(s)`, 'debug');
+            dirty.clear();
+        }
+
+        function markDirty(storeKey, key, record) {
+            if (!backend) {
+                return;
+            }
+            dirty.set(prefix + storeKey + '\\u0001' + key, record);
+            if (flushTimer === null) {
+                flushTimer = setTimeout(flush, flushDelay);
+            }
+        }
+
+        if (window.addEventListener) {
+            window.addEventListener('pagehide', flush);
+        }
+        if (document.addEventListener) {
+            document.addEventListener('visibilitychange', function() {
+                if (document.visibilityState === 'hidden') {
+                    flush();
+                }
+            });
+        }
+
+        function store(storeKey) {
+            let handle = stores.get(storeKey);
+            if (handle) {
+                return handle;
+            }
+            const records = load(storeKey);
+            handle = {
+                get: function(key) {
+                    return records.get(encodeKey(key));
+                },
+                put: function(key, value) {
+                    const encoded = encodeKey(key);
+                    records.set(encoded, value);
+                    markDirty(storeKey, encoded, { value: value });
+                },
+                delete: function(key) {
+                    const encoded = encodeKey(key);
+                    records.delete(encoded);
+                    markDirty(storeKey, encoded, { deleted: true });
+                },
+                clear: function() {
+                    records.forEach((value, encoded) => markDirty(storeKey, encoded, { deleted: true }));
+                    records.clear();
+                }
+            };
+            stores.set(storeKey, handle);
+            return handle;
+        }
+
+        return { store: store, flush: flush };
     }
 
     if (!window.indexedDB) {
         appleLog('Implementing IndexedDB for Apple Books', 'warn');
 
-        const memoryDB = new Map();
+        const storage = createShimStorage(EAGLEPUB_CONFIG.storage || {});
+
+        // Requests settle the way IndexedDB's do: the result is there at
+        // once, and onsuccess, then each transaction's oncomplete, fires
+        // after the caller has attached its handlers. One microtask settles
+        // everything asked for in a turn instead of a promise per call.
+        const settling = [];
+        const completing = [];
+        let settleQueued = false;
+        const defer = typeof queueMicrotask === 'function' ? queueMicrotask : function(callback) {
+            Promise.resolve().then(callback);
+        };
+
+        function fire(target, handler, type) {
+            if (!target[handler]) {
+                return;
+            }
+            // A throwing handler must not starve the ones queued after it.
+            try {
+                target[handler]({ type: type, target: target });
+            } catch (e) {
+                appleLog(`IndexedDB ${type} handler failed: ${e.message}`, 'error');
+            }
+        }
+
+        function settle() {
+            settleQueued = false;
+            settling.splice(0).forEach(request => fire(request, 'onsuccess', 'success'));
+            // Handlers may have made more requests; their transactions
+            // complete once those have settled too.
+            if (!settling.length) {
+                completing.splice(0).forEach(transaction => fire(transaction, 'oncomplete', 'complete'));
+            }
+        }
+
+        function queueSettle() {
+            if (!settleQueued) {
+                settleQueued = true;
+                defer(settle);
+            }
+        }
+
+        function request(result, source, transaction) {
+            const pending = {
+                result: result,
+                error: null,
+                readyState: 'done',
+                source: source || null,
+                transaction: transaction || null,
+                onsuccess: null,
+                onerror: null
+            };
+            settling.push(pending);
+            queueSettle();
+            return pending;
+        }
 
         window.indexedDB = {
             open: function(name, version) {
                 appleLog(`Opening IndexedDB: ${name} v${version}`);
 
-                return new Promise((resolve) => {
-                    const db = {
-                        name: name,
-                        version: version || 1,
-                        transaction: function(stores, mode = 'readonly') {
-                            return {
-                                objectStore: function(storeName) {
-                                    const storeKey = `${name}_${storeName}`;
-                                    if (!memoryDB.has(storeKey)) {
-                                        memoryDB.set(storeKey, new Map());
+                const db = {
+                    name: name,
+                    version: version || 1,
+                    transaction: function(stores, mode = 'readonly') {
+                        const transaction = {
+                            db: db,
+                            mode: mode,
+                            error: null,
+                            oncomplete: null,
+                            onerror: null,
+                            onabort: null,
+                            objectStore: function(storeName) {
+                                const store = storage.store(`${name}_${storeName}`);
+                                const objectStore = {
+                                    name: storeName,
+                                    transaction: transaction,
+                                    // Reads and writes hit memory synchronously.
+                                    get: function(key) {
+                                        return request(store.get(key), objectStore, transaction);
+                                    },
+                                    put: function(value, key) {
+                                        store.put(key, value);
+                                        return request(key, objectStore, transaction);
+                                    },
+                                    delete: function(key) {
+                                        store.delete(key);
+                                        return request(undefined, objectStore, transaction);
+                                    },
+                                    clear: function() {
+                                        store.clear();
+                                        return request(undefined, objectStore, transaction);
                                     }
+                                };
+                                return objectStore;
+                            }
+                        };
+                        completing.push(transaction);
+                        queueSettle();
+                        return transaction;
+                    },
+                    createObjectStore: function(name, options) {
+                        // Stores persist across reloads, so creating one
+                        // again keeps its records.
+                        appleLog(`Created object store: ${name}`);
+                        return this.transaction([name], 'readwrite').objectStore(name);
+                    },
+                    close: function() {}
+                };
 
-                                    return {
-                                        get: function(key) {
-                                            return new Promise((resolve) => {
-                                                const store = memoryDB.get(storeKey);
-                                                const result = store ? store.get(key) : undefined;
-                                                resolve({ target: { result: result } });
-                                            });
-                                        },
-                                        put: function(value, key) {
-                                            return new Promise((resolve) => {
-                                                const store = memoryDB.get(storeKey);
-                                                if (store) {
-                                                    store.set(key, value);
-                                                }
-                                                resolve({ target: { result: key } });
-                                            });
-                                        },
-                                        delete: function(key) {
-                                            return new Promise((resolve) => {
-                                                const store = memoryDB.get(storeKey);
-                                                if (store) {
-                                                    store.delete(key);
-                                                }
-                                                resolve({ target: { result: undefined } });
-                                            });
-                                        }
-                                    };
-                                }
-                            };
-                        },
-                        createObjectStore: function(name, options) {
-                            const storeKey = `${this.name}_${name}`;
-                            memoryDB.set(storeKey, new Map());
-                            appleLog(`Created object store: ${name}`);
-                            return this.transaction([name], 'readwrite').objectStore(name);
-                        }
-                    };
-
-                    setTimeout(() => {
-                        resolve({ target: { result: db } });
-                    }, 10);
-                });
+                return request(db);
+            },
+            flush: function() {
+                storage.flush();
             }
         };
     }
 
+    if (window.indexedDB && window.indexedDB.open) {
+        const originalOpen = window.indexedDB.open;
+        window.indexedDB.open = function() {
+            postMilestone('indexeddb');
+            return originalOpen.apply(this, arguments);
+        };
+    }
+
     if (!window.caches) {
         appleLog('Implementing Cache API for Apple Books', 'warn');
 
-        const memoryCache = new Map();
+        // One LRU across every named cache, bounded by bytes rather than by
+        // entries. Map iteration order is insertion order, so re-inserting
+        // on a hit keeps the least recently used entry first. Bodies are
+        // kept as ArrayBuffers; a stored Response could only be read once.
+        const budget = EAGLEPUB_CONFIG.response_cache_bytes === undefined ?
+            32 * 1024 * 1024 : EAGLEPUB_CONFIG.response_cache_bytes;
+        const entries = new Map();
+        const openCaches = new Map();
+        const stats = { hits: 0, misses: 0, evictions: 0, bytes: 0 };
+
+        function cacheUrl(request) {
+            return typeof request === 'string' ? request : request.url;
+        }
+
+        function reportStats() {
+            appleLog(`Response cache: ${stats.hits} hit(s), ${stats.misses} miss(es), ` +
+                     `${stats.evictions} eviction(s), ${entries.size} entries, ` +
+                     `${(stats.bytes / 1024 / 1024).toFixed(1)} of ${(budget / 1024 / 1024).toFixed(1)} MB`);
+        }
+
+        function removeEntry(key) {
+            const entry = entries.get(key);
+            if (entry) {
+                entries.delete(key);
+                stats.bytes -= entry.body.byteLength;
+            }
+            return !!entry;
+        }
+
+        function evictToBudget() {
+            const evicted = stats.evictions;
+            for (const key of entries.keys()) {
+                if (stats.bytes <= budget) {
+                    break;
+                }
+                removeEntry(key);
+                stats.evictions++;
+            }
+            if (stats.evictions > evicted) {
+                reportStats();
+            }
+        }
+
+        function openCache(cacheName) {
+            const prefix = cacheName + '\\u0001';
+            return {
+                match: function(request) {
+                    const key = prefix + cacheUrl(request);
+                    const entry = entries.get(key);
+                    if (!entry) {
+                        stats.misses++;
+                        return Promise.resolve(undefined);
+                    }
+                    stats.hits++;
+                    entries.delete(key);
+                    entries.set(key, entry);
+                    if ((stats.hits + stats.misses) % 100 === 0) {
+                        reportStats();
+                    }
+                    return Promise.resolve(new Response(entry.body, entry.init));
+                },
+                put: function(request, response) {
+                    const key = prefix + cacheUrl(request);
+                    const init = {
+                        status: response.status || 200,
+                        statusText: response.statusText,
+                        headers: response.headers ? Array.from(response.headers.entries()) : []
+                    };
+                    return response.arrayBuffer().then(body => {
+                        removeEntry(key);
+                        if (body.byteLength > budget) {
+                            appleLog(`Not caching ${cacheUrl(request)}: ${body.byteLength} bytes exceeds the budget`, 'debug');
+                            return;
+                        }
+                        entries.set(key, { body: body, init: init });
+                        stats.bytes += body.byteLength;
+                        evictToBudget();
+                    });
+                },
+                delete: function(request) {
+                    return Promise.resolve(removeEntry(prefix + cacheUrl(request)));
+                }
+            };
+        }
 
         window.caches = {
             open: function(cacheName) {
-                return Promise.resolve({
-                    match: function(request) {
-                        const url = typeof request === 'string' ? request : request.url;
-                        const cached = memoryCache.get(url);
-                        return Promise.resolve(cached || undefined);
-                    },
-                    put: function(request, response) {
-                        const url = typeof request === 'string' ? request : request.url;
-                        memoryCache.set(url, response);
-                        appleLog(`Cached: ${url}`);
-                        return Promise.resolve();
-                    },
-                    delete: function(request) {
-                        const url = typeof request === 'string' ? request : request.url;
-                        const deleted = memoryCache.delete(url);
-                        return Promise.resolve(deleted);
-                    }
-                });
+                if (!openCaches.has(cacheName)) {
+                    openCaches.set(cacheName, openCache(cacheName));
+                }
+                return Promise.resolve(openCaches.get(cacheName));
+            },
+            stats: function() {
+                reportStats();
+                return Object.assign({ entries: entries.size, budget: budget }, stats);
             }
         };
     }
 
+    // Route table compiled by the builder: one regex with a capture group
+    // per rule, in rule order, so a single exec() classifies a URL. Packaged
+    // resources are resolved before the table.
+    const routing = EAGLEPUB_CONFIG.routes || { pattern: '^(?:(.*))$', actions: ['local'], timeout_ms: 15000 };
+    const routePattern = new RegExp(routing.pattern);
+    const routeStats = {};
+    let routedRequests = 0;
+
+    function now() {
+        return window.performance && performance.now ? performance.now() : Date.now();
+    }
+
+    function classifyRoute(url) {
+        if (resolvePackaged(url)) {
+            return 'packaged';
+        }
+        const match = routePattern.exec(url.split('#')[0]);
+        if (match) {
+            for (let i = 1; i < match.length; i++) {
+                if (match[i] !== undefined) {
+                    return routing.actions[i - 1];
+                }
+            }
+        }
+        return 'local';
+    }
+
+    function reportRoutes() {
+        Object.keys(routeStats).forEach(route => {
+            const stats = routeStats[route];
+            appleLog(`Route ${route}: ${stats.requests} request(s), ${stats.errors} error(s), ` +
+                     `${stats.timeouts} timeout(s), mean ${(stats.total_ms / stats.requests).toFixed(1)} ms, ` +
+                     `max ${stats.max_ms.toFixed(1)} ms`);
+        });
+    }
+
+    function finishRoute(route, url, started, status, failure) {
+        const elapsed = now() - started;
+        const stats = routeStats[route] ||
+            (routeStats[route] = { requests: 0, errors: 0, timeouts: 0, total_ms: 0, max_ms: 0 });
+        stats.requests++;
+        stats.total_ms += elapsed;
+        stats.max_ms = Math.max(stats.max_ms, elapsed);
+        if (failure === 'timeout') {
+            stats.timeouts++;
+            appleLog(`${route} request timed out: ${url}`, 'warn');
+        } else if (failure) {
+            stats.errors++;
+            appleLog(`${route} request failed: ${url} - ${failure}`, 'error');
+        } else {
+            appleLog(`${route} ${url} - ${status} in ${elapsed.toFixed(1)} ms`, 'debug');
+        }
+        if (++routedRequests % 100 === 0) {
+            reportRoutes();
+        }
+    }
+
+    window.eaglepubRoutes = {
+        classify: classifyRoute,
+        stats: function() {
+            reportRoutes();
+            return JSON.parse(JSON.stringify(routeStats));
+        }
+    };
+
+    function fetchWithTimeout(originalFetch, request, options) {
+        // The timer is cleared as soon as the request settles, and aborts
+        // the request when it fires.
+        if (!routing.timeout_ms) {
+            return originalFetch(request, options);
+        }
+        let timer = null;
+        const controller = window.AbortController && !options.signal ? new AbortController() : null;
+        if (controller) {
+            options.signal = controller.signal;
+        }
+        const timeout = new Promise((_, reject) => {
+            timer = setTimeout(() => {
+                if (controller) {
+                    controller.abort();
+                }
+                reject(new Error('Network timeout'));
+            }, routing.timeout_ms);
+        });
+        return Promise.race([originalFetch(request, options), timeout]).finally(() => clearTimeout(timer));
+    }
+
+    function emptyResponse() {
+        return new Response(new ArrayBuffer(0), { status: 200, statusText: 'OK' });
+    }
+
     if (window.fetch) {
         const originalFetch = window.fetch;
-        window.fetch = function(url, options = {}) {
-            appleLog(`Fetch request: ${url}`);
-
-            const isWebSocket = url.includes('ws://') || url.includes('wss://');
-            const isServerRequest = url.includes('api.') || url.includes('server') || url.includes(':') || url.includes('http') || url.includes('ws');
-            
-            if (isWebSocket || isServerRequest) {
-                return originalFetch(url, {
+        window.fetch = function(request, options = {}) {
+            postMilestone('request');
+            const url = requestUrl(request);
+            const route = classifyRoute(url);
+            const started = now();
+            let response;
+
+            if (route === 'packaged') {
+                const packaged = resolvePackaged(url);
+                response = packaged.parts ? readPackaged(packaged).then(buffer => new Response(buffer, {
+                    status: 200,
+                    statusText: 'OK',
+                    headers: { 'Content-Type': packaged.type }
+                })) : originalFetch(packaged.href, options);
+            } else if (route === 'stub') {
+                response = Promise.resolve(emptyResponse());
+            } else if (route === 'websocket') {
+                response = originalFetch(request, options);
+            } else {
+                response = fetchWithTimeout(originalFetch, request, {
                     ...options,
                     mode: 'cors',
-                    cache: 'no-cache'
-                }).then(response => {
-                    appleLog(`Fetch response: ${url} - ${response.status}`);
-                    return response;
-                }).catch(error => {
-                    appleLog(`Fetch failed: ${url} - ${error.message}`, 'error');
-                    throw error;
+                    cache: route === 'remote' ? 'no-cache' : 'default'
                 });
             }
 
-            const fetchPromise = originalFetch(url, {
-                ...options,
-                mode: 'cors',
-                cache: 'default'
-            }).then(response => {
-                appleLog(`Fetch response: ${url} - ${response.status}`);
-                return response;
-            }).catch(error => {
-                appleLog(`Fetch failed: ${url} - ${error.message}`, 'error');
+            return response.then(result => {
+                finishRoute(route, url, started, result.status);
+                return result;
+            }, error => {
+                finishRoute(route, url, started, 0, error.message === 'Network timeout' ? 'timeout' : error.message);
                 throw error;
             });
+        };
+    }
 
-            const timeoutPromise = new Promise((_, reject) => {
-                setTimeout(() => reject(new Error('Network timeout')), 15000);
-            });
+    function completeXHR(xhr, href, type, buffer) {
+        // XHR state is exposed through read-only prototype getters, so the
+        // response is installed as own properties instead.
+        let response = buffer;
+        if (xhr.responseType === 'blob') {
+            response = new Blob([buffer], { type: type });
+        } else if ((xhr.responseType === '' || xhr.responseType === 'text') && /x-user-defined/i.test(xhr._mimeType)) {
+            // The old binary-as-text idiom: bytes 0x80-0xff land in U+F780-U+F7FF.
+            const bytes = new Uint8Array(buffer);
+            let text = '';
+            for (let i = 0; i < bytes.length; i += 8192) {
+                text += String.fromCharCode.apply(null, Array.from(bytes.subarray(i, i + 8192),
+                    byte => byte < 0x80 ? byte : 0xf700 + byte));
+            }
+            response = text;
+        } else if (xhr.responseType === '' || xhr.responseType === 'text') {
+            response = new TextDecoder().decode(buffer);
+        }
 
-            return Promise.race([fetchPromise, timeoutPromise]);
+        const state = {
+            readyState: 4,
+            status: 200,
+            statusText: 'OK',
+            response: response,
+            responseURL: href
         };
+        if (typeof response === 'string') {
+            state.responseText = response;
+        }
+        Object.keys(state).forEach(key => {
+            Object.defineProperty(xhr, key, { configurable: true, value: state[key] });
+        });
+
+        ['readystatechange', 'load', 'loadend'].forEach(type => {
+            xhr.dispatchEvent(new Event(type));
+        });
     }
 
     if (window.XMLHttpRequest) {
-        const OriginalXHR = window.XMLHttpRequest;
         window.XMLHttpRequest = function() {
             const xhr = new OriginalXHR();
             const originalOpen = xhr.open;
             const originalSend = xhr.send;
+            const originalOverrideMimeType = xhr.overrideMimeType;
+
+            xhr.overrideMimeType = function(mimeType) {
+                xhr._mimeType = mimeType;
+                return originalOverrideMimeType.call(this, mimeType);
+            };
 
             xhr.open = function(method, url, async = true, user, password) {
-                appleLog(`XHR ${method}: ${url}`);
-                xhr.timeout = 15000;
+                postMilestone('request');
                 xhr._url = url;
-                
-                xhr.ontimeout = function() {
-                    appleLog(`XHR timeout: ${url}`, 'warn');
-                    xhr.status = 200;
-                    xhr.readyState = 4;
-                    xhr.response = new ArrayBuffer(0);
-                    xhr.responseText = '';
-                    if (xhr.onload) xhr.onload();
-                };
+                xhr._async = async;
+                xhr._packaged = resolvePackaged(url);
+                xhr._route = classifyRoute(url);
+
+                if (xhr._packaged) {
+                    url = xhr._packaged.parts ? xhr._packaged.parts[0] : xhr._packaged.href;
+                }
 
-                return originalOpen.call(this, method, url, async, user, password);
+                const result = originalOpen.call(this, method, url, async, user, password);
+                // Synchronous requests may not have a timeout.
+                if (async && routing.timeout_ms && (xhr._route === 'local' || xhr._route === 'remote')) {
+                    xhr.timeout = routing.timeout_ms;
+                }
+                return result;
             };
 
             xhr.send = function(data) {
-                const originalError = xhr.onerror;
-                xhr.onerror = function(e) {
-                    const url = xhr.responseURL || xhr._url || 'unknown';
-                    appleLog(`XHR attempting: ${url}`, 'info');
+                const route = xhr._route;
+                const url = xhr._url || 'unknown';
+                const started = now();
+                let failure = null;
+                xhr.addEventListener('error', () => { failure = failure || 'network error'; });
+                xhr.addEventListener('timeout', () => { failure = 'timeout'; });
+                xhr.addEventListener('loadend', () => finishRoute(route, url, started, xhr.status, failure));
 
-                    if (url.includes('ws://') || url.includes('wss://') || url.includes('api.') || url.includes('server') || url.includes(':')) {
-                        if (originalError) originalError.call(this, e);
+                const packaged = xhr._packaged;
+                if (packaged && packaged.parts && !xhr._async) {
+                    // A synchronous caller reads the body as soon as send()
+                    // returns, so the parts are fetched and joined in place.
+                    let buffer;
+                    try {
+                        buffer = readPackagedSync(packaged);
+                    } catch (error) {
+                        failure = error.message;
+                        xhr.dispatchEvent(new Event('error'));
+                        xhr.dispatchEvent(new Event('loadend'));
                         return;
                     }
-
-                    if (url.includes('Bundle') || url.includes('bundle') || url.includes('client') || url.includes('eaglercraftx') || url.includes('.epk')) {
-                        xhr.status = 200;
-                        xhr.readyState = 4;
-                        xhr.statusText = 'OK';
-                        
-                        const epkHeader = new Uint8Array([0x45, 0x50, 0x4B, 0x00]);
-                        const bundleSize = new Uint8Array(4);
-                        const bundleData = new Uint8Array(1024);
-                        
-                        const fullBundle = new Uint8Array(epkHeader.length + bundleSize.length + bundleData.length);
-                        fullBundle.set(epkHeader, 0);
-                        fullBundle.set(bundleSize, epkHeader.length);
-                        fullBundle.set(bundleData, epkHeader.length + bundleSize.length);
-                        
-                        xhr.response = fullBundle.buffer;
-                        xhr.responseText = '';
-                        appleLog(`EPK bundle created: ${fullBundle.length} bytes`);
-                        
-                        if (xhr.onreadystatechange) xhr.onreadystatechange();
-                        if (xhr.onload) xhr.onload();
-                    } else {
-                        if (originalError) originalError.call(this, e);
-                    }
-                };
+                    completeXHR(xhr, packaged.href, packaged.type, buffer);
+                    return;
+                }
+                if (packaged && packaged.parts) {
+                    readPackaged(packaged).then(buffer => {
+                        completeXHR(xhr, packaged.href, packaged.type, buffer);
+                    }).catch(error => {
+                        failure = error.message;
+                        xhr.dispatchEvent(new Event('error'));
+                        xhr.dispatchEvent(new Event('loadend'));
+                    });
+                    return;
+                }
+                if (route === 'stub') {
+                    setTimeout(() => completeXHR(xhr, url, '', new ArrayBuffer(0)), 0);
+                    return;
+                }
+
                 return originalSend.call(this, data);
             };
 
@@ -274,22 +1272,145 @@ def create_eaglecraft_epub():
         };
     }
 
+    // Graphics profiles come from the builder. The launcher stores the
+    // reader's choice, and it takes effect the next time the game boots.
+    const graphics = EAGLEPUB_CONFIG.graphics || { profiles: {}, default: 'auto' };
+
+    function detectGraphicsProfile() {
+        const agent = navigator.userAgent || '';
+        if (/iPhone|iPod/.test(agent)) {
+            return 'iphone-low-power';
+        }
+        // iPadOS reports itself as a Mac; touch support gives it away.
+        if (/iPad/.test(agent) || (/Macintosh/.test(agent) && navigator.maxTouchPoints > 1)) {
+            return 'ipad';
+        }
+        return 'mac';
+    }
+
+    function selectGraphicsProfile() {
+        let name = graphics.default;
+        try {
+            name = window.localStorage.getItem(graphics.storage_key) || name;
+        } catch (e) {
+            // No storage; keep the build default.
+        }
+        if (name === 'auto') {
+            name = detectGraphicsProfile();
+        }
+        return graphics.profiles[name] ? name : null;
+    }
+
+    const graphicsProfileName = selectGraphicsProfile();
+    const graphicsProfile = graphicsProfileName ? graphics.profiles[graphicsProfileName] : null;
+
+    if (graphicsProfile && graphicsProfile.render_scale !== 1) {
+        // The game sizes its canvas from devicePixelRatio, so scaling the
+        // ratio renders a smaller backbuffer that CSS stretches to fit.
+        const nativeRatio = window.devicePixelRatio || 1;
+        try {
+            Object.defineProperty(window, 'devicePixelRatio', {
+                configurable: true,
+                get: function() {
+                    return nativeRatio * graphicsProfile.render_scale;
+                }
+            });
+        } catch (e) {
+            appleLog(`Render scale unavailable: ${e.message}`, 'warn');
+        }
+    }
+
+    function watchFirstFrame(gl) {
+        // Own properties shadow the context's draw calls until the first one
+        // runs, then are deleted so later frames go straight to WebGL.
+        if (milestones.frame !== undefined) {
+            return;
+        }
+        ['drawArrays', 'drawElements'].forEach(function(method) {
+            gl[method] = function() {
+                delete gl.drawArrays;
+                delete gl.drawElements;
+                const result = gl[method].apply(gl, arguments);
+                postMilestone('frame');
+                loadIdleScripts();
+                return result;
+            };
+        });
+    }
+
+    // Non-critical scripts split out by the builder wait in the page as
+    // <script type="text/eaglepub-lazy" data-src> placeholders. They load
+    // once the first frame is drawn (or 10 s after the page loaded, for a
+    // game that never draws), or earlier through eaglepubScripts.load(id).
+    // Non-async script elements run in insertion order, so document order
+    // is kept without waiting for one to load before requesting the next.
+    const lazyScripts = {};
+    let idleScriptsStarted = false;
+
+    function loadLazyScript(placeholder) {
+        const id = placeholder.id;
+        if (!lazyScripts[id]) {
+            lazyScripts[id] = new Promise((resolve, reject) => {
+                const script = document.createElement('script');
+                script.async = false;
+                script.onload = () => {
+                    appleLog(`Loaded lazy script ${id}`, 'debug');
+                    resolve();
+                };
+                script.onerror = () => reject(new Error(`Could not load lazy script ${id}`));
+                script.src = placeholder.getAttribute('data-src');
+                placeholder.parentNode.insertBefore(script, placeholder.nextSibling);
+            });
+        }
+        return lazyScripts[id];
+    }
+
+    function loadIdleScripts() {
+        if (idleScriptsStarted || !document.querySelectorAll) {
+            return;
+        }
+        idleScriptsStarted = true;
+        const placeholders = Array.prototype.slice.call(document.querySelectorAll('script[type="text/eaglepub-lazy"]'));
+        const start = () => placeholders.forEach(loadLazyScript);
+        if (window.requestIdleCallback) {
+            window.requestIdleCallback(start, { timeout: 2000 });
+        } else {
+            setTimeout(start, 0);
+        }
+    }
+
+    window.eaglepubScripts = {
+        load: function(id) {
+            const placeholder = document.getElementById(id);
+            if (!placeholder || placeholder.getAttribute('type') !== 'text/eaglepub-lazy') {
+                return Promise.reject(new Error(`No lazy script ${id}`));
+            }
+            return loadLazyScript(placeholder);
+        }
+    };
+    window.addEventListener('load', () => setTimeout(loadIdleScripts, 10000));
+
     if (window.HTMLCanvasElement) {
+        // WebGL 2 contexts take the same attributes and profile as WebGL 1.
+        const webglContextTypes = ['webgl', 'webgl2', 'experimental-webgl'];
         const originalGetContext = HTMLCanvasElement.prototype.getContext;
         HTMLCanvasElement.prototype.getContext = function(contextType, options) {
-            if (contextType === 'webgl' || contextType === 'experimental-webgl') {
-                appleLog(`Creating WebGL context with Apple Books optimizations`);
+            if (webglContextTypes.indexOf(contextType) !== -1) {
+                appleLog(`Creating WebGL context with graphics profile ${graphicsProfileName || 'compatible'}`);
                 const gl = originalGetContext.call(this, contextType, {
                     ...options,
                     antialias: false,
                     depth: true,
                     stencil: false,
                     preserveDrawingBuffer: true,
-                    powerPreference: 'default'
+                    powerPreference: 'default',
+                    ...(graphicsProfile ? graphicsProfile.context : {})
                 });
 
                 if (gl) {
                     appleLog('WebGL context created successfully');
+                    postMilestone('webgl');
+                    watchFirstFrame(gl);
                 } else {
                     appleLog('WebGL context creation failed', 'error');
                 }
@@ -311,7 +1432,7 @@ def create_eaglecraft_epub():
         const element = originalCreateElement.call(this, tagName);
 
         if (tagName.toLowerCase() === 'style' || tagName.toLowerCase() === 'link') {
-            appleLog(`Creating ${tagName} element with Apple Books compatibility`);
+            appleLog(`Creating ${tagName} element with Apple Books compatibility`, 'debug');
 
             element.onerror = function() {
                 appleLog(`${tagName} loading failed - using fallback`, 'warn');
@@ -320,28 +1441,28 @@ def create_eaglecraft_epub():
 
         return element;
     };
-
+__PERF_HUD_JS__
     appleLog('Apple Books browser API implementation complete');
+    postMilestone('shim');
 
 })();
 </script>
 """
-    
 
 
+def render_browser_api_fixes(config):
+    # "</" would end the surrounding <script> element early.
+    config_js = json.dumps(config, separators=(",", ":"), sort_keys=True).replace("</", "<\\/")
+    fixes = BROWSER_API_FIXES.replace("__APPLE_LOG_JS__", APPLE_LOG_JS.strip("\n"), 1)
+    # Builds without the HUD carry none of its code.
+    fixes = fixes.replace("__PERF_HUD_JS__", PERF_HUD_JS if config.get("perf_hud") else "", 1)
+    return fixes.replace("__EAGLEPUB_CONFIG__", config_js, 1)
 
-    if "<head>" in raw_html:
-        raw_html = raw_html.replace("<head>", f"<head>{browser_api_fixes}")
-    else:
-        raw_html = browser_api_fixes + raw_html
-
-    html_filename = "eaglecraft_fixed.html"
-    html_path = os.path.join(oebps_path, html_filename)
 
-    with open(html_path, "w", encoding="utf-8") as f:
-        f.write(raw_html)
-
-    index_xhtml = f"""<?xml version="1.0" encoding="utf-8"?>
+def render_index_xhtml(html_filename, config=None):
+    # "]]>" would end the surrounding CDATA section early.
+    config_js = json.dumps(config or {}, separators=(",", ":"), sort_keys=True).replace("]]>", "]]\\u003e")
+    return f"""<?xml version="1.0" encoding="utf-8"?>
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
 <html xmlns="http://www.w3.org/1999/xhtml">
  <head>
@@ -390,6 +1511,7 @@ body {{
 }}
 
 .header.minimized .launch-btn,
+.header.minimized .graphics,
 .header.minimized .status,
 .header.minimized .loading,
 .header.minimized h1,
@@ -440,6 +1562,10 @@ body {{
        outline: 3px solid 
        outline-offset: 2px;
      }}
+     .graphics {{
+       margin-top: 10px;
+       font-size: 14px;
+     }}
      .status {{
        margin-top: 15px;
        font-size: 14px;
@@ -466,6 +1592,7 @@ body {{
    </style>
    <script type="text/javascript">
      <![CDATA[
+     const LAUNCHER_CONFIG = {config_js};
      let gameLoaded = false;
 
      function toggleHeader() {{
@@ -473,6 +1600,7 @@ body {{
        header.classList.toggle('minimized');
      }}
 
+     // @debug-start
      function toggleDebugLog() {{
        const logger = document.getElementById('apple-books-logger');
        const button = document.getElementById('debug-toggle-btn');
@@ -487,67 +1615,280 @@ body {{
            button.textContent = 'Debug Log';
            button.style.backgroundColor = '#333';
          }} else {{
-           // Show the logger
+           // Show the logger and draw what was buffered while hidden
            logger.style.display = 'block';
            button.textContent = 'Hide Log';
            button.style.backgroundColor = '#f44';
+           appleLog.flush();
+         }}
+       }}
+     }}
+
+     function copyStartupTrace() {{
+       // Apple Books may refuse clipboard access, so the trace is also put
+       // in a selected text box to copy by hand.
+       const text = JSON.stringify(startupTrace());
+       const output = document.getElementById('trace-output');
+       output.value = text;
+       output.style.display = 'block';
+       output.select();
+       if (navigator.clipboard && navigator.clipboard.writeText) {{
+         navigator.clipboard.writeText(text).then(function() {{
+           appleLog(`Startup trace copied (${{launch.marks.length}} marks)`);
+         }}, function() {{
+           appleLog('Clipboard unavailable; copy the startup trace from the box', 'warn');
+         }});
+       }} else {{
+         appleLog('Clipboard unavailable; copy the startup trace from the box', 'warn');
+       }}
+     }}
+{APPLE_LOG_JS}
+     // A window property so the shim in the game iframe can log here too.
+     window.appleLog = createAppleLog(LAUNCHER_CONFIG.log || {{}}, 'apple-books-logger', 'log-content');
+     // @debug-end
+
+     // Boot milestones posted by the shim in the game frame, in this page's
+     // performance.now() time. The game is shown on its first frame. `marks`
+     // keeps every launcher and game milestone, across reloads, for the
+     // startup trace.
+     const launch = {{
+       milestones: {{}},
+       marks: [],
+       started: null,
+       clicked: null,
+       latency_ms: null,
+       timer: null,
+       slow: false
+     }};
+     window.eaglepubLaunch = launch;
+     const launchConfig = LAUNCHER_CONFIG.launch || {{}};
+     const clockOrigin = performance.timeOrigin || Date.now() - performance.now();
+
+     function traceMark(name, thread, at) {{
+       if (at === undefined) {{
+         at = performance.now();
+         try {{
+           performance.mark(`eaglepub:${{name}}`);
+         }} catch (e) {{
+           // Marks are only a convenience.
          }}
        }}
+       launch.marks.push({{ name: name, thread: thread, at: at }});
+     }}
+
+     // Chrome trace event format, loadable in chrome://tracing or Perfetto:
+     // an instant event per milestone on its thread, and a span on the
+     // "phases" track for the time leading up to each one. Timestamps are
+     // microseconds since the book started loading.
+     function startupTrace() {{
+       const threads = {{ launcher: 1, game: 2, phases: 3 }};
+       const us = function(ms) {{
+         return Math.round(ms * 1000);
+       }};
+       const events = [{{ name: 'process_name', ph: 'M', pid: 1, tid: 0, args: {{ name: 'EaglePub' }} }}];
+       Object.keys(threads).forEach(function(name) {{
+         events.push({{ name: 'thread_name', ph: 'M', pid: 1, tid: threads[name], args: {{ name: name }} }});
+       }});
+
+       let previous = 0;
+       launch.marks.slice().sort(function(a, b) {{
+         return a.at - b.at;
+       }}).forEach(function(mark) {{
+         events.push({{ name: mark.name, cat: 'boot', ph: 'i', s: 't', ts: us(mark.at), pid: 1, tid: threads[mark.thread] }});
+         events.push({{ name: mark.name, cat: 'phase', ph: 'X', ts: us(previous), dur: us(mark.at - previous), pid: 1,
+                       tid: threads.phases }});
+         previous = mark.at;
+       }});
+
+       return {{
+         traceEvents: events,
+         displayTimeUnit: 'ms',
+         otherData: {{
+           format: 'eaglepub-startup-trace/1',
+           userAgent: navigator.userAgent,
+           maxTouchPoints: navigator.maxTouchPoints || 0,
+           devicePixelRatio: window.devicePixelRatio,
+           screen: window.screen ? `${{screen.width}}x${{screen.height}}` : null,
+           graphicsProfile: (document.getElementById('graphicsProfile') || {{}}).value || null,
+           latency_ms: launch.latency_ms
+         }}
+       }};
      }}
+     window.eaglepubTrace = startupTrace;
 
-     function appleLog(message, type = 'info') {{
-       const logContent = document.getElementById('log-content');
-       if (logContent) {{
-         const timestamp = new Date().toLocaleTimeString();
-         const color = type === 'error' ? '#f44' : type === 'warn' ? '#fa0' : '#0f0';
-         logContent.innerHTML += `<div style="color: ${{color}}; margin-bottom: 2px;">[${{timestamp}}] ${{message}}</div>`;
-         logContent.scrollTop = logContent.scrollHeight;
+     function startGameFrame() {{
+       const iframe = document.getElementById('gameFrame');
+       if (iframe.getAttribute('src')) {{
+         return iframe;
        }}
+
+       // A hidden frame still lays out and animates, so the game can boot
+       // behind the header before the reader asks for it.
+       iframe.style.visibility = launch.clicked === null ? 'hidden' : 'visible';
+       iframe.style.display = 'block';
+       launch.milestones = {{}};
+       launch.slow = false;
+       launch.started = performance.now();
+       iframe.onload = function() {{
+         appleLog('Iframe loaded successfully');
+       }};
+       // Only a fallback; launchTimedOut() catches failed navigations.
+       iframe.onerror = gameFailed;
+       traceMark('iframe-navigation', 'launcher');
+       iframe.src = '{html_filename}';
+       appleLog(launch.clicked === null ? 'Warming up game frame' : 'Game frame loading');
+       return iframe;
+     }}
+
+     function gameReady() {{
+       clearTimeout(launch.timer);
+       gameLoaded = true;
+       traceMark('ready', 'launcher');
+       launch.latency_ms = Math.max(0, launch.milestones.frame - launch.clicked);
+       document.getElementById('launchBtn').style.display = 'none';
+       document.getElementById('loading').style.display = 'none';
+       const status = document.getElementById('status');
+       status.textContent = 'Game loaded!';
+       // @debug-start
+       status.textContent = 'Game loaded! Use the Debug Log button to monitor progress.';
+       // @debug-end
+       appleLog(`Game interface ready ${{launch.latency_ms.toFixed(0)}} ms after launch ` +
+                `(${{(launch.milestones.frame - launch.started).toFixed(0)}} ms after the frame started loading)`);
+     }}
+
+     function gameFailed() {{
+       clearTimeout(launch.timer);
+       const iframe = document.getElementById('gameFrame');
+       const launchBtn = document.getElementById('launchBtn');
+       const status = document.getElementById('status');
+       status.textContent = 'Error loading game.';
+       // @debug-start
+       status.textContent = 'Error loading game. Check Debug Log for details.';
+       // @debug-end
+       iframe.removeAttribute('src');
+       iframe.style.display = 'none';
+       launch.clicked = null;
+       launchBtn.disabled = false;
+       launchBtn.textContent = 'Retry Launch';
+       launchBtn.style.display = 'inline-block';
+       document.getElementById('loading').style.display = 'none';
+       appleLog('Iframe loading failed', 'error');
      }}
 
+     window.addEventListener('message', function(event) {{
+       const iframe = document.getElementById('gameFrame');
+       const data = event.data;
+       if (!data || data.eaglepub !== 'milestone' || event.source !== iframe.contentWindow) {{
+         return;
+       }}
+       // The shim reports wall-clock times; the frame has its own clock.
+       const at = data.time - clockOrigin;
+       launch.milestones[data.name] = at;
+       traceMark(data.name, 'game', at);
+       appleLog(`Boot milestone ${{data.name}} at +${{(at - launch.started).toFixed(0)}} ms`);
+       if (data.name === 'frame' && launch.clicked !== null && !gameLoaded) {{
+         gameReady();
+       }}
+     }});
+
      function launchGame() {{
-       if (!gameLoaded) {{
-         const iframe = document.getElementById('gameFrame');
-         const launchBtn = document.getElementById('launchBtn');
-         const status = document.getElementById('status');
-         const loading = document.getElementById('loading');
-
-         loading.style.display = 'block';
-         status.textContent = 'Loading with Apple Books browser API support...';
-         launchBtn.disabled = true;
-         launchBtn.textContent = 'Loading...';
-
-         iframe.style.display = 'block';
-         iframe.src = '{html_filename}';
-
-         // Log to parent debug console
-         appleLog('Game launch initiated');
-
-         setTimeout(function() {{
-           launchBtn.style.display = 'none';
-           loading.style.display = 'none';
-           status.textContent = 'Game loaded! Use the Debug Log button to monitor progress.';
-           gameLoaded = true;
-           appleLog('Game interface ready');
-         }}, 3000);
-
-         iframe.onload = function() {{
-           status.textContent = 'Game interface loaded. Check Debug Log for details.';
-           appleLog('Iframe loaded successfully');
-         }};
-
-         iframe.onerror = function() {{
-           status.textContent = 'Error loading game. Check Debug Log for details.';
-           launchBtn.disabled = false;
-           launchBtn.textContent = 'Retry Launch';
-           launchBtn.style.display = 'inline-block';
-           loading.style.display = 'none';
-           appleLog('Iframe loading failed', 'error');
-         }};
+       if (gameLoaded || launch.clicked !== null) {{
+         return;
+       }}
+       const launchBtn = document.getElementById('launchBtn');
+       const status = document.getElementById('status');
+
+       launch.clicked = performance.now();
+       traceMark('launch', 'launcher');
+       document.getElementById('loading').style.display = 'block';
+       status.textContent = 'Loading with Apple Books browser API support...';
+       launchBtn.disabled = true;
+       launchBtn.textContent = 'Loading...';
+
+       const iframe = startGameFrame();
+       iframe.style.visibility = 'visible';
+       appleLog('Game launch initiated');
+
+       if (launch.milestones.frame !== undefined) {{
+         gameReady();
+         return;
+       }}
+       if (launchConfig.timeout_ms) {{
+         launch.timer = setTimeout(launchTimedOut, launchConfig.timeout_ms);
+       }}
+     }}
+
+     // iframe.onerror does not fire when a navigation fails, so this is
+     // what notices a frame that never loads.
+     function launchTimedOut() {{
+       if (!Object.keys(launch.milestones).length) {{
+         // Not a word from the shim: the frame never loaded.
+         appleLog(`Game frame sent nothing ${{launchConfig.timeout_ms}} ms after launch`, 'error');
+         gameFailed();
+         return;
+       }}
+       if (!launch.slow) {{
+         // The game is booting, only slowly; give it one more period
+         // before giving up on it.
+         launch.slow = true;
+         document.getElementById('status').textContent = 'Still starting...';
+         appleLog(`No frame drawn ${{launchConfig.timeout_ms}} ms after launch`, 'warn');
+         launch.timer = setTimeout(launchTimedOut, launchConfig.timeout_ms);
+         return;
+       }}
+       appleLog(`No frame drawn ${{2 * launchConfig.timeout_ms}} ms after launch`, 'error');
+       gameFailed();
+     }}
+
+     function setupGraphicsProfiles() {{
+       const graphics = LAUNCHER_CONFIG.graphics;
+       const select = document.getElementById('graphicsProfile');
+       if (!graphics || !select) {{
+         return;
+       }}
+
+       const choices = [['auto', 'Automatic']].concat(Object.keys(graphics.profiles).map(function(name) {{
+         return [name, graphics.profiles[name].label || name];
+       }}));
+       choices.forEach(function(choice) {{
+         const option = document.createElement('option');
+         option.value = choice[0];
+         option.textContent = choice[1];
+         select.appendChild(option);
+       }});
+
+       let current = graphics.default;
+       try {{
+         current = localStorage.getItem(graphics.storage_key) || current;
+       }} catch (e) {{
+         // No storage; the build default applies.
        }}
+       select.value = current;
+
+       select.addEventListener('change', function() {{
+         try {{
+           localStorage.setItem(graphics.storage_key, select.value);
+         }} catch (e) {{
+           appleLog(`Could not save graphics profile: ${{e.message}}`, 'warn');
+         }}
+         appleLog(`Graphics profile: ${{select.value}}`);
+
+         // The shim applies the profile when the game boots, so restart a
+         // game that is already running.
+         const iframe = document.getElementById('gameFrame');
+         if (iframe.getAttribute('src') && iframe.contentWindow) {{
+           launch.milestones = {{}};
+           launch.started = performance.now();
+           traceMark('iframe-navigation', 'launcher');
+           iframe.contentWindow.location.reload();
+         }}
+       }});
      }}
 
      document.addEventListener('DOMContentLoaded', function() {{
+       traceMark('index-parsed', 'launcher');
+       setupGraphicsProfiles();
+
        const header = document.querySelector('.header');
        const minimizeBtn = document.createElement('button');
        minimizeBtn.className = 'minimize-btn';
@@ -562,12 +1903,21 @@ body {{
        
        // Initialize debug log
        appleLog('Apple Books debug system initialized');
+
+       if (launchConfig.preload) {{
+         // Let the header paint first.
+         if (window.requestIdleCallback) {{
+           window.requestIdleCallback(startGameFrame, {{ timeout: 500 }});
+         }} else {{
+           setTimeout(startGameFrame, 0);
+         }}
+       }}
      }});
      ]]>
    </script>
  </head>
  <body>
-    
+   <!-- @debug-start -->
    <div id="apple-books-logger" style="
     position: fixed; 
     top: 0; 
@@ -588,19 +1938,28 @@ body {{
         Apple Books Debug Log
         <button onclick="toggleDebugLog()" 
                 style="float: right; background: #f44; color: white; border: none; padding: 2px 6px;">×</button>
+        <button onclick="copyStartupTrace()"
+                style="float: right; margin-right: 4px; background: #333; color: #0f0; border: 1px solid #666; padding: 2px 6px;">Copy Trace</button>
     </div>
+    <textarea id="trace-output" readonly="readonly"
+              style="display: none; width: 100%; height: 60px; box-sizing: border-box; font-size: 9px; margin-bottom: 5px;"></textarea>
     <div id="log-content"></div>
 </div>
 <button id="debug-toggle-btn" onclick="toggleDebugLog()" 
         style="position: fixed; top: 10px; right: 10px; z-index: 1000000; background: #333; color: #0f0; border: 1px solid #666; padding: 5px;">
     Debug Log
 </button>
+<!-- @debug-end -->
 
 
    <div class="header">
      <h1>Eaglecraft - Apple Books</h1>
      <p>With comprehensive browser API support and visible debugging</p>
      <button id="launchBtn" class="launch-btn">Launch Game</button>
+     <div class="graphics">
+       <label for="graphicsProfile">Graphics</label>
+       <select id="graphicsProfile"></select>
+     </div>
      <div id="loading" class="loading">
        <div class="spinner"></div>
        <p>Loading game...</p>
@@ -618,21 +1977,26 @@ body {{
  </body>
 </html>"""
 
-    with open(os.path.join(oebps_path, "index.xhtml"), "w", encoding="utf-8") as f:
-        f.write(index_xhtml)
 
-    current_date = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-    book_id = f"urn:uuid:{uuid.uuid4()}"
+def render_manifest_items(resources):
+    return "".join(
+        f'\n    <item id="{html.escape(item["id"])}" href="{html.escape(item["href"])}" '
+        f'media-type="{html.escape(item["media_type"])}"/>'
+        for item in resources
+    )
 
-    content_opf = f"""<?xml version="1.0" encoding="UTF-8"?>
+
+def render_content_opf(book_id, current_date, html_filename, resources=(), title=DEFAULT_TITLE,
+                       creator=DEFAULT_CREATOR):
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
 <package xmlns="http://www.idpf.org/2007/opf" 
          version="3.0" 
          unique-identifier="bookid">
 
   <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
     <dc:identifier id="bookid">{html.escape(book_id)}</dc:identifier>
-    <dc:title>Eaglecraft - Apple Books</dc:title>
-    <dc:creator>WereWolf</dc:creator>
+    <dc:title>{html.escape(title)}</dc:title>
+    <dc:creator>{html.escape(creator)}</dc:creator>
     <dc:language>en</dc:language>
     <dc:subject>Games</dc:subject>
     <dc:description>Eaglecraft in apple books</dc:description>
@@ -644,7 +2008,7 @@ body {{
     <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
     <item id="index" href="index.xhtml" media-type="application/xhtml+xml" properties="scripted"/>
     <item id="game" href="{html.escape(html_filename)}" media-type="text/html"/>
-    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>{render_manifest_items(resources)}
   </manifest>
 
   <spine toc="ncx">
@@ -653,10 +2017,7 @@ body {{
 
 </package>"""
 
-    with open(os.path.join(oebps_path, "content.opf"), "w", encoding="utf-8") as f:
-        f.write(content_opf)
-
-    nav_xhtml = """<?xml version="1.0" encoding="utf-8"?>
+NAV_XHTML = """<?xml version="1.0" encoding="utf-8"?>
 <!DOCTYPE html>
 <html xmlns="http://www.w3.org/1999/xhtml" 
       xmlns:epub="http://www.idpf.org/2007/ops">
@@ -673,10 +2034,9 @@ body {{
   </body>
 </html>"""
 
-    with open(os.path.join(oebps_path, "nav.xhtml"), "w", encoding="utf-8") as f:
-        f.write(nav_xhtml)
 
-    toc_ncx = f"""<?xml version="1.0" encoding="UTF-8"?>
+def render_toc_ncx(book_id, title=DEFAULT_TITLE):
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
 <ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
   <head>
     <meta name="dtb:uid" content="{html.escape(book_id)}"/>
@@ -685,7 +2045,7 @@ body {{
     <meta name="dtb:maxPageNumber" content="0"/>
   </head>
   <docTitle>
-    <text>Eaglecraft - Apple Books</text>
+    <text>{html.escape(title)}</text>
   </docTitle>
   <navMap>
     <navPoint id="navpoint-1" playOrder="1">
@@ -697,39 +2057,2690 @@ body {{
   </navMap>
 </ncx>"""
 
-    with open(os.path.join(oebps_path, "toc.ncx"), "w", encoding="utf-8") as f:
-        f.write(toc_ncx)
 
-    epub_path = os.path.expanduser("~/Documents/eaglecraft_book.epub")
+def strip_debug_regions(source):
+    return DEBUG_REGION_RE.sub("", source)
+
+
+def scan_js_string(source, start):
+    quote = source[start]
+    index = start + 1
+    depth = 0
+    while index < len(source):
+        char = source[index]
+        if char == "\\":
+            index += 2
+            continue
+        if quote == "`":
+            # ${...} inside a template literal may hold braces of its own.
+            if source.startswith("${", index):
+                depth += 1
+                index += 2
+                continue
+            if depth and char == "}":
+                depth -= 1
+            elif not depth and char == "`":
+                return index + 1
+        elif char == quote:
+            return index + 1
+        index += 1
+    raise ValueError(f"Unterminated string literal at offset {start}")
+
+
+def scan_js_regex(source, start):
+    index = start + 1
+    in_class = False
+    while index < len(source):
+        char = source[index]
+        if char == "\\":
+            index += 2
+            continue
+        if char == "[":
+            in_class = True
+        elif char == "]":
+            in_class = False
+        elif char == "/" and not in_class:
+            index += 1
+            while index < len(source) and source[index].isalpha():
+                index += 1
+            return index
+        index += 1
+    raise ValueError(f"Unterminated regular expression at offset {start}")
+
+
+def tokenize_js(source):
+    # Just enough of a lexer for the builder's own scripts: strings,
+    # template literals, regex literals, comments, words and punctuation.
+    # Yields (token, whitespace_before) where whitespace_before is "\n",
+    # " " or "".
+    index = 0
+    gap = ""
+    previous = ""
+    while index < len(source):
+        char = source[index]
+        if char in " \t\r\n":
+            if char == "\n":
+                gap = "\n"
+            elif not gap:
+                gap = " "
+            index += 1
+            continue
+        if source.startswith("//", index):
+            end = source.find("\n", index)
+            index = len(source) if end == -1 else end
+            continue
+        if source.startswith("/*", index):
+            end = source.find("*/", index + 2)
+            if end == -1:
+                raise ValueError(f"Unterminated comment at offset {index}")
+            gap = gap or " "
+            index = end + 2
+            continue
+
+        if char in "'\"`":
+            end = scan_js_string(source, index)
+        elif char == "/" and (not previous or previous in JS_REGEX_AFTER or
+                              (previous[-1] not in ")]}" and not JS_WORD_RE.match(previous))):
+            end = scan_js_regex(source, index)
+        elif JS_WORD_RE.match(char):
+            end = JS_WORD_RE.match(source, index).end()
+        else:
+            end = index + 1
+
+        previous = source[index:end]
+        yield previous, gap
+        gap = ""
+        index = end
+
+
+def drop_js_calls(tokens, names):
+    # Removes `name(...)` statements, e.g. appleLog calls, together with
+    # their trailing semicolon.
+    result = []
+    index = 0
+    while index < len(tokens):
+        token, gap = tokens[index]
+        if token in names and index + 1 < len(tokens) and tokens[index + 1][0] == "(":
+            depth = 0
+            index += 1
+            while index < len(tokens):
+                depth += {"(": 1, ")": -1}.get(tokens[index][0], 0)
+                index += 1
+                if depth == 0:
+                    break
+            if index < len(tokens) and tokens[index][0] == ";":
+                index += 1
+            continue
+        result.append((token, gap))
+        index += 1
+    return result
+
+
+def minify_js(source, drop_calls=()):
+    tokens = list(tokenize_js(source))
+    if drop_calls:
+        tokens = drop_js_calls(tokens, drop_calls)
+        leftover = sorted({token for token, _ in tokens if token in drop_calls})
+        if leftover:
+            raise ValueError(f"Release build still references {', '.join(leftover)}")
+
+    out = []
+    last = ""
+    for token, gap in tokens:
+        if last:
+            # Line breaks are kept unless the neighbours make a statement
+            # boundary impossible, so automatic semicolon insertion behaves
+            # exactly as in the source.
+            if gap == "\n" and last[-1] not in "{([,;:=?" and token[0] not in "})],;.:?":
+                out.append("\n")
+            elif gap and (JS_WORD_RE.match(last[-1]) and JS_WORD_RE.match(token[0]) or
+                          last[-1] in "+-" and token[0] == last[-1]):
+                out.append(" ")
+        out.append(token)
+        last = token
+    return "".join(out)
+
+
+def minify_css(source):
+    source = CSS_COMMENT_RE.sub("", source)
+    source = re.sub(r"\s+", " ", source)
+    source = re.sub(r" ?([{};,>]) ?", r"\1", source)
+    return source.replace(": ", ":").replace(";}", "}").strip()
+
+
+def minify_xhtml(document, drop_calls=()):
+    # Collapses whitespace between markup and minifies the contents of
+    # <script> and <style> elements, keeping their CDATA wrappers. Bodies
+    # are set aside first so the markup pass cannot touch them.
+    bodies = []
+
+    def set_aside(match):
+        open_tag, tag, body, close_tag = match.groups()
+        cdata = CDATA_RE.fullmatch(body.strip())
+        code = cdata.group(1) if cdata else body
+        code = minify_css(code) if tag.lower() == "style" else minify_js(code, drop_calls)
+        bodies.append(f"<![CDATA[{code}]]>" if cdata else code)
+        return f"{open_tag}\0{len(bodies) - 1}\0{close_tag}"
+
+    markup = EMBEDDED_CODE_RE.sub(set_aside, document)
+    markup = re.sub(r"\s+", " ", re.sub(r">\s+<", "><", markup))
+    return re.sub(r"\0(\d+)\0", lambda match: bodies[int(match.group(1))], markup)
+
+
+def release_template(document):
+    # --release: drop debug-only regions and appleLog calls, then minify.
+    return minify_xhtml(strip_debug_regions(document), drop_calls=("appleLog",)).strip()
+
+
+def open_epub(output):
+    if isinstance(output, (str, bytes, os.PathLike)):
+        epub_path = os.path.expanduser(output)
+        parent = os.path.dirname(epub_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        return zipfile.ZipFile(epub_path, "w", zipfile.ZIP_DEFLATED, compresslevel=DEFAULT_COMPRESS_LEVEL), epub_path
+
+    # Any writable binary stream works; zipfile falls back to data
+    # descriptors when the stream cannot seek (pipes, sockets).
+    return zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED, compresslevel=DEFAULT_COMPRESS_LEVEL), None
+
+
+def find_head_tag_end(html_file, chunk_size=INJECT_CHUNK_SIZE):
+    # Scan in chunks, carrying the tail of each window forward so a tag
+    # split across a chunk boundary (or one with long attributes) still
+    # matches. Returns the offset just past the first <head ...> tag (None
+    # without one) and the chunks read to find it, so callers can reuse them
+    # instead of reading them again. Those are dropped (None) once they pass
+    # MAX_HEAD_SNIFF_BYTES; the caller then seeks back.
+    window_offset = 0
+    window = b""
+    sniffed = []
+    sniffed_size = 0
+
+    while True:
+        chunk = html_file.read(chunk_size)
+        if not chunk:
+            return None, sniffed
+
+        if sniffed is not None:
+            sniffed.append(chunk)
+            sniffed_size += len(chunk)
+            if sniffed_size > MAX_HEAD_SNIFF_BYTES:
+                sniffed = None
+
+        window += chunk
+        match = HEAD_TAG_RE.search(window)
+        if match:
+            return window_offset + match.end(), sniffed
+
+        keep = min(len(window), MAX_HEAD_TAG_LENGTH)
+        window_offset += len(window) - keep
+        window = window[-keep:]
+
+
+def inject_head_stream(html_file, fixes, chunk_size=INJECT_CHUNK_SIZE):
+    head_end, sniffed = find_head_tag_end(html_file, chunk_size)
+    head_end = head_end or 0
+    if sniffed is None:
+        # The tag was too far in to keep everything before it.
+        html_file.seek(0)
+        sniffed = []
+
+    injected = False
+    offset = 0
+    for chunk in sniffed:
+        cut = head_end - offset
+        offset += len(chunk)
+        if not injected and cut <= len(chunk):
+            if cut:
+                yield chunk[:cut]
+            yield fixes
+            injected = True
+            chunk = chunk[cut:]
+        if chunk:
+            yield chunk
+
+    if not injected:
+        yield from iter_file_chunks(html_file, head_end, chunk_size)
+        yield fixes
+    yield from iter_file_chunks(html_file, None, chunk_size)
+
+
+def iter_view_slices(view, start, end, chunk_size, mapped=None):
+    for offset in range(start, end, chunk_size):
+        chunk_end = min(offset + chunk_size, end)
+        # Release each slice once written so the mapping can be closed even
+        # if the caller still holds a reference to the last chunk.
+        with view[offset:chunk_end] as chunk:
+            yield chunk
+
+        if mapped is not None and hasattr(mmap, "MADV_DONTNEED"):
+            # Pages behind the cursor are clean and file-backed; dropping
+            # them keeps RSS flat instead of growing to the file size.
+            page_start = offset - offset % mmap.PAGESIZE
+            mapped.madvise(mmap.MADV_DONTNEED, page_start, chunk_end - page_start)
+
+
+def inject_head_mmap(html_file, fixes, chunk_size=INJECT_CHUNK_SIZE):
+    # Zero-copy variant: the tag search runs on the mapping itself and the
+    # prefix/suffix go to the archive as memoryview slices, never decoded.
+    if os.fstat(html_file.fileno()).st_size == 0:
+        yield fixes
+        return
+
+    with mmap.mmap(html_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        match = HEAD_TAG_RE.search(mapped)
+        head_end = match.end() if match else 0
+
+        with memoryview(mapped) as view:
+            yield from iter_view_slices(view, 0, head_end, chunk_size, mapped)
+            yield fixes
+            yield from iter_view_slices(view, head_end, len(view), chunk_size, mapped)
+
+
+def inject_head_text(html_file, fixes):
+    # The original decode-everything path. Slower and memory hungry, but
+    # it rejects input that is not valid UTF-8, and it is the baseline the
+    # byte-level modes are measured against.
+    raw_html = html_file.read().decode("utf-8")
+    match = TEXT_HEAD_TAG_RE.search(raw_html)
+    head_end = match.end() if match else 0
+    yield raw_html[:head_end].encode("utf-8")
+    yield fixes
+    yield raw_html[head_end:].encode("utf-8")
+
+
+def iter_game_html(html_file, fixes, input_mode):
+    if input_mode == "mmap":
+        return inject_head_mmap(html_file, fixes)
+    if input_mode == "text":
+        return inject_head_text(html_file, fixes)
+    return inject_head_stream(html_file, fixes)
+
+
+def asset_extension(media_type):
+    if media_type in ASSET_EXTENSIONS:
+        return ASSET_EXTENSIONS[media_type]
+    return mimetypes.guess_extension(media_type) or ".bin"
+
+
+def finish_asset(assets, media_type, spool, digest, kind="asset", directory=ASSET_DIR):
+    asset_id = f"{kind}-{digest.hexdigest()[:16]}"
+
+    for asset in assets:
+        if asset["id"] == asset_id:
+            # Same payload embedded twice: point both references at one file.
+            spool.close()
+            return asset["href"].encode("ascii")
+
+    href = f"{directory}/{asset_id[len(kind) + 1:]}{asset_extension(media_type)}"
+    spool.seek(0, os.SEEK_END)
+    assets.append({
+        "id": asset_id,
+        "href": href,
+        "media_type": media_type,
+        "file": spool,
+        "size": spool.tell(),
+    })
+    return href.encode("ascii")
+
+
+def reencode_spool(spool, size=None, chunk_size=INJECT_CHUNK_SIZE):
+    # Only reached for a malformed blob that was already too large to keep
+    # verbatim: re-encoding the decoded groups reproduces the original text.
+    spool.seek(0)
+    yield from (b64encode(chunk) for chunk in iter_file_chunks(spool, size, chunk_size - chunk_size % 3))
+    spool.close()
+
+
+def extract_base64_assets(chunks, assets, min_bytes):
+    # Rewrites data:...;base64, URIs of at least min_bytes encoded length into
+    # relative references to binary files collected in `assets`. Blobs are
+    # decoded group by group into spooled temp files, so a 50 MB payload never
+    # sits in memory as one string.
+    min_bytes = max(min_bytes, 4)
+    buffer = b""
+    blob = None
+
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        if not final:
+            buffer += chunk
+
+        while buffer or (final and blob is not None):
+            if blob is None:
+                match = DATA_URI_RE.search(buffer)
+                if not match:
+                    # Hold back a tail that could be the start of a split prefix.
+                    if final:
+                        yield buffer
+                        buffer = b""
+                    elif len(buffer) > MAX_DATA_URI_PREFIX:
+                        yield buffer[:-MAX_DATA_URI_PREFIX]
+                        buffer = buffer[-MAX_DATA_URI_PREFIX:]
+                    break
+
+                if match.start():
+                    yield buffer[:match.start()]
+
+                blob = {
+                    "prefix": match.group(0),
+                    "media_type": (match.group(1) or b"application/octet-stream").decode("ascii").lower(),
+                    "raw": [],
+                    "encoded_size": 0,
+                    "decoded_size": 0,
+                    "carry": b"",
+                    "wrapped": None,
+                    "spool": tempfile.SpooledTemporaryFile(max_size=ASSET_SPOOL_SIZE),
+                    "digest": hashlib.sha256(),
+                }
+                buffer = buffer[match.end():]
+                continue
+
+            run = BASE64_RUN_RE.match(buffer)
+            ended = final or run.end() < len(buffer)
+
+            # Trailing whitespace is left in the output; only whitespace
+            # between base64 characters belongs to the blob.
+            if ended:
+                encoded = buffer[:run.end()].rstrip(BASE64_WHITESPACE)
+                closing = buffer[run.end():run.end() + 1]
+            else:
+                # The run may continue in the next chunk: hold back padding
+                # and whitespace until we see what follows them.
+                encoded = buffer[:run.start(1)].rstrip(BASE64_WHITESPACE)
+            stripped = encoded.translate(None, BASE64_WHITESPACE)
+
+            if blob["wrapped"] is None and len(stripped) < len(encoded):
+                # Whitespace rules out re-encoding the decoded bytes, so keep
+                # the text from here on in case the blob must stay inline.
+                blob["wrapped"] = {
+                    "decoded_size": blob["decoded_size"],
+                    "spool": tempfile.SpooledTemporaryFile(max_size=ASSET_SPOOL_SIZE),
+                }
+                blob["wrapped"]["spool"].write(blob["carry"])
+            if blob["wrapped"] is not None:
+                blob["wrapped"]["spool"].write(encoded)
+
+            buffer = buffer[len(encoded):]
+            blob["encoded_size"] += len(encoded)
+            if blob["raw"] is not None:
+                blob["raw"].append(encoded)
+                if blob["encoded_size"] >= min_bytes:
+                    blob["raw"] = None
+
+            pending = blob["carry"] + stripped if blob["carry"] else stripped
+            if ended:
+                alpha = pending.rstrip(b"=")
+                if len(alpha) % 4 == 1:
+                    data = alpha[:-1]
+                else:
+                    data = alpha + b"=" * (-len(alpha) % 4)
+                blob["carry"] = b""
+            else:
+                # Only decode whole unpadded groups; the rest waits for the
+                # next chunk.
+                whole = len(pending) - len(pending) % 4
+                data, blob["carry"] = pending[:whole], pending[whole:]
+
+            if data:
+                decoded = binascii.a2b_base64(data)
+                blob["spool"].write(decoded)
+                blob["digest"].update(decoded)
+                blob["decoded_size"] += len(decoded)
+
+            if not ended:
+                break
+
+            wrapped = blob["wrapped"]
+            malformed = len(data) < len(alpha)
+            if wrapped is not None and not malformed:
+                # A wrapped run only ends the URI at a closing quote or
+                # parenthesis; anything else may be text the run swallowed.
+                malformed = closing not in (b'"', b"'", b")")
+
+            if blob["raw"] is not None:
+                # Below the threshold: leave the data URI exactly as it was.
+                yield blob["prefix"] + b"".join(blob["raw"])
+                blob["spool"].close()
+            elif malformed and wrapped is not None:
+                yield blob["prefix"]
+                yield from reencode_spool(blob["spool"], wrapped["decoded_size"])
+                wrapped["spool"].seek(0)
+                yield from iter_file_chunks(wrapped["spool"])
+            elif malformed:
+                # Malformed length; the browser would reject it too, so keep it.
+                yield blob["prefix"]
+                yield from reencode_spool(blob["spool"])
+                yield pending[len(data):]
+            else:
+                yield finish_asset(assets, blob["media_type"], blob["spool"], blob["digest"])
+            if wrapped is not None:
+                wrapped["spool"].close()
+            blob = None
+
+
+def script_attributes(attrs):
+    # (name, raw value) pairs of a start tag; values keep their quotes.
+    return [(name, value) for name, value in SCRIPT_ATTR_RE.findall(attrs)]
+
+
+def render_script_attributes(attributes, drop=()):
+    return b"".join(b" " + name + (b"=" + value if value else b"")
+                    for name, value in attributes if name.lower() not in drop)
+
+
+def script_attribute(attributes, name):
+    for key, value in attributes:
+        if key.lower() == name:
+            return value.strip(b"'\"")
+    return None
+
+
+def is_classic_script(attributes):
+    script_type = script_attribute(attributes, b"type")
+    return script_type is None or script_type.strip().lower() in CLASSIC_SCRIPT_TYPES
+
+
+def blocks_parser(attributes):
+    # A classic script without async or defer runs as soon as it is parsed;
+    # nothing before it can be deferred past it.
+    return is_classic_script(attributes) and not any(
+        name.lower() in (b"async", b"defer") for name, _ in attributes)
+
+
+def split_inline_scripts(chunks, assets, min_bytes, lazy_ids=()):
+    # Moves classic inline <script> bodies of at least min_bytes into
+    # scripts/*.js files collected in `assets`. Each is replaced by a
+    # <script src> at the same place, so scripts still run in document
+    # order. A split script is also deferred when no parser-blocking script
+    # follows it and it does not call document.write; until the rest of the
+    # page shows that, output is held in a spool and the spots where
+    # " defer" may go are remembered. Scripts whose id matches a `lazy_ids`
+    # glob become placeholders that the shim loads after the first frame.
+    buffer = b""
+    mode = "markup"
+    script = None
+    pending = None
+    defer_offsets = []
+
+    def emit(data):
+        if pending is None:
+            if data:
+                yield data
+        else:
+            pending.write(data)
+
+    def flush_pending(defer):
+        nonlocal pending
+        if pending is None:
+            return
+        spool, pending = pending, None
+        end = spool.tell()
+        spool.seek(0)
+        position = 0
+        for offset in defer_offsets + [end]:
+            yield from iter_file_chunks(spool, offset - position)
+            position = offset
+            if defer and offset != end:
+                yield b" defer"
+        defer_offsets.clear()
+        spool.close()
+
+    def start_pending():
+        nonlocal pending
+        if pending is None:
+            pending = tempfile.SpooledTemporaryFile(max_size=ASSET_SPOOL_SIZE)
+
+    def body_chunks():
+        if script["raw"] is not None:
+            yield b"".join(script["raw"])
+        else:
+            script["spool"].seek(0)
+            yield from iter_file_chunks(script["spool"])
+            script["spool"].close()
+
+    def add_body(data):
+        script["size"] += len(data)
+        script["digest"].update(data)
+        if DOCUMENT_WRITE_RE.search(script["tail"] + data):
+            script["writes"] = True
+        script["tail"] = (script["tail"] + data)[-len(b"document.write"):]
+        if script["raw"] is not None:
+            script["raw"].append(data)
+            if script["size"] >= min_bytes:
+                script["spool"] = tempfile.SpooledTemporaryFile(max_size=ASSET_SPOOL_SIZE)
+                script["spool"].write(b"".join(script["raw"]))
+                script["raw"] = None
+        else:
+            script["spool"].write(data)
+
+    def finish_script():
+        attributes = script["attributes"]
+        if script["raw"] is not None:
+            # Too small to move: a parser-blocking script pins everything
+            # held so far in place, then goes out as it was.
+            yield from flush_pending(False)
+            yield from emit(b"<script" + script["attrs"] + b">")
+            yield from emit(b"".join(script["raw"]))
+            return
+
+        href = finish_asset(assets, "text/javascript", script["spool"], script["digest"], "script", SCRIPT_DIR)
+        script_id = script_attribute(attributes, b"id")
+        kept = render_script_attributes(attributes, (b"async", b"defer"))
+        if script_id and any(fnmatch.fnmatchcase(script_id.decode("utf-8", "replace"), rule) for rule in lazy_ids):
+            kept = render_script_attributes(attributes, (b"async", b"defer", b"type"))
+            yield from emit(b'<script' + kept + b' type="' + LAZY_SCRIPT_TYPE + b'" data-src="' + href + b'">')
+        elif script["writes"]:
+            yield from flush_pending(False)
+            yield from emit(b'<script' + kept + b' src="' + href + b'">')
+        else:
+            start_pending()
+            pending.write(b'<script' + kept + b' src="' + href + b'"')
+            defer_offsets.append(pending.tell())
+            pending.write(b">")
+
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        if not final:
+            buffer += chunk
+
+        while buffer:
+            if mode == "comment":
+                end = buffer.find(b"-->")
+                if end == -1:
+                    keep = 0 if final else 2
+                    yield from emit(buffer[:len(buffer) - keep])
+                    buffer = buffer[len(buffer) - keep:]
+                    break
+                yield from emit(buffer[:end + 3])
+                buffer = buffer[end + 3:]
+                mode = "markup"
+                continue
+
+            if mode == "script":
+                match = SCRIPT_END_RE.search(buffer)
+                if match is None and not final:
+                    # "</script" may straddle the chunk boundary.
+                    body, buffer = buffer[:-len(b"</script")], buffer[-len(b"</script"):]
+                else:
+                    end = match.start() if match else len(buffer)
+                    body, buffer = buffer[:end], buffer[end:]
+                if script["keep"]:
+                    yield from emit(body)
+                else:
+                    add_body(body)
+                if match is None:
+                    break
+                if not script["keep"]:
+                    yield from finish_script()
+                # The end tag's closing ">" follows in the markup.
+                yield from emit(buffer[:len(b"</script")])
+                buffer = buffer[len(b"</script"):]
+                script = None
+                mode = "markup"
+                continue
+
+            match = SCRIPT_SCAN_RE.search(buffer)
+            if match is None:
+                # Hold back a tail that could be the start of a split tag.
+                keep = 0 if final else min(len(buffer), MAX_HEAD_TAG_LENGTH)
+                yield from emit(buffer[:len(buffer) - keep])
+                buffer = buffer[len(buffer) - keep:]
+                break
+
+            yield from emit(buffer[:match.start()])
+            buffer = buffer[match.end():]
+            if match.group(0) == b"<!--":
+                yield from emit(match.group(0))
+                mode = "comment"
+                continue
+
+            attrs = match.group(1)
+            attributes = script_attributes(attrs)
+            inline = script_attribute(attributes, b"src") is None
+            if not inline or not is_classic_script(attributes):
+                if not inline and blocks_parser(attributes):
+                    yield from flush_pending(False)
+                yield from emit(match.group(0))
+                script = {"keep": True}
+            else:
+                script = {
+                    "keep": False,
+                    "attrs": attrs,
+                    "attributes": attributes,
+                    "raw": [],
+                    "spool": None,
+                    "size": 0,
+                    "digest": hashlib.sha256(),
+                    "tail": b"",
+                    "writes": False,
+                }
+            mode = "script"
+
+        if final:
+            if mode == "script" and not script["keep"]:
+                # Unterminated: the browser runs the rest of the file as
+                # this script, so leave it exactly as it was.
+                yield from flush_pending(False)
+                yield from emit(b"<script" + script["attrs"] + b">")
+                yield from body_chunks()
+            yield from flush_pending(True)
+
+
+def parse_bundle_spec(spec):
+    # "URL=PATH" serves PATH for requests to URL; a bare "PATH" is matched
+    # by file name, which is how the game usually asks for its bundles.
+    if isinstance(spec, (tuple, list)):
+        return tuple(spec)
+    if "=" in spec:
+        # Split on the last "=": URLs often carry a query, paths rarely do.
+        url, _, path = spec.rpartition("=")
+        return url, path
+    return os.path.basename(spec), spec
+
+
+def plan_bundles(specs, part_bytes):
+    bundles = []
+    hrefs = set()
+
+    for index, spec in enumerate(specs, 1):
+        url, path = parse_bundle_spec(spec)
+        size = os.path.getsize(path)
+
+        href = f"{BUNDLE_DIR}/{os.path.basename(path)}"
+        if href in hrefs:
+            href = f"{BUNDLE_DIR}/{index}-{os.path.basename(path)}"
+        hrefs.add(href)
+
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        parts = []
+        if part_bytes and size > part_bytes:
+            for number, offset in enumerate(range(0, size, part_bytes)):
+                parts.append({
+                    "id": f"bundle-{index}-part-{number}",
+                    "href": f"{href}.{number:03d}",
+                    "media_type": "application/octet-stream",
+                    "offset": offset,
+                    "length": min(part_bytes, size - offset),
+                })
+        else:
+            parts.append({
+                "id": f"bundle-{index}",
+                "href": href,
+                "media_type": media_type,
+                "offset": 0,
+                "length": size,
+            })
+
+        bundles.append({"url": url, "path": path, "href": href, "size": size, "media_type": media_type,
+                        "parts": parts})
+
+    return bundles
+
+
+def bundle_resource_index(bundles):
+    return {
+        bundle["url"]: {
+            "href": bundle["href"],
+            "size": bundle["size"],
+            "type": bundle["media_type"],
+            "parts": [part["href"] for part in bundle["parts"]] if len(bundle["parts"]) > 1 else None,
+        }
+        for bundle in bundles
+    }
+
+
+def parse_route_rule(rule):
+    pattern, _, action = rule.rpartition("=")
+    if not pattern or action not in ROUTE_ACTIONS:
+        raise ValueError(f"Bad route rule {rule!r}; expected URL_GLOB={'|'.join(ROUTE_ACTIONS)}")
+    return pattern, action
+
+
+def compile_routes(rules, timeout_ms):
+    # One regex with a capture group per rule, in rule order: the shim
+    # classifies a URL with a single exec() and takes the first group that
+    # matched. Globs only know * and ?, everything else is literal.
+    groups = []
+    actions = []
+    for rule in rules:
+        pattern, action = parse_route_rule(rule)
+        groups.append("(" + "".join(".*" if char == "*" else "." if char == "?" else re.escape(char)
+                                    for char in pattern) + ")")
+        actions.append(action)
+    return {"pattern": f"^(?:{'|'.join(groups)})$", "actions": actions, "timeout_ms": timeout_ms}
+
+
+def iter_file_chunks(source, length=None, chunk_size=INJECT_CHUNK_SIZE):
+    remaining = length
+    while remaining is None or remaining > 0:
+        chunk = source.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+def iter_bundle_members(bundle):
+    with open(bundle["path"], "rb") as source:
+        for part in bundle["parts"]:
+            source.seek(part["offset"])
+            yield f"OEBPS/{part['href']}", iter_file_chunks(source, part["length"])
+
+
+def transform_game_chunks(chunks, options, assets, profile=None):
+    if options["extract_assets"]:
+        chunks = extract_base64_assets(chunks, assets, options["extract_assets_min_bytes"])
+        if profile is not None:
+            chunks = profile.chunks("extract assets", chunks)
+    if options["split_scripts"]:
+        chunks = split_inline_scripts(chunks, assets, options["split_scripts_min_bytes"], options["lazy_scripts"])
+        if profile is not None:
+            chunks = profile.chunks("split scripts", chunks)
+    return chunks
+
+
+def transform_game_html(chunks, fixes, options, assets, profile=None):
+    # The shim is ours, not the game's: only the markup on either side of it
+    # is rewritten, so it is never split out or deferred. Every input mode
+    # yields `fixes` itself as one chunk.
+    chunks = iter(chunks)
+    yield from transform_game_chunks(itertools.takewhile(lambda chunk: chunk is not fixes, chunks), options,
+                                     assets, profile)
+    yield fixes
+    yield from transform_game_chunks(chunks, options, assets, profile)
+
+
+def iter_game_members(html_file, fixes, options, assets, profile=None):
+    # `assets` fills up while the game member is consumed, so the asset
+    # members are only yielded once the HTML has been written.
+    chunks = iter_game_html(html_file, fixes, options["input_mode"])
+    if profile is not None:
+        profile.count("inject", bytes_in=os.fstat(html_file.fileno()).st_size + len(fixes))
+        chunks = profile.chunks("inject", chunks)
+    yield f"OEBPS/{GAME_HTML_FILENAME}", transform_game_html(chunks, fixes, options, assets, profile)
+
+    for asset in assets:
+        asset["file"].seek(0)
+        yield f"OEBPS/{asset['href']}", iter_file_chunks(asset["file"])
+
+
+class RawMemberWriter(io.BufferedIOBase):
+    # Counterpart of ZipFile.open(name, "w") for payloads that are already
+    # compressed: bytes go to the archive untouched and the CRC and sizes
+    # come from the caller, either up front or through finish().
+    #
+    # zipfile has no public API for this, so it leans on the same private
+    # ZipFile state that ZipFile.open(name, "w") keeps: _writing (one write
+    # handle at a time), _seekable (pipes get data descriptors), start_dir
+    # (where the next header and finally the central directory go),
+    # _writecheck() (duplicate names, ZIP64 limits) and _didModify (so
+    # close() writes the central directory), plus the public fp, filelist
+    # and NameToInfo. They date from ZipFile.open(name, "w") in Python 3.6;
+    # EagleZipTest.py checks them against the running interpreter.
+
+    def __init__(self, epub, zinfo, crc=None, file_size=None, compress_size=None):
+        if epub._writing:
+            raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+
+        self._epub = epub
+        self._zinfo = zinfo
+        self._known = crc is not None
+        self._compress_size = 0
+
+        zinfo.CRC = crc or 0
+        zinfo.file_size = file_size or 0
+        zinfo.compress_size = compress_size or 0
+        # Without a seekable output the header cannot be patched afterwards,
+        # so unknown sizes go into a data descriptor like zipfile does.
+        zinfo.flag_bits = 0 if self._known or epub._seekable else 0x08
+        if not zinfo.external_attr:
+            zinfo.external_attr = 0o600 << 16
+
+        if epub._seekable:
+            epub.fp.seek(epub.start_dir)
+        zinfo.header_offset = epub.fp.tell()
+
+        epub._writecheck(zinfo)
+        epub._didModify = True
+        epub.fp.write(zinfo.FileHeader(False))
+        epub._writing = True
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        self._epub.fp.write(data)
+        self._compress_size += len(data)
+        return len(data)
+
+    def finish(self, crc, file_size):
+        self._zinfo.CRC = crc
+        self._zinfo.file_size = file_size
+
+    def close(self):
+        if self.closed:
+            return
+
+        epub = self._epub
+        zinfo = self._zinfo
+        try:
+            super().close()
+            if self._known and self._compress_size != zinfo.compress_size:
+                raise RuntimeError(f"{zinfo.filename}: expected {zinfo.compress_size} compressed bytes, "
+                                   f"got {self._compress_size}")
+            zinfo.compress_size = self._compress_size
+            if zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT:
+                raise RuntimeError(f"{zinfo.filename} is too large for a non-ZIP64 member")
+
+            if zinfo.flag_bits & 0x08:
+                epub.fp.write(struct.pack("<LLLL", 0x08074b50, zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+                epub.start_dir = epub.fp.tell()
+            elif not self._known:
+                epub.start_dir = epub.fp.tell()
+                epub.fp.seek(zinfo.header_offset)
+                epub.fp.write(zinfo.FileHeader(False))
+                epub.fp.seek(epub.start_dir)
+            else:
+                epub.start_dir = epub.fp.tell()
+
+            epub.filelist.append(zinfo)
+            epub.NameToInfo[zinfo.filename] = zinfo
+        finally:
+            epub._writing = False
+
+
+def new_zipinfo(name, compress_type, date_time=None):
+    zinfo = zipfile.ZipInfo(name, date_time=date_time or time.localtime(time.time())[:6])
+    zinfo.compress_type = compress_type
+    if date_time is not None:
+        # zipfile records the build platform; pin it so Windows and Unix
+        # builds of a reproducible book match.
+        zinfo.create_system = 3
+    return zinfo
+
+
+def deflate_chunks(chunks, level, totals):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    file_size = 0
+
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        file_size += len(chunk)
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    totals["crc"] = crc
+    totals["file_size"] = file_size
+    yield compressor.flush()
+
+
+def deflate_block(block, level, dictionary, last):
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def iter_blocks(chunks, block_size):
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        while len(pending) >= block_size:
+            yield bytes(pending[:block_size])
+            del pending[:block_size]
+    if pending:
+        yield bytes(pending)
+
+
+def parallel_deflate_chunks(chunks, level, totals, workers, block_size):
+    # pigz-style: each block is deflated on its own thread, primed with the
+    # previous block's last 32 KiB so matches can still reach back across the
+    # seam, and ended with a sync flush so the pieces concatenate into one
+    # raw deflate stream. zlib releases the GIL, so threads scale across
+    # cores. The CRC runs sequentially here; it is far cheaper than deflate.
+    crc = 0
+    file_size = 0
+    dictionary = b""
+    blocks = iter_blocks(chunks, block_size)
+    block = next(blocks, None)
+
+    following = next(blocks, None)
+    if following is None:
+        # Single block: no seam to parallelise, skip the pool entirely.
+        block = block or b""
+        totals["crc"] = zlib.crc32(block)
+        totals["file_size"] = len(block)
+        yield deflate_block(block, level, b"", True)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        while block is not None:
+            crc = zlib.crc32(block, crc)
+            file_size += len(block)
+            pending.append(pool.submit(deflate_block, block, level, dictionary, following is None))
+            dictionary = block[-DEFLATE_WINDOW_SIZE:]
+            block = following
+            following = next(blocks, None) if block is not None else None
 
+            # Keep a couple of blocks queued per worker, no more: memory stays
+            # bounded by workers * block size whatever the member size.
+            while len(pending) > workers * 2:
+                yield pending.popleft().result()
+
+        totals["crc"] = crc
+        totals["file_size"] = file_size
+        while pending:
+            yield pending.popleft().result()
+
+
+def parse_compression_rule(rule):
+    conditions, _, action = rule.rpartition("=")
+    method, _, level = action.partition(":")
+    if not conditions or method not in ("stored", "deflate"):
+        raise ValueError(f"Bad compression rule {rule!r}; expected CONDITIONS=stored|deflate[:LEVEL]")
+
+    matchers = []
+    for condition in conditions.split("&"):
+        size = COMPRESSION_SIZE_RE.match(condition)
+        if size:
+            scale = {"": 1, "K": 1024, "M": 1024 * 1024}[size.group(3).upper()]
+            matchers.append((size.group(1), int(size.group(2)) * scale))
+        elif condition.startswith("type:"):
+            matchers.append(("type", condition[len("type:"):]))
+        else:
+            matchers.append(("name", condition))
+
+    if method == "stored":
+        return matchers, zipfile.ZIP_STORED, None
+    level = int(level) if level else DEFAULT_COMPRESS_LEVEL
+    if not 0 <= level <= 9:
+        raise ValueError(f"Bad deflate level in compression rule {rule!r}")
+    return matchers, zipfile.ZIP_DEFLATED, level
+
+
+def member_media_type(name):
+    extension = os.path.splitext(name)[1].lower()
+    return MEMBER_MEDIA_TYPES.get(extension) or mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+
+def choose_compression(rules, name, size):
+    media_type = member_media_type(name)
+    for matchers, compress_type, level in rules:
+        for kind, value in matchers:
+            if kind == "name" and not fnmatch.fnmatchcase(name, value):
+                break
+            if kind == "type" and not fnmatch.fnmatchcase(media_type, value):
+                break
+            if kind == "<" and not size < value:
+                break
+            if kind == ">=" and not size >= value:
+                break
+        else:
+            return compress_type, level
+    return zipfile.ZIP_DEFLATED, DEFAULT_COMPRESS_LEVEL
+
+
+def peek_size(chunks, limit):
+    # Size rules are decided before writing, but most members are streamed.
+    # Buffer just past the largest threshold: either the member ends inside
+    # it, or every size comparison already has its answer.
+    head = []
+    size = 0
+    chunks = iter(chunks)
+    for chunk in chunks:
+        # mmap slices are released once the producer moves on; keep a copy.
+        head.append(bytes(chunk) if isinstance(chunk, memoryview) else chunk)
+        size += len(chunk)
+        if size > limit:
+            break
+    return size, itertools.chain(head, chunks)
+
+
+def compression_settings(options):
+    timestamp = build_timestamp(options)
+    rules = [parse_compression_rule(rule) for rule in options["compression_policy"]]
+    thresholds = [value for matchers, _, _ in rules for kind, value in matchers if kind in ("<", ">=")]
+    return {
+        "rules": rules,
+        "size_limit": max(thresholds) if thresholds else None,
+        "workers": options["deflate_workers"] or os.cpu_count() or 1,
+        "block_bytes": options["deflate_block_bytes"],
+        "date_time": timestamp.timetuple()[:6] if timestamp else None,
+    }
+
+
+def compression_cache_key(compression, options):
+    # Parallel output depends on the block layout, not on the worker count.
+    block_bytes = compression["block_bytes"] if compression["workers"] > 1 else None
+    return [list(options["compression_policy"]), block_bytes]
+
+
+def stored_chunks(chunks, totals):
+    crc = 0
+    file_size = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        file_size += len(chunk)
+        yield chunk
+    totals["crc"] = crc
+    totals["file_size"] = file_size
+
+
+def write_compressed_member(epub, name, chunks, compression, tee=None, profile=None):
+    started = time.perf_counter()
+    size = None
+    if compression["size_limit"] is not None:
+        size, chunks = peek_size(chunks, compression["size_limit"])
+    compress_type, level = choose_compression(compression["rules"], name, size)
+
+    totals = {}
+    record = {"name": name, "compress_type": compress_type, "level": level, "offset": tee.tell() if tee else 0}
+
+    if compress_type == zipfile.ZIP_STORED:
+        payload = stored_chunks(chunks, totals)
+    elif compression["workers"] > 1:
+        payload = parallel_deflate_chunks(chunks, level, totals, compression["workers"], compression["block_bytes"])
+    else:
+        payload = deflate_chunks(chunks, level, totals)
+
+    write_stage = contextlib.nullcontext
+    if profile is not None:
+        payload = profile.chunks("compress", payload)
+        write_stage = functools.partial(profile.stage, "write")
+
+    with RawMemberWriter(epub, new_zipinfo(name, compress_type, compression["date_time"])) as member:
+        for piece in payload:
+            with write_stage():
+                member.write(piece)
+                if tee is not None:
+                    tee.write(piece)
+        with write_stage():
+            member.finish(totals["crc"], totals["file_size"])
+
+    if profile is not None:
+        profile.count("compress", bytes_in=totals["file_size"])
+        profile.count("write", bytes_in=epub.NameToInfo[name].compress_size,
+                      bytes_out=epub.NameToInfo[name].compress_size)
+
+    record.update(totals, compress_size=epub.NameToInfo[name].compress_size)
+    record["seconds"] = time.perf_counter() - started
+    return record
+
+
+def write_stored_member(epub, name, data, date_time=None):
+    # Sizes known up front, so no data descriptor even on a pipe: the OCF
+    # spec wants `mimetype` to be a plain STORED entry.
+    zinfo = new_zipinfo(name, zipfile.ZIP_STORED, date_time)
+    with RawMemberWriter(epub, zinfo, zlib.crc32(data), len(data), len(data)) as member:
+        member.write(data)
+
+
+def copy_precompressed_member(epub, source, record, date_time=None):
+    started = time.perf_counter()
+    source.seek(record["offset"])
+    zinfo = new_zipinfo(record["name"], record["compress_type"], date_time)
+    with RawMemberWriter(epub, zinfo, record["crc"], record["file_size"], record["compress_size"]) as member:
+        for chunk in iter_file_chunks(source, record["compress_size"]):
+            member.write(chunk)
+    return dict(record, seconds=time.perf_counter() - started, cached=True)
+
+
+def builder_digest():
+    # Template and shim sources live in this file, so any edit to it
+    # invalidates cached members built by an older version.
     try:
-        with zipfile.ZipFile(epub_path, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as epub:
-            epub.write(mimetype_path, "mimetype", compress_type=zipfile.ZIP_STORED)
-            epub.write(os.path.join(meta_inf_path, "container.xml"), "META-INF/container.xml")
+        with open(os.path.abspath(__file__), "rb") as source:
+            return hashlib.sha256(source.read()).hexdigest()
+    except (NameError, OSError):
+        return str(CACHE_FORMAT_VERSION)
+
+
+class BuildCache:
+    # Content-addressed store of pre-compressed member groups. Each entry is
+    # objects/<k[:2]>/<k> (concatenated deflate streams) plus <k>.json with
+    # the CRCs, sizes and offsets needed to copy them into a new archive.
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_BUILD_OPTIONS["cache_max_bytes"]):
+        self.root = os.path.expanduser(cache_dir)
+        self.objects = os.path.join(self.root, "objects")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.objects, exist_ok=True)
+
+    def _read_json(self, name, default):
+        try:
+            with open(os.path.join(self.root, name), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def _write_json(self, path, value):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+    @contextlib.contextmanager
+    def _locked(self, name):
+        # Parallel --batch builds share stats.json and inputs.json; each
+        # read-merge-write holds the file's lock so no update is lost.
+        lock_path = os.path.join(self.root, f"{name}.lock")
+        if fcntl is not None:
+            with open(lock_path, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            return
+
+        # Without flock, creating the lock file exclusively is the lock. One
+        # left behind by a killed build is broken once it is stale.
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                with contextlib.suppress(OSError):
+                    if time.time() - os.path.getmtime(lock_path) > CACHE_STALE_LOCK_SECONDS:
+                        os.remove(lock_path)
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            with contextlib.suppress(OSError):
+                os.remove(lock_path)
+
+    def file_digest(self, path):
+        # Remember digests by (size, mtime, inode) so an unchanged 100 MB
+        # input is not re-hashed on every build.
+        memo = self._read_json("inputs.json", {})
+        real_path = os.path.realpath(path)
+        st = os.stat(real_path)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+
+        remembered = memo.get(real_path)
+        if remembered and remembered[:3] == stamp:
+            return remembered[3]
+
+        digest = hashlib.sha256()
+        with open(real_path, "rb") as source:
+            for chunk in iter_file_chunks(source):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+
+        # A file written within the mtime granularity could change again
+        # without its stamp moving, so only settled files are remembered.
+        if time.time() - st.st_mtime > CACHE_SETTLE_SECONDS:
+            with self._locked("inputs.json"):
+                memo = self._read_json("inputs.json", {})
+                memo[real_path] = stamp + [digest]
+                self._write_json(os.path.join(self.root, "inputs.json"), memo)
+        return digest
+
+    def key(self, *parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _paths(self, key):
+        directory = os.path.join(self.objects, key[:2])
+        return os.path.join(directory, key), os.path.join(directory, f"{key}.json")
+
+    def lookup(self, key):
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            if not os.path.exists(data_path):
+                raise OSError(data_path)
+            # Entries are evicted least recently used first.
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry["path"] = data_path
+        return entry
+
+    def replay(self, entry, epub, date_time=None):
+        with open(entry["path"], "rb") as source:
+            return [copy_precompressed_member(epub, source, record, date_time) for record in entry["members"]]
+
+    def begin(self, key):
+        directory = os.path.dirname(self._paths(key)[0])
+        os.makedirs(directory, exist_ok=True)
+        data_file = tempfile.NamedTemporaryFile(dir=directory, prefix=f"{key}.", suffix=".tmp", delete=False)
+        return {"key": key, "file": data_file, "members": []}
+
+    def commit(self, pending, extra):
+        pending["file"].close()
+        data_path, meta_path = self._paths(pending["key"])
+        os.replace(pending["file"].name, data_path)
+        self._write_json(meta_path, {"members": pending["members"], "extra": extra})
+        self.evict()
+
+    def abort(self, pending):
+        pending["file"].close()
+        with contextlib.suppress(OSError):
+            os.remove(pending["file"].name)
+
+    def entries(self):
+        entries = []
+        for directory in os.listdir(self.objects):
+            directory = os.path.join(self.objects, directory)
+            for name in os.listdir(directory):
+                if not name.endswith(".json"):
+                    continue
+                meta_path = os.path.join(directory, name)
+                data_path = meta_path[:-len(".json")]
+                try:
+                    size = os.path.getsize(meta_path) + os.path.getsize(data_path)
+                    entries.append((os.path.getmtime(meta_path), size, meta_path, data_path))
+                except OSError:
+                    continue
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+
+        for _, size, meta_path, data_path in entries:
+            if total <= self.max_bytes:
+                break
+            for path in (meta_path, data_path):
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+            total -= size
+            self.evictions += 1
+
+    def save_stats(self):
+        with self._locked("stats.json"):
+            stats = self._read_json("stats.json", {"hits": 0, "misses": 0, "evictions": 0})
+            stats["hits"] += self.hits
+            stats["misses"] += self.misses
+            stats["evictions"] += self.evictions
+            self._write_json(os.path.join(self.root, "stats.json"), stats)
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        stats = self._read_json("stats.json", {"hits": 0, "misses": 0, "evictions": 0})
+        entries = self.entries()
+        lookups = stats["hits"] + stats["misses"]
+        stats.update(
+            entries=len(entries),
+            bytes=sum(entry[1] for entry in entries),
+            max_bytes=self.max_bytes,
+            hit_rate=round(stats["hits"] / lookups, 3) if lookups else None,
+        )
+        return stats
+
+
+class MemoryBuildCache:
+    # The BuildCache interface over process memory, for long-running
+    # builders: entries are the compressed bytes themselves, evicted least
+    # recently used first beyond max_bytes, and lost on exit.
+
+    def __init__(self, max_bytes=DEFAULT_BUILD_OPTIONS["cache_max_bytes"]):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.digests = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.totals = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def file_digest(self, path):
+        real_path = os.path.realpath(path)
+        st = os.stat(real_path)
+        stamp = (real_path, st.st_size, st.st_mtime_ns, st.st_ino)
+        if stamp in self.digests:
+            return self.digests[stamp]
+
+        digest = hashlib.sha256()
+        with open(real_path, "rb") as source:
+            for chunk in iter_file_chunks(source):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        if time.time() - st.st_mtime > CACHE_SETTLE_SECONDS:
+            self.digests = {key: value for key, value in self.digests.items() if key[0] != real_path}
+            self.digests[stamp] = digest
+        return digest
+
+    key = BuildCache.key
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def replay(self, entry, epub, date_time=None):
+        source = io.BytesIO(entry["data"])
+        return [copy_precompressed_member(epub, source, record, date_time) for record in entry["members"]]
+
+    def begin(self, key):
+        return {"key": key, "file": io.BytesIO(), "members": []}
+
+    def commit(self, pending, extra):
+        self.entries[pending["key"]] = {"data": pending["file"].getvalue(), "members": pending["members"],
+                                        "extra": extra}
+        self.entries.move_to_end(pending["key"])
+        self.evict()
+
+    def abort(self, pending):
+        pending["file"].close()
+
+    def evict(self):
+        total = sum(len(entry["data"]) for entry in self.entries.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            total -= len(entry["data"])
+            self.evictions += 1
+
+    def save_stats(self):
+        for name in self.totals:
+            self.totals[name] += getattr(self, name)
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        lookups = self.totals["hits"] + self.totals["misses"]
+        return dict(
+            self.totals,
+            entries=len(self.entries),
+            bytes=sum(len(entry["data"]) for entry in self.entries.values()),
+            max_bytes=self.max_bytes,
+            hit_rate=round(self.totals["hits"] / lookups, 3) if lookups else None,
+        )
+
+
+def peak_rss_mb():
+    # Process high-water mark. ru_maxrss is KB on Linux and bytes on macOS.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class BuildProfile:
+    # Splits a build into named stages. Stages nest as the streaming pipeline
+    # pulls chunks through them (write -> compress -> inject -> read), and
+    # time is charged to the innermost one only, so the stage totals add up
+    # to the build time instead of counting the same second several times.
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self._stack = []
+        self._started = self._mark = time.perf_counter()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _record(self, name):
+        if name not in self.stages:
+            self.stages[name] = {"seconds": 0.0, "bytes_in": 0, "bytes_out": 0, "peak_rss_mb": None,
+                                 "peak_traced_mb": None}
+        return self.stages[name]
+
+    def _switch(self):
+        now = time.perf_counter()
+        if self._stack:
+            record = self.stages[self._stack[-1]]
+            record["seconds"] += now - self._mark
+            rss = peak_rss_mb()
+            if rss is not None:
+                record["peak_rss_mb"] = max(record["peak_rss_mb"] or 0, rss)
+            if self.trace_memory:
+                # Python-heap peak since the last stage switch; reset_peak()
+                # is 3.9+, older versions report the peak since start.
+                traced = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+                record["peak_traced_mb"] = max(record["peak_traced_mb"] or 0, traced)
+                if hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak()
+        self._mark = now
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self._record(name)
+        self._switch()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._switch()
+            self._stack.pop()
+
+    def chunks(self, name, chunks):
+        # Charges the work of producing each chunk to `name`.
+        chunks = iter(chunks)
+        while True:
+            with self.stage(name):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            self.stages[name]["bytes_out"] += len(chunk)
+            yield chunk
+
+    def count(self, name, bytes_in=0, bytes_out=0):
+        record = self._record(name)
+        record["bytes_in"] += bytes_in
+        record["bytes_out"] += bytes_out
+
+    def close(self):
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def report(self):
+        total = time.perf_counter() - self._started
+        stages = [dict(self.stages[name], name=name, seconds=round(self.stages[name]["seconds"], 6))
+                  for name in PROFILE_STAGES if name in self.stages]
+        return {
+            "seconds": round(total, 6),
+            "unattributed_seconds": round(total - sum(record["seconds"] for record in self.stages.values()), 6),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": stages,
+        }
+
+
+class ProfiledReader:
+    # Times reads of the game HTML as the "read" stage. Everything else,
+    # including fileno() for the mmap path, goes to the real file.
+
+    def __init__(self, source, profile):
+        self._source = source
+        self._profile = profile
+
+    def read(self, size=-1):
+        with self._profile.stage("read"):
+            data = self._source.read(size)
+        self._profile.count("read", len(data), len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._source, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._source.close()
+
+
+def print_build_profile(report):
+    print(f"{'stage':<16} {'seconds':>9} {'in MB':>10} {'out MB':>10} {'peak RSS MB':>12} {'peak heap MB':>13}")
+    for record in report["stages"]:
+        rss = f"{record['peak_rss_mb']:.1f}" if record["peak_rss_mb"] is not None else "-"
+        traced = f"{record['peak_traced_mb']:.1f}" if record["peak_traced_mb"] is not None else "-"
+        print(f"{record['name']:<16} {record['seconds']:>9.3f} {record['bytes_in'] / 1024 / 1024:>10.2f} "
+              f"{record['bytes_out'] / 1024 / 1024:>10.2f} {rss:>12} {traced:>13}")
+    print(f"{'(other)':<16} {report['unattributed_seconds']:>9.3f}")
+    print(f"{'total':<16} {report['seconds']:>9.3f}")
+
+
+def write_build_profile(prefix, profile, profiler, details):
+    # <prefix>.json for CI to track, <prefix>.pstats for `python -m pstats`.
+    report = dict(details, **profile.report())
+    print_build_profile(report)
+    try:
+        with open(f"{prefix}.json", "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        profiler.dump_stats(f"{prefix}.pstats")
+    except OSError as e:
+        print(f"Error writing build profile: {e}")
+        return
+    print(f"Build profile written to {prefix}.json and {prefix}.pstats")
+
+
+def write_member_group(epub, members, compression, cache=None, key=None, describe=dict, report=None,
+                       profile=None):
+    # Writes (name, chunks) members, or replays them pre-compressed when the
+    # cache already holds this key. describe() returns whatever the caller
+    # needs to remember about the group (manifest entries, ...). Per-member
+    # records (sizes, method, time) are appended to `report`.
+    if report is None:
+        report = []
+
+    if cache is not None:
+        with profile.stage("cache") if profile is not None else contextlib.nullcontext():
+            entry = cache.lookup(key)
+            if entry is not None:
+                replayed = cache.replay(entry, epub, compression["date_time"])
+                report.extend(replayed)
+                if profile is not None:
+                    copied = sum(record["compress_size"] for record in replayed)
+                    profile.count("cache", bytes_in=copied, bytes_out=copied)
+                return entry["extra"]
+
+    pending = cache.begin(key) if cache is not None else None
+    try:
+        for name, chunks in members:
+            record = write_compressed_member(epub, name, chunks, compression, pending["file"] if pending else None,
+                                             profile)
+            report.append(record)
+            if pending is not None:
+                pending["members"].append({key: value for key, value in record.items() if key != "seconds"})
+        extra = describe()
+    except BaseException:
+        if pending is not None:
+            cache.abort(pending)
+        raise
+
+    if pending is not None:
+        with profile.stage("cache") if profile is not None else contextlib.nullcontext():
+            cache.commit(pending, extra)
+    return extra
+
+
+def print_compression_report(report):
+    print(f"{'member':<44} {'method':<10} {'in KB':>10} {'out KB':>10} {'saved KB':>10} {'ms':>8}")
+    for record in report:
+        if record["compress_type"] == zipfile.ZIP_STORED:
+            method = "stored"
+        else:
+            method = f"deflate:{record['level']}"
+        if record.get("cached"):
+            method += "*"
+        saved = record["file_size"] - record["compress_size"]
+        print(f"{record['name']:<44} {method:<10} {record['file_size'] / 1024:>10.1f} "
+              f"{record['compress_size'] / 1024:>10.1f} {saved / 1024:>10.1f} {record['seconds'] * 1000:>8.1f}")
+    if any(record.get("cached") for record in report):
+        print("* copied pre-compressed from the build cache")
+
+
+def read_xml_member(epub, name, problems):
+    if name not in epub.NameToInfo:
+        problems.append(f"{name}: missing")
+        return None
+    try:
+        return ElementTree.fromstring(epub.read(name))
+    except ElementTree.ParseError as e:
+        problems.append(f"{name}: not well-formed XML ({e})")
+    except zipfile.BadZipFile as e:
+        problems.append(f"{name}: {e}")
+    return None
+
+
+def check_well_formed(epub, zinfo, problems):
+    # Streamed through expat, so a large XHTML member is never held whole.
+    parser = xml.parsers.expat.ParserCreate()
+    try:
+        with epub.open(zinfo) as member:
+            for chunk in iter_file_chunks(member):
+                parser.Parse(chunk, False)
+        parser.Parse(b"", True)
+    except xml.parsers.expat.ExpatError as e:
+        problems.append(f"{zinfo.filename}: not well-formed XML ({e})")
+    except zipfile.BadZipFile as e:
+        problems.append(f"{zinfo.filename}: {e}")
+
+
+def check_mimetype(epub, problems):
+    first = epub.infolist()[0] if epub.infolist() else None
+    if first is None or first.filename != "mimetype" or first.header_offset != 0:
+        problems.append("mimetype: must be the first member")
+        return
+    if first.compress_type != zipfile.ZIP_STORED:
+        problems.append("mimetype: must be STORED, not compressed")
+    epub.fp.seek(0)
+    header = epub.fp.read(30)
+    if len(header) == 30 and struct.unpack("<H", header[28:30])[0]:
+        problems.append("mimetype: local header must not have an extra field")
+    if epub.read(first) != b"application/epub+zip":
+        problems.append("mimetype: must contain exactly 'application/epub+zip'")
+
+
+def check_package(epub, opf, problems):
+    # Returns the book identifier, for the NCX check.
+    package_dir = posixpath.dirname(OPF_PATH)
+    items = opf.findall(f"{{{OPF_NS}}}manifest/{{{OPF_NS}}}item")
+    manifest = {}
+    listed = {OPF_PATH}
+    for item in items:
+        item_id = item.get("id")
+        if item_id in manifest:
+            problems.append(f"{OPF_PATH}: duplicate manifest id {item_id!r}")
+        manifest[item_id] = item
+        name = posixpath.normpath(posixpath.join(package_dir, urllib.parse.unquote(item.get("href", ""))))
+        listed.add(name)
+        if name not in epub.NameToInfo:
+            problems.append(f"{OPF_PATH}: manifest item {item_id!r} points to missing member {name}")
+
+    for item_id, (href, media_type, properties) in REQUIRED_MANIFEST_ITEMS.items():
+        item = manifest.get(item_id)
+        if item is None:
+            problems.append(f"{OPF_PATH}: manifest has no {item_id!r} item")
+        elif item.get("href") != href or item.get("media-type") != media_type:
+            problems.append(f"{OPF_PATH}: {item_id!r} item should be {href} ({media_type}), "
+                            f"not {item.get('href')} ({item.get('media-type')})")
+        elif properties and properties not in item.get("properties", "").split():
+            problems.append(f"{OPF_PATH}: {item_id!r} item needs properties=\"{properties}\"")
+
+    for name in epub.NameToInfo:
+        if name.startswith(f"{package_dir}/") and not name.endswith("/") and name not in listed:
+            problems.append(f"{name}: not listed in the manifest")
+
+    spine = opf.find(f"{{{OPF_NS}}}spine")
+    if spine is None or not len(spine):
+        problems.append(f"{OPF_PATH}: spine is missing or empty")
+    else:
+        if spine.get("toc") not in manifest:
+            problems.append(f"{OPF_PATH}: spine toc {spine.get('toc')!r} is not a manifest id")
+        for itemref in spine:
+            if itemref.get("idref") not in manifest:
+                problems.append(f"{OPF_PATH}: spine refers to unknown item {itemref.get('idref')!r}")
+
+    unique_id = opf.get("unique-identifier")
+    for identifier in opf.iter(f"{{{DC_NS}}}identifier"):
+        if identifier.get("id") == unique_id and (identifier.text or "").strip():
+            return identifier.text.strip()
+    problems.append(f"{OPF_PATH}: unique-identifier {unique_id!r} names no dc:identifier")
+    return None
+
+
+def validate_epub(source):
+    # Structural checks for what this builder can get wrong, cheap enough
+    # to run after every build; epubcheck remains the full validator.
+    # Returns a list of problems, empty when the book passed.
+    try:
+        epub = zipfile.ZipFile(source)
+    except (OSError, zipfile.BadZipFile) as e:
+        return [f"not a readable zip archive: {e}"]
+
+    problems = []
+    with epub:
+        names = collections.Counter(zinfo.filename for zinfo in epub.infolist())
+        for name, count in names.items():
+            if count > 1:
+                problems.append(f"{name}: appears {count} times")
 
-            for filename in ["content.opf", "index.xhtml", "nav.xhtml", "toc.ncx", html_filename]:
-                file_path = os.path.join(oebps_path, filename)
-                if os.path.exists(file_path):
-                    epub.write(file_path, f"OEBPS/{filename}")
+        check_mimetype(epub, problems)
 
-        print("Apple Books EPUB created successfully:", epub_path)
-        print(f"File size: {os.path.getsize(epub_path) / 1024 / 1024:.2f} MB")
+        container = read_xml_member(epub, CONTAINER_PATH, problems)
+        if container is not None:
+            paths = [rootfile.get("full-path")
+                     for rootfile in container.iter(f"{{{CONTAINER_NS}}}rootfile")
+                     if rootfile.get("media-type") == "application/oebps-package+xml"]
+            if paths != [OPF_PATH]:
+                problems.append(f"{CONTAINER_PATH}: rootfile should be {OPF_PATH}, not {', '.join(paths) or 'none'}")
 
+        identifier = None
+        opf = read_xml_member(epub, OPF_PATH, problems)
+        if opf is not None:
+            identifier = check_package(epub, opf, problems)
+
+        ncx = read_xml_member(epub, NCX_PATH, problems)
+        if ncx is not None and identifier is not None:
+            uids = [meta.get("content") for meta in ncx.iter(f"{{{NCX_NS}}}meta") if meta.get("name") == "dtb:uid"]
+            if uids != [identifier]:
+                problems.append(f"{NCX_PATH}: dtb:uid should match the book identifier {identifier!r}")
+
+        for zinfo in epub.infolist():
+            if zinfo.filename.endswith(XML_MEMBER_SUFFIXES) and zinfo.filename not in (
+                    CONTAINER_PATH, OPF_PATH, NCX_PATH):
+                check_well_formed(epub, zinfo, problems)
+
+    return problems
+
+
+def report_validation(epub_path):
+    started = time.perf_counter()
+    problems = validate_epub(epub_path)
+    for problem in problems:
+        print(f"  {problem}")
+    if problems:
+        print(f"EPUB validation failed: {len(problems)} problem(s) in {epub_path}")
+        return False
+    print(f"EPUB structure validated in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return True
+
+
+def build_timestamp(options):
+    # Reproducible builds take every date from SOURCE_DATE_EPOCH, or a fixed
+    # one, instead of the clock. None means "now".
+    if not options["reproducible"]:
+        return None
+    epoch = os.environ.get("SOURCE_DATE_EPOCH", "").strip()
+    try:
+        seconds = int(epoch) if epoch else REPRODUCIBLE_EPOCH
+    except ValueError:
+        raise ValueError(f"SOURCE_DATE_EPOCH must be a number of seconds, not {epoch!r}")
+    return datetime.datetime.fromtimestamp(max(seconds, REPRODUCIBLE_EPOCH), datetime.timezone.utc)
+
+
+def content_identifier(epub, *parts):
+    # A UUID hashed from every member written so far and `parts` (members
+    # still to come, metadata): the same inputs and options always give the
+    # same identifier, and any change to the book gives a new one.
+    digest = hashlib.sha256()
+    for zinfo in epub.infolist():
+        digest.update(f"{zinfo.filename}\0{zinfo.CRC:08x}\0{zinfo.file_size}\n".encode("utf-8"))
+    for part in parts:
+        digest.update(hashlib.sha256(part).digest())
+    return f"urn:uuid:{uuid.UUID(bytes=digest.digest()[:16], version=5)}"
+
+
+def resolve_build_options(options):
+    unknown = set(options) - set(DEFAULT_BUILD_OPTIONS)
+    if unknown:
+        raise TypeError(f"Unknown build option(s): {', '.join(sorted(unknown))}")
+
+    resolved = dict(DEFAULT_BUILD_OPTIONS, **options)
+    if resolved["input_mode"] not in INPUT_MODES:
+        raise ValueError(f"input_mode must be one of {INPUT_MODES}, not {resolved['input_mode']!r}")
+    for rule in resolved["compression_policy"]:
+        parse_compression_rule(rule)
+    if resolved["log_level"] not in LOG_LEVELS:
+        raise ValueError(f"log_level must be one of {LOG_LEVELS}, not {resolved['log_level']!r}")
+    if resolved["log_buffer_size"] < 1:
+        raise ValueError("log_buffer_size must be at least 1")
+    if resolved["response_cache_bytes"] < 0:
+        raise ValueError("response_cache_bytes must not be negative")
+    for rule in resolved["routes"]:
+        parse_route_rule(rule)
+    profiles = resolved["graphics_profiles"]
+    if resolved["graphics_profile"] != "auto" and resolved["graphics_profile"] not in profiles:
+        raise ValueError(f"graphics_profile must be 'auto' or one of {tuple(profiles)}, "
+                         f"not {resolved['graphics_profile']!r}")
+    for name, profile in profiles.items():
+        if not 0 < profile["render_scale"] <= 4:
+            raise ValueError(f"render_scale of graphics profile {name!r} must be in (0, 4]")
+    if resolved["perf_hud_frames"] < 1:
+        raise ValueError("perf_hud_frames must be at least 1")
+    if resolved["split_scripts_min_bytes"] < 1:
+        raise ValueError("split_scripts_min_bytes must be at least 1")
+    if resolved["launch_timeout_ms"] < 0:
+        raise ValueError("launch_timeout_ms must not be negative")
+    build_timestamp(resolved)
+    return resolved
+
+
+def template_options(options):
+    # The options the shared templates depend on; books that agree on these
+    # can reuse one rendering.
+    return {key: options[key] for key in ("bundles", "bundle_part_bytes", "release", "log_buffer_size", "log_level",
+                                        "storage_prefix", "storage_flush_ms", "response_cache_bytes", "routes",
+                                        "request_timeout_ms", "graphics_profile", "graphics_profiles", "perf_hud",
+                                        "perf_hud_frames", "preload_game", "launch_timeout_ms")}
+
+
+def render_shared_templates(options, bundles=None):
+    if bundles is None:
+        bundles = plan_bundles(options["bundles"], options["bundle_part_bytes"])
+    log_config = {"size": options["log_buffer_size"], "level": options["log_level"]}
+    graphics_config = {
+        "default": options["graphics_profile"],
+        "profiles": options["graphics_profiles"],
+        "storage_key": f"{options['storage_prefix']}graphics-profile",
+    }
+    templates = {
+        "META-INF/container.xml": CONTAINER_XML,
+        "OEBPS/index.xhtml": render_index_xhtml(GAME_HTML_FILENAME, {
+            "log": log_config,
+            "graphics": graphics_config,
+            "launch": {"preload": options["preload_game"], "timeout_ms": options["launch_timeout_ms"]},
+        }),
+        "OEBPS/nav.xhtml": NAV_XHTML,
+        "fixes": render_browser_api_fixes({
+            "resources": bundle_resource_index(bundles),
+            "log": log_config,
+            "storage": {"prefix": options["storage_prefix"], "flush_ms": options["storage_flush_ms"]},
+            "response_cache_bytes": options["response_cache_bytes"],
+            "routes": compile_routes(options["routes"], options["request_timeout_ms"]),
+            "graphics": graphics_config,
+            "perf_hud": {"frames": options["perf_hud_frames"]} if options["perf_hud"] else None,
+        }),
+    }
+    if options["release"]:
+        templates = {name: release_template(text) for name, text in templates.items()}
+    return {name: text.encode("utf-8") for name, text in templates.items()}
+
+
+def create_eaglecraft_epub(input_path=DEFAULT_INPUT_PATH, output=DEFAULT_EPUB_PATH, templates=None,
+                           member_cache=None, **options):
+
+    options = resolve_build_options(options)
+
+    try:
+        bundles = plan_bundles(options["bundles"], options["bundle_part_bytes"])
+    except OSError as e:
+        print(f"Error reading bundle: {e}")
+        return False
+
+    html_filename = GAME_HTML_FILENAME
+    current_date = (build_timestamp(options) or datetime.datetime.now()).strftime("%Y-%m-%dT%H:%M:%SZ")
+    book_id = options["identifier"] or f"urn:uuid:{uuid.uuid4()}"
+
+    # Stage timings are cheap and always collected; heap tracing and
+    # cProfile only run when a --profile report was asked for.
+    profile = BuildProfile(trace_memory=bool(options["profile"]))
+    profiler = None
+    if options["profile"]:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    html_file = None
+    epub_path = None
+    assets = []
+    cache = None
+    report = []
+    ok = False
+    try:
+        # Opened inside the try so the finally closes it whatever fails
+        # between here and the write.
+        try:
+            html_file = ProfiledReader(open(input_path, "rb"), profile)
+        except FileNotFoundError:
+            print(f"Error: {input_path} file not found!")
+            print("Please ensure eaglecraft.html exists in the current directory.")
+            return False
+        except Exception as e:
+            print(f"Error reading {input_path}: {e}")
+            return False
+
+        cache = member_cache
+        if cache is None and options["cache"]:
+            cache = BuildCache(options["cache_dir"], options["cache_max_bytes"])
+        compression = compression_settings(options)
+        with profile.stage("render templates"):
+            if templates is None:
+                templates = render_shared_templates(options, bundles)
+        fixes = templates["fixes"]
+
+        game_key = bundle_keys = None
+        if cache is not None:
+            with profile.stage("cache"):
+                builder = builder_digest()
+                game_key = cache.key(
+                    "game", builder, cache.file_digest(input_path), hashlib.sha256(fixes).hexdigest(),
+                    compression_cache_key(compression, options),
+                    options["extract_assets"], options["extract_assets_min_bytes"],
+                    options["split_scripts"], options["split_scripts_min_bytes"], list(options["lazy_scripts"]),
+                )
+                bundle_keys = [
+                    cache.key("bundle", builder, cache.file_digest(bundle["path"]), bundle["parts"],
+                              compression_cache_key(compression, options))
+                    for bundle in bundles
+                ]
+
+        with profile.stage("write"):
+            epub, epub_path = open_epub(output)
+        with html_file, epub:
+            with profile.stage("write"):
+                write_stored_member(epub, "mimetype", b"application/epub+zip", compression["date_time"])
+            write_member_group(epub, [("META-INF/container.xml", [templates["META-INF/container.xml"]])],
+                               compression, report=report, profile=profile)
+
+            game = write_member_group(
+                epub, iter_game_members(html_file, fixes, options, assets, profile), compression, cache, game_key,
+                describe=lambda: {"resources": [
+                    {key: asset[key] for key in ("id", "href", "media_type", "size")} for asset in assets
+                ]},
+                report=report, profile=profile,
+            )
+
+            for index, bundle in enumerate(bundles):
+                write_member_group(epub, iter_bundle_members(bundle), compression, cache,
+                                   bundle_keys[index] if cache is not None else None, report=report,
+                                   profile=profile)
+
+            with profile.stage("render templates"):
+                resources = game["resources"] + [part for bundle in bundles for part in bundle["parts"]]
+                if options["reproducible"] and not options["identifier"]:
+                    book_id = content_identifier(epub, templates["OEBPS/index.xhtml"], templates["OEBPS/nav.xhtml"],
+                                                 options["title"].encode("utf-8"), options["creator"].encode("utf-8"))
+                content_opf = render_content_opf(book_id, current_date, html_filename, resources,
+                                                 options["title"], options["creator"])
+                toc_ncx = render_toc_ncx(book_id, options["title"])
+            write_member_group(epub, [
+                ("OEBPS/content.opf", [content_opf.encode("utf-8")]),
+                ("OEBPS/index.xhtml", [templates["OEBPS/index.xhtml"]]),
+                ("OEBPS/nav.xhtml", [templates["OEBPS/nav.xhtml"]]),
+                ("OEBPS/toc.ncx", [toc_ncx.encode("utf-8")]),
+            ], compression, report=report, profile=profile)
+
+            # The central directory goes out on close.
+            with profile.stage("write"):
+                epub.close()
+
+        if options["compression_report"]:
+            print_compression_report(report)
+        scripts = [asset for asset in game["resources"] if asset["id"].startswith("script-")]
+        extracted = [asset for asset in game["resources"] if not asset["id"].startswith("script-")]
+        if extracted:
+            size = sum(asset["size"] for asset in extracted)
+            print(f"Extracted {len(extracted)} embedded assets ({size / 1024 / 1024:.2f} MB decoded)")
+        if scripts:
+            size = sum(asset["size"] for asset in scripts)
+            print(f"Split {len(scripts)} inline scripts into {SCRIPT_DIR}/ ({size / 1024 / 1024:.2f} MB)")
+        for bundle in bundles:
+            print(f"Packaged bundle {bundle['url']} -> {bundle['href']} ({len(bundle['parts'])} part(s))")
+        if epub_path:
+            print("Apple Books EPUB created successfully:", epub_path)
+            print(f"File size: {os.path.getsize(epub_path) / 1024 / 1024:.2f} MB")
+        else:
+            print("Apple Books EPUB written to stream")
+
+        if options["validate"]:
+            if epub_path is None:
+                print("Skipping validation: the EPUB went to a stream")
+            elif not report_validation(epub_path):
+                # Leave nothing behind that a reader or upload step could
+                # mistake for a good book.
+                os.remove(epub_path)
+                print(f"Removed {epub_path}")
+                return False
+
+        ok = True
         return True
 
     except Exception as e:
         print(f"Error creating EPUB: {e}")
+        if epub_path and os.path.exists(epub_path):
+            os.remove(epub_path)
         return False
 
     finally:
+        if html_file is not None:
+            html_file.close()
+        for asset in assets:
+            asset["file"].close()
+        if cache is not None:
+            if cache.hits or cache.misses:
+                print(f"Build cache: {cache.hits} hit(s), {cache.misses} miss(es), {cache.evictions} eviction(s)")
+            cache.save_stats()
+        if profiler is not None:
+            profiler.disable()
+            write_build_profile(options["profile"], profile, profiler, {
+                "input": input_path,
+                "output": epub_path or "<stream>",
+                "ok": ok,
+                "members": report,
+            })
+        profile.close()
+
+
+def run_batch_job(job):
+    # Runs in a pool worker. Each book's messages are captured so parallel
+    # builds don't interleave on the console.
+    log = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        try:
+            ok = create_eaglecraft_epub(job["input"], job["output"], templates=job["templates"], **job["options"])
+        except Exception as e:
+            print(f"Error creating EPUB: {e}")
+            ok = False
+
+    return {
+        "input": job["input"],
+        "output": job["output"],
+        "title": job["options"].get("title", DEFAULT_TITLE),
+        "ok": ok,
+        "seconds": time.perf_counter() - started,
+        "log": log.getvalue(),
+    }
+
+
+def build_many(books, workers=None, **options):
+    # books: dicts with "input", "output" and any per-book build option
+    # (title, creator, identifier, bundles, ...). Shared templates are
+    # rendered once per distinct template configuration, not once per book.
+    jobs = []
+    shared = {}
+    for book in books:
+        book_options = dict(options, **book)
+        input_path = book_options.pop("input")
+        output = os.path.expanduser(book_options.pop("output"))
+
+        template_key = json.dumps(template_options(resolve_build_options(book_options)), sort_keys=True)
+        if template_key not in shared:
+            try:
+                shared[template_key] = render_shared_templates(resolve_build_options(book_options))
+            except OSError:
+                # Let the worker report the missing bundle like a single build would.
+                shared[template_key] = None
+
+        jobs.append({"input": input_path, "output": output, "templates": shared[template_key],
+                     "options": book_options})
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(run_batch_job, jobs))
+
+
+class EpubBuilder:
+    # Importable builder for long-running callers (EagleServe.py, scripts,
+    # tests). Rendered templates and compressed game and bundle members stay
+    # in memory between builds, so a book that only differs in metadata is
+    # mostly copied bytes. Messages are captured rather than printed. Not
+    # thread-safe: use one per worker.
+
+    def __init__(self, cache_max_bytes=DEFAULT_BUILD_OPTIONS["cache_max_bytes"], max_templates=16):
+        self.cache = MemoryBuildCache(cache_max_bytes)
+        self.templates = collections.OrderedDict()
+        self.max_templates = max_templates
+        self.log = ""
+
+    def shared_templates(self, options):
+        # Bundle sizes end up in the shim's resource index.
+        sizes = [os.path.getsize(parse_bundle_spec(spec)[1]) for spec in options["bundles"]]
+        key = json.dumps([template_options(options), sizes], sort_keys=True)
+        if key not in self.templates:
+            self.templates[key] = render_shared_templates(options)
+            while len(self.templates) > self.max_templates:
+                self.templates.popitem(last=False)
+        self.templates.move_to_end(key)
+        return self.templates[key]
+
+    def build(self, input_path=DEFAULT_INPUT_PATH, output=None, **options):
+        # Returns the EPUB as bytes, or writes it to `output` (a path or a
+        # writable binary stream) and returns None. Raises RuntimeError with
+        # the build's messages when it fails.
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            try:
+                templates = self.shared_templates(resolve_build_options(options))
+            except OSError as e:
+                print(f"Error reading bundle: {e}")
+                templates = None
+            stream = io.BytesIO() if output is None else output
+            ok = templates is not None and create_eaglecraft_epub(input_path, stream, templates,
+                                                                  member_cache=self.cache, **options)
+        self.log = log.getvalue()
+        if not ok:
+            raise RuntimeError(self.log.strip() or "build failed")
+        return stream.getvalue() if output is None else None
+
+
+def print_batch_summary(results, wall_seconds):
+    print(f"{'book':<32} {'input MB':>9} {'epub MB':>9} {'seconds':>8}  status")
+    for result in results:
+        input_mb = os.path.getsize(result["input"]) / 1024 / 1024 if os.path.exists(result["input"]) else 0
+        output_mb = os.path.getsize(result["output"]) / 1024 / 1024 if os.path.exists(result["output"]) else 0
+        status = "ok" if result["ok"] else "FAILED"
+        print(f"{result['title'][:32]:<32} {input_mb:>9.2f} {output_mb:>9.2f} {result['seconds']:>8.2f}  {status}")
+
+    busy = sum(result["seconds"] for result in results)
+    print(f"{len(results)} book(s) in {wall_seconds:.2f} s wall, {busy:.2f} s of build time")
+
+
+def gf2_matrix_times(matrix, vector):
+    total = 0
+    row = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return total
+
+
+def gf2_matrix_square(matrix):
+    return [gf2_matrix_times(matrix, row) for row in matrix]
+
+
+def crc32_combine(crc1, crc2, length2):
+    # CRC-32 of A + B from crc32(A), crc32(B) and len(B), as zlib's
+    # crc32_combine (which Python does not expose): len(B) zero bytes are
+    # fed through crc1 by repeated squaring of the one-zero-bit operator.
+    if length2 <= 0:
+        return crc1
+    odd = [0xEDB88320] + [1 << bit for bit in range(31)]
+    even = gf2_matrix_square(odd)
+    odd = gf2_matrix_square(even)
+    while True:
+        even = gf2_matrix_square(odd)
+        if length2 & 1:
+            crc1 = gf2_matrix_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = gf2_matrix_square(even)
+        if length2 & 1:
+            crc1 = gf2_matrix_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+    return crc1 ^ crc2
+
+
+def member_data_offset(zinfo):
+    # Local header: 30 fixed bytes, the name, then the extra field.
+    return zinfo.header_offset + 30 + len(zinfo.filename.encode("utf-8")) + len(zinfo.extra)
+
+
+# Watch mode keeps members in memory between rebuilds and never runs the
+# one-shot build, so these options would be silently ignored.
+WATCH_UNSUPPORTED_OPTIONS = ("cache", "profile", "compression_report")
+
+
+class WatchBuild:
+    # Rebuilds the book whenever the game, this file's templates or a bundle
+    # changes. The game member is compressed in two joinable pieces: the
+    # HTML up to <head> plus the shim, ended with a sync flush, then the
+    # rest of the page as a fresh deflate stream that needs no dictionary.
+    # A template edit recompresses only the first piece; the rest, and every
+    # other member that did not change, is copied compressed from the
+    # previous archive, which is then replaced atomically.
+
+    def __init__(self, input_path, output, options):
+        self.input_path = input_path
+        self.epub_path = os.path.expanduser(output)
+        self.options = options
+        self.book_id = options.get("identifier")
+        if not self.book_id and not options.get("reproducible"):
+            self.book_id = f"urn:uuid:{uuid.uuid4()}"
+        self.template_path = os.path.abspath(__file__)
+        self.templates = sys.modules[__name__]
+        self.records = None
+        self.digests = {}
+
+    def watched(self):
+        paths = {self.input_path: "game", self.template_path: "templates"}
+        for spec in self.options.get("bundles", ()):
+            paths[parse_bundle_spec(spec)[1]] = "bundles"
+        return paths
+
+    def stamps(self):
+        stamps = {}
+        for path in self.watched():
+            try:
+                stat = os.stat(path)
+                stamps[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                stamps[path] = None
+        return stamps
+
+    def reload_templates(self):
+        # Executes a fresh copy of this file so edited templates are used
+        # without a restart. Only its template functions are called; the
+        # build itself keeps running the code it started with.
+        spec = importlib.util.spec_from_file_location("eaglepub_watch_templates", self.template_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        self.templates = module
+
+    def write_member(self, epub, name, chunks, compression, records, updated):
+        data = b"".join(chunks)
+        digest = hashlib.sha256(data).hexdigest()
+        if self.digests.get(name) != digest:
+            updated.append(name)
+            self.digests[name] = digest
+        record = write_compressed_member(epub, name, [data], compression)
+        records[name] = dict(record, offset=member_data_offset(epub.NameToInfo[name]))
+
+    def copy_member(self, epub, source, name, records, copied):
+        record = copy_precompressed_member(epub, source, self.records[name], self.date_time)
+        records[name] = dict(record, offset=member_data_offset(epub.NameToInfo[name]))
+        copied.append(name)
+
+    def write_game(self, epub, html_file, fixes, options, compression, source, records, head_assets, tail_assets):
+        name = f"OEBPS/{GAME_HTML_FILENAME}"
+        previous = self.records.get(name) if source is not None else None
+
+        head = b"".join(transform_game_chunks([self.prefix], options, head_assets)) + fixes
+
+        if previous is None:
+            html_file.seek(self.head_end)
+            tail = transform_game_chunks(iter_file_chunks(html_file), options, tail_assets)
+            size = None
+            if compression["size_limit"] is not None:
+                size, tail = peek_size(tail, compression["size_limit"])
+                size += len(head)
+            compress_type, level = choose_compression(compression["rules"], name, size)
+        else:
+            tail_assets.extend(previous["tail_assets"])
+            compress_type, level = previous["compress_type"], previous["level"]
+
+        if compress_type == zipfile.ZIP_STORED:
+            head_payload = head
+        else:
+            # Sync flush, not finish: the tail's stream continues the member.
+            head_payload = deflate_block(head, level, b"", False)
+
+        started = time.perf_counter()
+        if previous is None:
+            totals = {}
+            if compress_type == zipfile.ZIP_STORED:
+                payload = stored_chunks(tail, totals)
+            elif compression["workers"] > 1:
+                payload = parallel_deflate_chunks(tail, level, totals, compression["workers"],
+                                                  compression["block_bytes"])
+            else:
+                payload = deflate_chunks(tail, level, totals)
+            with RawMemberWriter(epub, new_zipinfo(name, compress_type, compression["date_time"])) as member:
+                member.write(head_payload)
+                tail_offset = epub.fp.tell()
+                for piece in payload:
+                    member.write(piece)
+                tail_record = {"crc": totals["crc"], "file_size": totals["file_size"],
+                               "compress_size": epub.fp.tell() - tail_offset}
+                member.finish(crc32_combine(zlib.crc32(head), tail_record["crc"], tail_record["file_size"]),
+                              len(head) + tail_record["file_size"])
+        else:
+            tail_record = previous["tail"]
+            crc = crc32_combine(zlib.crc32(head), tail_record["crc"], tail_record["file_size"])
+            zinfo = new_zipinfo(name, compress_type, compression["date_time"])
+            with RawMemberWriter(epub, zinfo, crc, len(head) + tail_record["file_size"],
+                                 len(head_payload) + tail_record["compress_size"]) as member:
+                member.write(head_payload)
+                tail_offset = epub.fp.tell()
+                source.seek(tail_record["offset"])
+                for chunk in iter_file_chunks(source, tail_record["compress_size"]):
+                    member.write(chunk)
+
+        zinfo = epub.NameToInfo[name]
+        records[name] = {
+            "name": name,
+            "compress_type": compress_type,
+            "level": level,
+            "crc": zinfo.CRC,
+            "file_size": zinfo.file_size,
+            "compress_size": zinfo.compress_size,
+            "offset": member_data_offset(zinfo),
+            "seconds": time.perf_counter() - started,
+            "tail": dict(tail_record, offset=tail_offset),
+            "tail_assets": [{key: asset[key] for key in ("id", "href", "media_type", "size")}
+                            for asset in tail_assets],
+        }
+
+    def build(self, changed):
+        started = time.perf_counter()
+        full = self.records is None or "game" in changed
+        if "templates" in changed and self.records is not None:
+            self.reload_templates()
+        options = self.templates.resolve_build_options(self.options)
+        bundles = plan_bundles(options["bundles"], options["bundle_part_bytes"])
+        templates = self.templates.render_shared_templates(options, bundles)
+        compression = compression_settings(options)
+        self.date_time = compression["date_time"]
+
+        if full:
+            with open(self.input_path, "rb") as html_file:
+                head_end, sniffed = find_head_tag_end(html_file)
+                self.head_end = head_end or 0
+                if sniffed is None:
+                    html_file.seek(0)
+                    self.prefix = html_file.read(self.head_end)
+                else:
+                    self.prefix = b"".join(sniffed)[:self.head_end]
+
+        temp_path = f"{self.epub_path}.watch"
+        source = open(self.epub_path, "rb") if self.records is not None else None
+        records = {}
+        updated = []
+        copied = []
+        head_assets = []
+        tail_assets = []
+        try:
+            with contextlib.ExitStack() as stack:
+                if source is not None:
+                    stack.enter_context(source)
+                html_file = stack.enter_context(open(self.input_path, "rb"))
+                epub = stack.enter_context(open_epub(temp_path)[0])
+
+                write_stored_member(epub, "mimetype", b"application/epub+zip", compression["date_time"])
+                self.write_member(epub, "META-INF/container.xml", [templates["META-INF/container.xml"]],
+                                  compression, records, updated)
+
+                self.write_game(epub, html_file, templates["fixes"], options, compression,
+                                None if full else source, records, head_assets, tail_assets)
+                updated.append(f"OEBPS/{GAME_HTML_FILENAME}")
+                tail_ids = {asset["id"] for asset in tail_assets}
+                # A payload found in both pieces is one file, like in a normal build.
+                assets = [asset for asset in head_assets if asset["id"] not in tail_ids] + tail_assets
+                for asset in assets:
+                    name = f"OEBPS/{asset['href']}"
+                    if "file" in asset:
+                        asset["file"].seek(0)
+                        self.write_member(epub, name, iter_file_chunks(asset["file"]), compression, records,
+                                          updated)
+                    else:
+                        self.copy_member(epub, source, name, records, copied)
+                resources = [{key: asset[key] for key in ("id", "href", "media_type", "size")} for asset in assets]
+
+                for bundle in bundles:
+                    for name, chunks in iter_bundle_members(bundle):
+                        if "bundles" in changed or self.records is None or name not in self.records:
+                            self.write_member(epub, name, chunks, compression, records, updated)
+                        else:
+                            self.copy_member(epub, source, name, records, copied)
+                    resources.extend(bundle["parts"])
+
+                current_date = (build_timestamp(options) or datetime.datetime.now()).strftime("%Y-%m-%dT%H:%M:%SZ")
+                book_id = self.book_id or content_identifier(
+                    epub, templates["OEBPS/index.xhtml"], templates["OEBPS/nav.xhtml"],
+                    options["title"].encode("utf-8"), options["creator"].encode("utf-8"))
+                content_opf = self.templates.render_content_opf(
+                    book_id, current_date, GAME_HTML_FILENAME, resources, options["title"], options["creator"])
+                for name, data in (
+                    ("OEBPS/content.opf", content_opf.encode("utf-8")),
+                    ("OEBPS/index.xhtml", templates["OEBPS/index.xhtml"]),
+                    ("OEBPS/nav.xhtml", templates["OEBPS/nav.xhtml"]),
+                    ("OEBPS/toc.ncx", self.templates.render_toc_ncx(book_id, options["title"]).encode("utf-8")),
+                ):
+                    self.write_member(epub, name, [data], compression, records, updated)
+            if options["validate"] and not report_validation(temp_path):
+                raise RuntimeError("the new book failed validation")
+            os.replace(temp_path, self.epub_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            for asset in head_assets + tail_assets:
+                if "file" in asset:
+                    asset["file"].close()
+
+        self.records = records
+        return {
+            "seconds": time.perf_counter() - started,
+            "updated": updated,
+            "copied": copied,
+            "size": os.path.getsize(self.epub_path),
+            "full": full,
+        }
+
+    def run(self, interval):
+        kinds = self.watched()
+        stamps = self.stamps()
         try:
-            shutil.rmtree(output_dir)
-        except:
-            pass
+            report = self.build(set(kinds.values()))
+        except Exception as e:
+            print(f"Error creating EPUB: {e}")
+            report = None
+        if report is not None:
+            print(f"Built {self.epub_path} in {report['seconds']:.2f} s ({report['size'] / 1024 / 1024:.2f} MB)")
+        print(f"Watching {', '.join(sorted(kinds))} every {interval:g} s; Ctrl+C to stop")
+
+        try:
+            while True:
+                time.sleep(interval)
+                current = self.stamps()
+                if current == stamps:
+                    continue
+                # Let an editor or copy finish writing before reading.
+                while True:
+                    time.sleep(interval)
+                    settled = self.stamps()
+                    if settled == current:
+                        break
+                    current = settled
+
+                changed = {kinds[path] for path in current if current[path] != stamps.get(path)}
+                stamps = current
+                try:
+                    report = self.build(changed)
+                except Exception as e:
+                    print(f"Rebuild failed ({', '.join(sorted(changed))} changed), keeping the last book: {e}")
+                    continue
+                print(f"Rebuilt in {report['seconds'] * 1000:.0f} ms ({', '.join(sorted(changed))} changed): "
+                      f"updated {', '.join(name.rsplit('/', 1)[-1] for name in report['updated'])}; "
+                      f"copied {len(report['copied'])} member(s)"
+                      f"{'' if report['full'] else '; game HTML tail reused'}")
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        return True
+
+
+def watch_eaglecraft_epub(input_path=DEFAULT_INPUT_PATH, output=DEFAULT_EPUB_PATH, interval=0.5, **options):
+    if not isinstance(output, (str, bytes, os.PathLike)):
+        print("Error: --watch needs an output file, not a stream")
+        return False
+    resolved = resolve_build_options(options)
+    unsupported = [name for name in WATCH_UNSUPPORTED_OPTIONS if resolved[name]]
+    if unsupported:
+        print(f"Error: --watch does not support {', '.join(unsupported)}")
+        return False
+    return WatchBuild(input_path, output, options).run(interval)
+
+
+def compression_rule_arg(rule):
+    try:
+        parse_compression_rule(rule)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return rule
+
+
+def route_rule_arg(rule):
+    try:
+        parse_route_rule(rule)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return rule
+
+
+def positive_int_arg(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Package eaglecraft.html as an Apple Books EPUB.")
+    parser.add_argument("-i", "--input", default=DEFAULT_INPUT_PATH,
+                        help="game HTML to package (default: %(default)s)")
+    parser.add_argument("-o", "--output", default=DEFAULT_EPUB_PATH,
+                        help="EPUB path to write, or '-' for stdout (default: %(default)s)")
+    parser.add_argument("--title", default=DEFAULT_BUILD_OPTIONS["title"], help="dc:title (default: %(default)s)")
+    parser.add_argument("--creator", default=DEFAULT_BUILD_OPTIONS["creator"],
+                        help="dc:creator (default: %(default)s)")
+    parser.add_argument("--identifier",
+                        help="dc:identifier (default: a random urn:uuid, or one derived from the content "
+                             "with --reproducible)")
+    parser.add_argument("--batch", metavar="BOOKS.json",
+                        help="build every book listed in a JSON array of {input, output, title, creator, "
+                             "identifier, ...} objects; the other options are shared defaults")
+    parser.add_argument("--jobs", type=int, help="worker processes for --batch (default: one per core)")
+    parser.add_argument("--input-mode", choices=INPUT_MODES, default=DEFAULT_BUILD_OPTIONS["input_mode"],
+                        help="how the game HTML is read: chunked stream, mmap with zero-copy slices, "
+                             "or the legacy decoded text path (default: %(default)s)")
+    parser.add_argument("--extract-assets", action="store_true",
+                        help="move large base64 data: URIs out of the game HTML into binary files under OEBPS/assets")
+    parser.add_argument("--extract-assets-min-bytes", type=int,
+                        default=DEFAULT_BUILD_OPTIONS["extract_assets_min_bytes"],
+                        help="smallest encoded data: URI worth extracting (default: %(default)s)")
+    parser.add_argument("--split-scripts", action="store_true",
+                        help="move large inline <script> bodies into separate OEBPS/scripts/*.js files, "
+                             "deferred where that keeps their order")
+    parser.add_argument("--split-scripts-min-bytes", type=positive_int_arg,
+                        default=DEFAULT_BUILD_OPTIONS["split_scripts_min_bytes"],
+                        help="smallest inline script worth splitting out (default: %(default)s)")
+    parser.add_argument("--lazy-script", action="append", default=[], metavar="ID_GLOB",
+                        help="with --split-scripts, load split scripts whose id matches ID_GLOB only after "
+                             "the first frame or on demand; may be repeated")
+    parser.add_argument("--bundle", action="append", default=[], metavar="[URL=]PATH",
+                        help="package an EPK/asset bundle and serve requests for URL (or its file name) "
+                             "from it; URL may contain '=', PATH may not; may be repeated")
+    parser.add_argument("--bundle-part-bytes", type=int, default=DEFAULT_BUILD_OPTIONS["bundle_part_bytes"],
+                        help="split bundles larger than this into parts read on demand; 0 disables "
+                             "(default: %(default)s)")
+    parser.add_argument("--compress", action="append", default=[], metavar="RULE", type=compression_rule_arg,
+                        help="compression rule tried before the defaults, e.g. '*.bin=stored', "
+                             "'type:text/*=deflate:9' or 'size>=8M=deflate:4'; may be repeated")
+    parser.add_argument("--compression-report", action="store_true",
+                        help="print bytes saved and milliseconds spent for each member")
+    parser.add_argument("--deflate-workers", type=int, default=DEFAULT_BUILD_OPTIONS["deflate_workers"],
+                        help="threads used to deflate large members in independent blocks, pigz style; "
+                             "0 uses every core (default: %(default)s)")
+    parser.add_argument("--deflate-block-bytes", type=int, default=DEFAULT_BUILD_OPTIONS["deflate_block_bytes"],
+                        help="uncompressed block size for parallel deflate (default: %(default)s)")
+    parser.add_argument("--cache", action="store_true",
+                        help="reuse pre-compressed members from a content-addressed build cache")
+    parser.add_argument("--cache-dir", default=DEFAULT_BUILD_OPTIONS["cache_dir"],
+                        help="build cache location (default: %(default)s)")
+    parser.add_argument("--cache-max-mb", type=int, default=DEFAULT_BUILD_OPTIONS["cache_max_bytes"] // 1024 // 1024,
+                        help="evict least recently used cache entries beyond this size (default: %(default)s)")
+    parser.add_argument("--cache-stats", action="store_true",
+                        help="print build cache statistics and exit")
+    build_type = parser.add_mutually_exclusive_group()
+    build_type.add_argument("--release", action="store_true", default=DEFAULT_BUILD_OPTIONS["release"],
+                            help="minify the shim and launcher and strip appleLog calls and the debug log panel")
+    build_type.add_argument("--debug", dest="release", action="store_false",
+                            help="keep the verbose logging build (default)")
+    parser.add_argument("--log-buffer-size", type=positive_int_arg, default=DEFAULT_BUILD_OPTIONS["log_buffer_size"],
+                        help="debug log entries kept in memory and in the panel (default: %(default)s)")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default=DEFAULT_BUILD_OPTIONS["log_level"],
+                        help="least severe debug log messages to keep; per-request messages are 'debug' "
+                             "(default: %(default)s)")
+    parser.add_argument("--storage-prefix", default=DEFAULT_BUILD_OPTIONS["storage_prefix"],
+                        help="localStorage key prefix for the persistent IndexedDB fallback (default: %(default)s)")
+    parser.add_argument("--storage-flush-ms", type=int, default=DEFAULT_BUILD_OPTIONS["storage_flush_ms"],
+                        help="delay before coalesced IndexedDB writes are flushed to localStorage "
+                             "(default: %(default)s)")
+    parser.add_argument("--response-cache-mb", type=float,
+                        default=DEFAULT_BUILD_OPTIONS["response_cache_bytes"] / 1024 / 1024,
+                        help="memory budget of the Cache API fallback; least recently used responses are "
+                             "evicted beyond it (default: %(default)s)")
+    parser.add_argument("--route", action="append", default=[], metavar="RULE", type=route_rule_arg,
+                        help="request route tried before the defaults, e.g. '*analytics*=stub' or "
+                             "'https://cdn.example/*=local'; actions: " + ", ".join(ROUTE_ACTIONS) +
+                             "; may be repeated")
+    parser.add_argument("--request-timeout-ms", type=int, default=DEFAULT_BUILD_OPTIONS["request_timeout_ms"],
+                        help="timeout for local and remote fetch/XHR requests; 0 disables (default: %(default)s)")
+    parser.add_argument("--graphics-profile", choices=("auto",) + tuple(GRAPHICS_PROFILES),
+                        default=DEFAULT_BUILD_OPTIONS["graphics_profile"],
+                        help="default WebGL profile (context attributes and render scale); readers can switch "
+                             "it from the launcher (default: %(default)s)")
+    parser.add_argument("--perf-hud", action="store_true", default=DEFAULT_BUILD_OPTIONS["perf_hud"],
+                        help="overlay FPS, frame-time percentiles, long tasks and heap size on the game; "
+                             "tap it to dump the frame-time histogram to the debug log")
+    parser.add_argument("--perf-hud-frames", type=positive_int_arg, default=DEFAULT_BUILD_OPTIONS["perf_hud_frames"],
+                        help="frames in the HUD's rolling histogram (default: %(default)s)")
+    parser.add_argument("--no-preload", dest="preload_game", action="store_false",
+                        default=DEFAULT_BUILD_OPTIONS["preload_game"],
+                        help="load the game only when Launch is pressed instead of warming it up hidden "
+                             "behind the launcher")
+    parser.add_argument("--launch-timeout-ms", type=int, default=DEFAULT_BUILD_OPTIONS["launch_timeout_ms"],
+                        help="fail the launch if the game frame sends nothing this long after launch, and warn, "
+                             "then fail after twice as long, if it draws no frame; 0 disables "
+                             "(default: %(default)s)")
+    parser.add_argument("--reproducible", action="store_true",
+                        help="byte-identical output for identical inputs: dates from SOURCE_DATE_EPOCH (or "
+                             "1980-01-01), fixed zip entry times and an identifier derived from the content")
+    parser.add_argument("--validate", action="store_true",
+                        help="check the finished EPUB's structure (mimetype, container, manifest, well-formed "
+                             "XHTML/NCX/OPF) and fail the build on problems")
+    parser.add_argument("--emit-shim", metavar="PATH",
+                        help="write the injected <script> for these options to PATH and exit, "
+                             "e.g. to test it under Node")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and rebuild when the game HTML, a bundle or this file's templates "
+                             "change, recompressing only the members that changed")
+    parser.add_argument("--watch-interval", type=float, default=0.5, metavar="SECONDS",
+                        help="how often --watch polls for changes (default: %(default)s)")
+    parser.add_argument("--profile", metavar="PREFIX",
+                        help="time each build stage and write PREFIX.json (stages, bytes, peak memory) "
+                             "and PREFIX.pstats (cProfile)")
+    args = parser.parse_args(argv)
+
+    if args.watch:
+        for name in WATCH_UNSUPPORTED_OPTIONS:
+            if getattr(args, name):
+                parser.error(f"--watch cannot be combined with --{name.replace('_', '-')}")
+    return args
+
+
+def options_from_args(args):
+    return {
+        "title": args.title,
+        "creator": args.creator,
+        "identifier": args.identifier,
+        "input_mode": args.input_mode,
+        "extract_assets": args.extract_assets,
+        "extract_assets_min_bytes": args.extract_assets_min_bytes,
+        "split_scripts": args.split_scripts,
+        "split_scripts_min_bytes": args.split_scripts_min_bytes,
+        "lazy_scripts": tuple(args.lazy_script),
+        "bundles": args.bundle,
+        "bundle_part_bytes": args.bundle_part_bytes,
+        "compression_policy": tuple(args.compress) + DEFAULT_COMPRESSION_POLICY,
+        "compression_report": args.compression_report,
+        "deflate_workers": args.deflate_workers,
+        "deflate_block_bytes": args.deflate_block_bytes,
+        "cache": args.cache,
+        "cache_dir": args.cache_dir,
+        "cache_max_bytes": args.cache_max_mb * 1024 * 1024,
+        "profile": args.profile,
+        "release": args.release,
+        "log_buffer_size": args.log_buffer_size,
+        "log_level": args.log_level,
+        "storage_prefix": args.storage_prefix,
+        "storage_flush_ms": args.storage_flush_ms,
+        "response_cache_bytes": int(args.response_cache_mb * 1024 * 1024),
+        "routes": tuple(args.route) + DEFAULT_ROUTES,
+        "request_timeout_ms": args.request_timeout_ms,
+        "graphics_profile": args.graphics_profile,
+        "perf_hud": args.perf_hud,
+        "perf_hud_frames": args.perf_hud_frames,
+        "preload_game": args.preload_game,
+        "launch_timeout_ms": args.launch_timeout_ms,
+        "reproducible": args.reproducible,
+        "validate": args.validate,
+    }
+
 
 if __name__ == "__main__":
 
-    if create_eaglecraft_epub():
-        print("Use the 'Debug Log' button in-game to monitor loading progress")
-    else:
-        print('make sure eaglecraft.html is in the scope.')
+    args = parse_args()
+    output = args.output
+    console = contextlib.nullcontext()
+
+    if output == "-":
+        # Keep status messages off the archive bytes.
+        output = sys.stdout.buffer
+        console = contextlib.redirect_stdout(sys.stderr)
+
+    with console:
+        if args.cache_stats:
+            cache = BuildCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+            for name, value in cache.stats().items():
+                print(f"{name:<10} {value}")
+            sys.exit(0)
+
+        options = options_from_args(args)
+
+        if args.emit_shim:
+            templates = render_shared_templates(resolve_build_options(options))
+            with open(args.emit_shim, "wb") as f:
+                f.write(templates["fixes"])
+            print(f"Shim written to {args.emit_shim}")
+            sys.exit(0)
+
+        if args.batch:
+            with open(args.batch, "r", encoding="utf-8") as f:
+                books = json.load(f)
+            started = time.perf_counter()
+            results = build_many(books, args.jobs, **options)
+            for result in results:
+                if not result["ok"]:
+                    print(f"--- {result['input']} ---")
+                    print(result["log"], end="")
+            print_batch_summary(results, time.perf_counter() - started)
+            sys.exit(0 if all(result["ok"] for result in results) else 1)
+
+        if args.watch:
+            sys.exit(0 if watch_eaglecraft_epub(args.input, output, args.watch_interval, **options) else 1)
+
+        if create_eaglecraft_epub(args.input, output, **options):
+            if not options["release"]:
+                print("Use the 'Debug Log' button in-game to monitor loading progress")
+        else:
+            if not os.path.exists(args.input):
+                print('make sure eaglecraft.html is in the scope.')
+            sys.exit(1)
@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import hashlib
+import argparse
+import collections
+import concurrent.futures
+import concurrent.futures.process
+
+import EaglePub
+
+# Per-request options testers may set; everything else comes from the
+# server's command line, so requests cannot reach the file system.
+REQUEST_OPTIONS = ("title", "creator", "identifier", "release", "log_level", "graphics_profile", "perf_hud",
+                   "perf_hud_frames", "reproducible")
+MAX_BODY_BYTES = 64 * 1024
+LATENCY_WINDOW = 1000
+THROUGHPUT_WINDOW = 60
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+# One builder per worker process; it keeps that worker's templates and
+# compressed members warm between requests.
+worker_builder = None
+
+
+def init_worker(cache_max_bytes):
+    global worker_builder
+    worker_builder = EaglePub.EpubBuilder(cache_max_bytes)
+
+
+def run_build(input_path, options):
+    started = time.perf_counter()
+    before = dict(worker_builder.cache.totals)
+    try:
+        data = worker_builder.build(input_path, **options)
+        error = None
+    except (RuntimeError, TypeError, ValueError) as e:
+        data = None
+        error = str(e)
+    totals = worker_builder.cache.totals
+    return {
+        "data": data,
+        "error": error,
+        "seconds": time.perf_counter() - started,
+        "cache_hits": totals["hits"] - before["hits"],
+        "cache_misses": totals["misses"] - before["misses"],
+        "pid": os.getpid(),
+    }
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in EaglePub.iter_file_chunks(f):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def percentiles(values):
+    # Nearest rank, like EagleTrace.py.
+    ordered = sorted(values)
+    if not ordered:
+        return None
+
+    def rank(q):
+        return round(ordered[max(0, math.ceil(q * len(ordered)) - 1)], 1)
+
+    return {"p50": rank(0.5), "p95": rank(0.95), "p99": rank(0.99), "max": round(ordered[-1], 1)}
+
+
+class BuildService:
+    # Builds on a process pool, one warm EpubBuilder per worker. Requests
+    # for the same input content and options share one in-flight build.
+
+    def __init__(self, input_path, options, workers, cache_max_bytes):
+        self.input_path = input_path
+        self.options = options
+        self.workers = workers
+        self.cache_max_bytes = cache_max_bytes
+        self.pool = self.new_pool()
+        self.in_flight = {}
+        self.input_digests = {}
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.build_times = collections.deque(maxlen=LATENCY_WINDOW)
+        self.finished = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def new_pool(self):
+        return concurrent.futures.ProcessPoolExecutor(self.workers, initializer=init_worker,
+                                                      initargs=(self.cache_max_bytes,))
+
+    async def input_digest(self):
+        # Hashed once per (size, mtime) in a thread, not on every request.
+        st = os.stat(self.input_path)
+        stamp = (st.st_size, st.st_mtime_ns)
+        if stamp not in self.input_digests:
+            digest = await asyncio.get_event_loop().run_in_executor(None, hash_file, self.input_path)
+            self.input_digests = {stamp: digest}
+        return self.input_digests[stamp]
+
+    async def build(self, request_options):
+        unknown = set(request_options) - set(REQUEST_OPTIONS)
+        if unknown:
+            raise ValueError(f"unsupported option(s) {', '.join(sorted(unknown))}; "
+                             f"allowed: {', '.join(REQUEST_OPTIONS)}")
+        options = dict(self.options, **request_options)
+        EaglePub.resolve_build_options(options)
+
+        key = hashlib.sha256(json.dumps([await self.input_digest(), options], sort_keys=True,
+                                        default=list).encode("utf-8")).hexdigest()
+        task = self.in_flight.get(key)
+        coalesced = task is not None
+        if coalesced:
+            self.counters["coalesced"] += 1
+        else:
+            task = asyncio.ensure_future(self.run(options))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # A client that disconnects must not cancel a build others wait on.
+        return await asyncio.shield(task), coalesced
+
+    async def run(self, options):
+        self.counters["builds"] += 1
+        pool = self.pool
+        started = time.perf_counter()
+        try:
+            result = await asyncio.get_event_loop().run_in_executor(pool, run_build, self.input_path, options)
+        except Exception as e:
+            # Every coalesced waiter gets this result, so it must be a
+            # response, not an exception.
+            if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                # A worker died (killed, out of memory); the pool refuses
+                # all later work, so swap in a fresh one, once per crash.
+                error = f"build worker crashed: {e}"
+                if self.pool is pool:
+                    self.pool = self.new_pool()
+                    pool.shutdown(wait=False)
+            else:
+                error = f"build failed: {type(e).__name__}: {e}"
+            result = {"data": None, "error": error, "seconds": time.perf_counter() - started,
+                      "cache_hits": 0, "cache_misses": 0, "pid": None}
+        self.build_times.append(result["seconds"] * 1000)
+        self.counters["cache_hits"] += result["cache_hits"]
+        self.counters["cache_misses"] += result["cache_misses"]
+        if result["error"] is not None:
+            self.counters["failures"] += 1
+        return result
+
+    def metrics(self):
+        now = time.time()
+        uptime = now - self.started
+        recent = [finished for finished in self.finished if now - finished <= THROUGHPUT_WINDOW]
+        return {
+            "uptime_s": round(uptime, 1),
+            "requests": self.counters["requests"],
+            "builds": self.counters["builds"],
+            "coalesced": self.counters["coalesced"],
+            "failures": self.counters["failures"],
+            "in_flight": len(self.in_flight),
+            "bytes_sent": self.counters["bytes_sent"],
+            "throughput": {
+                "books_per_s": round(len(recent) / min(uptime, THROUGHPUT_WINDOW), 3) if uptime else 0,
+                "mb_per_s": round(self.counters["bytes_sent"] / 1024 / 1024 / uptime, 3) if uptime else 0,
+            },
+            "latency_ms": percentiles(self.latencies),
+            "build_ms": percentiles(self.build_times),
+            "cache": {"hits": self.counters["cache_hits"], "misses": self.counters["cache_misses"]},
+        }
+
+    async def respond(self, method, path, body):
+        if path == "/metrics":
+            if method != "GET":
+                return 405, "application/json", b'{"error": "use GET"}', {}
+            return 200, "application/json", json.dumps(self.metrics(), indent=2).encode("utf-8"), {}
+        if path != "/build":
+            return 404, "application/json", b'{"error": "try POST /build or GET /metrics"}', {}
+        if method != "POST":
+            return 405, "application/json", b'{"error": "use POST"}', {}
+
+        started = time.perf_counter()
+        request_options = json.loads(body or b"{}")
+        if not isinstance(request_options, dict):
+            raise ValueError("body must be a JSON object of build options")
+        result, coalesced = await self.build(request_options)
+        if result["error"] is not None:
+            return 500, "application/json", json.dumps({"error": result["error"]}).encode("utf-8"), {}
+
+        self.latencies.append((time.perf_counter() - started) * 1000)
+        self.finished.append(time.time())
+        self.counters["bytes_sent"] += len(result["data"])
+        return 200, "application/epub+zip", result["data"], {
+            "Content-Disposition": 'attachment; filename="eaglecraft_book.epub"',
+            "X-Build-Ms": f"{result['seconds'] * 1000:.0f}",
+            "X-Coalesced": "true" if coalesced else "false",
+        }
+
+    async def handle(self, reader, writer):
+        # One request per connection: enough for testers and scripts.
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            self.counters["requests"] += 1
+            try:
+                length = int(headers.get("content-length") or 0)
+            except ValueError:
+                length = -1
+            if len(request_line) != 3 or length < 0:
+                status, content_type, payload, extra = 400, "application/json", b'{"error": "bad request"}', {}
+            elif length > MAX_BODY_BYTES:
+                status, content_type, payload, extra = 413, "application/json", b'{"error": "body too large"}', {}
+            else:
+                body = await reader.readexactly(length) if length else b""
+                method, path = request_line[0], request_line[1].split("?", 1)[0]
+                try:
+                    status, content_type, payload, extra = await self.respond(method, path, body)
+                except (ValueError, TypeError) as e:
+                    status, content_type, extra = 400, "application/json", {}
+                    payload = json.dumps({"error": str(e)}).encode("utf-8")
+                except OSError as e:
+                    status, content_type, extra = 500, "application/json", {}
+                    payload = json.dumps({"error": str(e)}).encode("utf-8")
+
+            head = [f"HTTP/1.1 {status} {REASONS[status]}", f"Content-Type: {content_type}",
+                    f"Content-Length: {len(payload)}", "Connection: close"]
+            head += [f"{name}: {value}" for name, value in extra.items()]
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            writer.write(payload)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(service, host, port):
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f"Serving {service.input_path} on http://{host}:{port} (POST /build, GET /metrics)", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build EaglePub EPUBs on demand over HTTP.")
+    parser.add_argument("-i", "--input", default=EaglePub.DEFAULT_INPUT_PATH,
+                        help="game HTML every book is built from (default: %(default)s)")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--workers", type=EaglePub.positive_int_arg, default=os.cpu_count() or 1,
+                        help="build processes, each with its own warm cache (default: one per core)")
+    parser.add_argument("--cache-mb", type=EaglePub.positive_int_arg, default=512,
+                        help="compressed members each worker keeps in memory (default: %(default)s)")
+    parser.add_argument("--options", type=json.loads, default={}, metavar="JSON",
+                        help="build options shared by every request, e.g. '{\"extract_assets\": true}'")
+    args = parser.parse_args(argv)
+
+    if not isinstance(args.options, dict):
+        parser.error("--options must be a JSON object")
+    try:
+        EaglePub.resolve_build_options(args.options)
+    except (TypeError, ValueError) as e:
+        parser.error(str(e))
+    if not os.path.exists(args.input):
+        parser.error(f"{args.input} not found")
+
+    service = BuildService(args.input, args.options, args.workers, args.cache_mb * 1024 * 1024)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        print("Stopped", file=sys.stderr)
+    finally:
+        service.pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
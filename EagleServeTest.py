@@ -0,0 +1,87 @@
+import os
+import json
+import asyncio
+import tempfile
+import unittest
+
+import EagleServe
+
+GAME_HTML = b"<!DOCTYPE html><html><head><title>game</title></head><body><canvas></canvas></body></html>"
+run_build = EagleServe.run_build
+
+
+def crash_once_build(input_path, options):
+    # Kills the worker on its first build; the marker survives the crash.
+    marker = os.path.join(os.path.dirname(input_path), "crashed")
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    return run_build(input_path, options)
+
+
+class BuildServiceTest(unittest.TestCase):
+    # Runs the real server on an ephemeral port and talks raw HTTP to it.
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmp.name, "eaglecraft.html")
+        with open(self.input_path, "wb") as f:
+            f.write(GAME_HTML)
+        self.service = EagleServe.BuildService(self.input_path, {}, 1, 16 * 1024 * 1024)
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.service.handle, "127.0.0.1", 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        self.service.pool.shutdown()
+        self.tmp.cleanup()
+
+    def request(self, head, body=b""):
+        # Reads by Content-Length, not to EOF: forked workers inherit the
+        # server's sockets, so a close may not reach the client right away.
+        async def exchange():
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+            writer.write(head.encode("latin-1") + b"\r\n\r\n" + body)
+            await writer.drain()
+            response_head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+            headers = dict(line.lower().split(": ", 1) for line in response_head[1:] if line)
+            response_body = await reader.readexactly(int(headers["content-length"]))
+            writer.close()
+            return int(response_head[0].split()[1]), response_body
+
+        return self.loop.run_until_complete(asyncio.wait_for(exchange(), 60))
+
+    def test_bad_content_length_is_400(self):
+        for value in ("abc", "-5", "1.5"):
+            with self.subTest(value=value):
+                status, body = self.request(f"POST /build HTTP/1.1\r\nContent-Length: {value}")
+                self.assertEqual(status, 400)
+                self.assertIn("error", json.loads(body))
+        status, _ = self.request("GET /metrics HTTP/1.1")
+        self.assertEqual(status, 200)
+
+    def test_build(self):
+        status, body = self.request("POST /build HTTP/1.1\r\nContent-Length: 2", b"{}")
+        self.assertEqual(status, 200)
+        self.assertTrue(body.startswith(b"PK"))
+
+    def test_crashed_worker_is_500_and_pool_recovers(self):
+        EagleServe.run_build = crash_once_build
+        try:
+            status, body = self.request("POST /build HTTP/1.1\r\nContent-Length: 2", b"{}")
+            self.assertEqual(status, 500)
+            self.assertIn("crashed", json.loads(body)["error"])
+            self.assertEqual(self.service.metrics()["failures"], 1)
+
+            status, body = self.request("POST /build HTTP/1.1\r\nContent-Length: 2", b"{}")
+            self.assertEqual(status, 200)
+            self.assertTrue(body.startswith(b"PK"))
+        finally:
+            EagleServe.run_build = run_build
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,269 @@
+// Checks the shim's IndexedDB fallback against a fake localStorage.
+//
+//   node EagleShimTest.js              # emits a shim with EaglePub.py first
+//   node EagleShimTest.js shim.html    # tests a shim from --emit-shim
+//
+// Each check boots the shim on a fresh window, writes through the
+// IndexedDB API, waits for the debounced flush, then boots it again on the
+// same storage, the way a reload would, and reads the records back.
+'use strict';
+
+const assert = require('assert');
+const childProcess = require('child_process');
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
+
+const EMIT_FLUSH_MS = 20;
+
+function loadShim(file) {
+    let source = file;
+    if (!source) {
+        source = path.join(os.tmpdir(), `eaglepub-shim-${process.pid}.html`);
+        childProcess.execFileSync('python3', [path.join(__dirname, 'EaglePub.py'), '--emit-shim', source,
+            '--storage-flush-ms', String(EMIT_FLUSH_MS)], { stdio: 'ignore' });
+    }
+    const text = fs.readFileSync(source, 'utf8');
+    if (!file) {
+        fs.unlinkSync(source);
+    }
+    // Only the storage settings matter here; they have no nested objects.
+    const config = JSON.parse('{' + /"storage":\s*\{[^{}]*\}/.exec(text)[0] + '}');
+    const script = text.replace(/^[\s\S]*?<script[^>]*>/, '').replace(/<\/script>\s*$/, '');
+    return { script: script, config: config };
+}
+
+function fakeLocalStorage() {
+    const items = new Map();
+    const storage = {
+        items: items,
+        writes: 0,
+        get length() {
+            return items.size;
+        },
+        key: function(index) {
+            const keys = Array.from(items.keys());
+            return index < keys.length ? keys[index] : null;
+        },
+        getItem: function(name) {
+            return items.has(name) ? items.get(name) : null;
+        },
+        setItem: function(name, value) {
+            storage.writes++;
+            items.set(name, String(value));
+        },
+        removeItem: function(name) {
+            storage.writes++;
+            items.delete(name);
+        }
+    };
+    return storage;
+}
+
+// Boots the shim the way the game iframe would, minus the browser.
+function boot(shim, localStorage) {
+    const window = {
+        localStorage: localStorage,
+        XMLHttpRequest: function() {},
+        addEventListener: function() {},
+        Uint8Array: Uint8Array,
+        Float32Array: Float32Array,
+        ArrayBuffer: ArrayBuffer
+    };
+    const document = {
+        readyState: 'complete',
+        getElementById: function() {
+            return null;
+        },
+        addEventListener: function() {},
+        createElement: function() {
+            return {};
+        }
+    };
+    new Function('window', 'document', 'navigator', shim.script)(window, document, {});
+    return window;
+}
+
+// Waits for an IndexedDB request the way the game does, through onsuccess.
+function result(request) {
+    return new Promise(function(resolve, reject) {
+        request.onsuccess = event => resolve(event.target.result);
+        request.onerror = event => reject(event.target.error);
+    });
+}
+
+async function openDatabase(window) {
+    return result(window.indexedDB.open('world', 1));
+}
+
+async function openStore(window, mode) {
+    return (await openDatabase(window)).transaction(['chunks'], mode).objectStore('chunks');
+}
+
+function get(store, key) {
+    return result(store.get(key));
+}
+
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+// Past the debounce, with room for a slow timer.
+function waitForFlush(shim) {
+    return sleep(shim.config.storage.flush_ms + 50);
+}
+
+function pattern(length, seed) {
+    const bytes = new Uint8Array(length);
+    for (let i = 0; i < length; i++) {
+        bytes[i] = (i * 7919 + seed) & 0xff;
+    }
+    return bytes;
+}
+
+const checks = {
+    'put and get survive a reload': async function(shim) {
+        const localStorage = fakeLocalStorage();
+        let store = await openStore(boot(shim, localStorage), 'readwrite');
+        await store.put('hello', 'name');
+        await store.put({ seed: 42, spawn: [0, 64, 0] }, 'level');
+        await store.put(3, [1, 2]);
+        await waitForFlush(shim);
+
+        store = await openStore(boot(shim, localStorage), 'readonly');
+        assert.strictEqual(await get(store, 'name'), 'hello');
+        assert.deepStrictEqual(await get(store, 'level'), { seed: 42, spawn: [0, 64, 0] });
+        assert.strictEqual(await get(store, [1, 2]), 3);
+        assert.strictEqual(await get(store, 'missing'), undefined);
+    },
+
+    'binary values round-trip through the 15-bit packing': async function(shim) {
+        const localStorage = fakeLocalStorage();
+        let store = await openStore(boot(shim, localStorage), 'readwrite');
+        // Every length up to 16 ends the last code unit on a different bit.
+        for (let length = 0; length <= 16; length++) {
+            await store.put(pattern(length, length), ['bytes', length]);
+        }
+        const every = new Uint8Array(256).map((value, i) => i);
+        await store.put(every, 'every');
+        await store.put(pattern(10000, 1).buffer, 'buffer');
+        await store.put({ blocks: pattern(4099, 2), light: new Float32Array([1.5, -0, Infinity]) }, 'chunk');
+        await waitForFlush(shim);
+
+        const packed = localStorage.getItem(Array.from(localStorage.items.keys()).find(name => name.endsWith('"buffer"')));
+        assert.ok(packed.length < 10000 * 0.6, `10000 bytes took ${packed.length} characters`);
+
+        store = await openStore(boot(shim, localStorage), 'readonly');
+        for (let length = 0; length <= 16; length++) {
+            const value = await get(store, ['bytes', length]);
+            assert.ok(value instanceof Uint8Array, `length ${length} is not a Uint8Array`);
+            assert.deepStrictEqual(Array.from(value), Array.from(pattern(length, length)));
+        }
+        assert.deepStrictEqual(Array.from(await get(store, 'every')), Array.from(every));
+        const buffer = await get(store, 'buffer');
+        assert.ok(buffer instanceof ArrayBuffer);
+        assert.deepStrictEqual(new Uint8Array(buffer), pattern(10000, 1));
+        const chunk = await get(store, 'chunk');
+        assert.deepStrictEqual(Array.from(chunk.blocks), Array.from(pattern(4099, 2)));
+        assert.ok(chunk.light instanceof Float32Array);
+        assert.deepStrictEqual(Array.from(chunk.light), [1.5, -0, Infinity]);
+    },
+
+    'the debounced flush runs once per changed record': async function(shim) {
+        const localStorage = fakeLocalStorage();
+        const window = boot(shim, localStorage);
+        const store = await openStore(window, 'readwrite');
+        const before = localStorage.writes;
+        for (let i = 0; i < 50; i++) {
+            await store.put({ version: i }, [0, 0]);
+        }
+        await store.put('temporary', 'scratch');
+        assert.strictEqual(localStorage.writes, before, 'wrote before the flush delay');
+
+        await waitForFlush(shim);
+        assert.strictEqual(localStorage.writes - before, 2);
+
+        // Nothing changed since, so a forced flush writes nothing.
+        window.indexedDB.flush();
+        assert.strictEqual(localStorage.writes - before, 2);
+        assert.deepStrictEqual(await get(await openStore(boot(shim, localStorage), 'readonly'), [0, 0]), { version: 49 });
+    },
+
+    'requests settle through onsuccess, then oncomplete': async function(shim) {
+        const window = boot(shim, fakeLocalStorage());
+        const db = await openDatabase(window);
+        const transaction = db.transaction(['chunks'], 'readwrite');
+        const store = transaction.objectStore('chunks');
+        const events = [];
+        transaction.oncomplete = () => events.push('complete');
+        const put = store.put('stone', [4, 2]);
+        const read = store.get([4, 2]);
+        // Results are there at once; the events wait for the handlers.
+        assert.strictEqual(read.readyState, 'done');
+        assert.strictEqual(read.result, 'stone');
+        put.onsuccess = event => {
+            events.push(`put ${JSON.stringify(event.target.result)}`);
+            // A request made from a handler still lands before oncomplete.
+            store.delete([4, 2]).onsuccess = () => events.push('delete');
+        };
+        read.onsuccess = () => {
+            events.push(`get ${read.result}`);
+            throw new Error('a failing handler');
+        };
+        store.clear().onsuccess = () => events.push('clear');
+        assert.deepStrictEqual(events, []);
+        await sleep(0);
+        assert.deepStrictEqual(events, ['put [4,2]', 'get stone', 'clear', 'delete', 'complete']);
+        assert.strictEqual(await get(db.transaction(['chunks']).objectStore('chunks'), [4, 2]), undefined);
+    },
+
+    'delete and clear remove records': async function(shim) {
+        const localStorage = fakeLocalStorage();
+        let window = boot(shim, localStorage);
+        let store = await openStore(window, 'readwrite');
+        for (let i = 0; i < 5; i++) {
+            await store.put(pattern(100, i), i);
+        }
+        const db = await openDatabase(window);
+        await db.transaction(['settings'], 'readwrite').objectStore('settings').put('fancy', 'graphics');
+        await waitForFlush(shim);
+
+        store = await openStore(boot(shim, localStorage), 'readwrite');
+        await store.delete(2);
+        assert.strictEqual(await get(store, 2), undefined);
+        await waitForFlush(shim);
+
+        window = boot(shim, localStorage);
+        store = await openStore(window, 'readwrite');
+        assert.strictEqual(await get(store, 2), undefined);
+        assert.deepStrictEqual(Array.from(await get(store, 3)), Array.from(pattern(100, 3)));
+
+        await store.clear();
+        assert.strictEqual(await get(store, 0), undefined);
+        window.indexedDB.flush();
+
+        store = await openStore(boot(shim, localStorage), 'readonly');
+        for (let i = 0; i < 5; i++) {
+            assert.strictEqual(await get(store, i), undefined);
+        }
+        const settings = await get((await openDatabase(boot(shim, localStorage))).transaction(['settings'])
+            .objectStore('settings'), 'graphics');
+        assert.strictEqual(settings, 'fancy', 'clear() reached another store');
+        assert.ok(Array.from(localStorage.items.keys()).every(name => !name.includes('world_chunks')));
+    }
+};
+
+(async function() {
+    const shim = loadShim(process.argv[2]);
+    let failed = 0;
+    for (const [name, check] of Object.entries(checks)) {
+        try {
+            await check(shim);
+            console.log(`ok   ${name}`);
+        } catch (e) {
+            failed++;
+            console.log(`FAIL ${name}\n     ${e.message}`);
+        }
+    }
+    process.exit(failed ? 1 : 0);
+})();
@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import glob
+import math
+import argparse
+
+# Boot milestones in order, then the reader pressing Launch and the game
+# being shown. The launcher records index-parsed, iframe-navigation, launch
+# and ready; the rest are posted by the shim in the game frame.
+BOOT_MARKS = ("index-parsed", "iframe-navigation", "shim", "request", "indexeddb", "webgl", "frame", "launch", "ready")
+GROUPINGS = ("device", "profile", "none")
+
+
+def trace_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, "*.json")))
+        else:
+            yield path
+
+
+def load_trace(path):
+    # Returns the first time, in ms since the book started loading, of each
+    # milestone; a game reloaded from the Graphics menu repeats its marks.
+    with open(path, "r", encoding="utf-8") as f:
+        trace = json.load(f)
+    events = trace["traceEvents"] if isinstance(trace, dict) else trace
+    marks = {}
+    for event in events:
+        if event.get("cat") == "boot" and event.get("ph") == "i":
+            marks.setdefault(event["name"], event["ts"] / 1000)
+    meta = trace.get("otherData", {}) if isinstance(trace, dict) else {}
+    return {"path": path, "meta": meta, "marks": marks}
+
+
+def device_class(meta):
+    agent = meta.get("userAgent") or ""
+    if "iPhone" in agent or "iPod" in agent:
+        return "iPhone"
+    # iPadOS reports itself as a Mac; touch support gives it away.
+    if "iPad" in agent or ("Macintosh" in agent and meta.get("maxTouchPoints", 0) > 1):
+        return "iPad"
+    if "Macintosh" in agent:
+        return "Mac"
+    return "other"
+
+
+def group_key(trace, by):
+    if by == "device":
+        return device_class(trace["meta"])
+    if by == "profile":
+        return trace["meta"].get("graphicsProfile") or "unknown"
+    return "all"
+
+
+def percentile(values, fraction):
+    # Nearest rank, so every reported value was actually observed.
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(fraction * len(ordered))) - 1]
+
+
+def phase_durations(marks):
+    # Time from the previous milestone the trace has to each one.
+    durations = {}
+    previous = 0.0
+    for name in sorted((name for name in BOOT_MARKS if name in marks), key=marks.get):
+        durations[name] = marks[name] - previous
+        previous = marks[name]
+    return durations
+
+
+def summarize(traces, by="device"):
+    groups = {}
+    for trace in traces:
+        groups.setdefault(group_key(trace, by), []).append(trace)
+
+    summary = {}
+    for key, members in sorted(groups.items()):
+        names = [name for name in BOOT_MARKS if any(name in trace["marks"] for trace in members)]
+        names += sorted({name for trace in members for name in trace["marks"]} - set(BOOT_MARKS))
+        rows = []
+        for name in names:
+            times = [trace["marks"][name] for trace in members if name in trace["marks"]]
+            phases = [phase_durations(trace["marks"]).get(name) for trace in members if name in trace["marks"]]
+            phases = [phase for phase in phases if phase is not None]
+            rows.append({
+                "mark": name,
+                "count": len(times),
+                "median_ms": round(percentile(times, 0.5), 1),
+                "p90_ms": round(percentile(times, 0.9), 1),
+                "max_ms": round(max(times), 1),
+                "phase_median_ms": round(percentile(phases, 0.5), 1) if phases else None,
+            })
+        latencies = [trace["meta"]["latency_ms"] for trace in members if trace["meta"].get("latency_ms") is not None]
+        summary[key] = {
+            "traces": len(members),
+            "marks": rows,
+            "launch_latency_median_ms": round(percentile(latencies, 0.5), 1) if latencies else None,
+        }
+    return summary
+
+
+def print_summary(summary, file=sys.stdout):
+    for key, group in summary.items():
+        print(f"{key} ({group['traces']} trace{'s' if group['traces'] != 1 else ''})", file=file)
+        print(f"  {'mark':<18} {'n':>4} {'median ms':>10} {'p90 ms':>10} {'max ms':>10} {'phase ms':>10}", file=file)
+        for row in group["marks"]:
+            phase = "" if row["phase_median_ms"] is None else f"{row['phase_median_ms']:.1f}"
+            print(f"  {row['mark']:<18} {row['count']:>4} {row['median_ms']:>10.1f} {row['p90_ms']:>10.1f} "
+                  f"{row['max_ms']:>10.1f} {phase:>10}", file=file)
+        if group["launch_latency_median_ms"] is not None:
+            print(f"  launch to first frame, median: {group['launch_latency_median_ms']:.1f} ms", file=file)
+        print(file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize EaglePub startup traces copied from the debug panel.")
+    parser.add_argument("traces", nargs="+", help="trace JSON files, or directories of them")
+    parser.add_argument("--by", choices=GROUPINGS, default="device",
+                        help="group traces by device class, graphics profile or not at all (default: %(default)s)")
+    parser.add_argument("--json", metavar="PATH", help="write the summary as JSON to PATH ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    traces = []
+    for path in trace_paths(args.traces):
+        try:
+            traces.append(load_trace(path))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+    if not traces:
+        parser.error("no readable traces")
+
+    summary = summarize(traces, args.by)
+    if args.json == "-":
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+        return
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import io
+import os
+import zlib
+import zipfile
+import threading
+import unittest
+
+import EaglePub
+
+DATE_TIME = (2024, 1, 1, 0, 0, 0)
+
+
+def sample(size, seed):
+    # Compressible, but not so much that deflate output stays tiny.
+    return bytes((i * 7919 + seed) % 251 for i in range(size)) * 4
+
+
+class RawMemberWriterTest(unittest.TestCase):
+    # RawMemberWriter drives zipfile through its private write state; these
+    # build real archives with every member writer and let zipfile check them.
+
+    def setUp(self):
+        options = EaglePub.resolve_build_options({"reproducible": True})
+        self.compression = EaglePub.compression_settings(options)
+        self.members = {
+            "mimetype": b"application/epub+zip",
+            "OEBPS/game.html": sample(300000, 1),
+            "OEBPS/assets/texture.png": sample(50000, 2),
+            "OEBPS/empty.js": b"",
+            "OEBPS/copied.html": sample(120000, 3),
+            "OEBPS/content.opf": b"<package/>",
+        }
+
+    def write_archive(self, output, workers=1):
+        compression = dict(self.compression, workers=workers, block_bytes=64 * 1024)
+        cached = io.BytesIO()
+        with EaglePub.open_epub(io.BytesIO())[0] as scratch:
+            data = self.members["OEBPS/copied.html"]
+            record = EaglePub.write_compressed_member(scratch, "OEBPS/copied.html",
+                                                      [data[:1000], data[1000:]], compression, tee=cached)
+
+        epub, _ = EaglePub.open_epub(output)
+        with epub:
+            EaglePub.write_stored_member(epub, "mimetype", self.members["mimetype"], DATE_TIME)
+            for name in ("OEBPS/game.html", "OEBPS/assets/texture.png", "OEBPS/empty.js"):
+                chunks = EaglePub.iter_file_chunks(io.BytesIO(self.members[name]), chunk_size=65536)
+                EaglePub.write_compressed_member(epub, name, chunks, compression)
+            EaglePub.copy_precompressed_member(epub, cached, record, DATE_TIME)
+            # Plain zipfile writes must still line up with ours.
+            epub.writestr("OEBPS/content.opf", self.members["OEBPS/content.opf"])
+
+    def check_archive(self, data):
+        with zipfile.ZipFile(io.BytesIO(data)) as epub:
+            self.assertIsNone(epub.testzip())
+            self.assertEqual(epub.namelist(), list(self.members))
+            for name, content in self.members.items():
+                self.assertEqual(epub.read(name), content, name)
+            infos = epub.infolist()
+        self.assertEqual(infos[0].compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(data[30:38], b"mimetype")
+        self.assertEqual(data[38:58], b"application/epub+zip")
+        types = {info.filename: info.compress_type for info in infos}
+        self.assertEqual(types["OEBPS/assets/texture.png"], zipfile.ZIP_STORED)
+        self.assertEqual(types["OEBPS/game.html"], zipfile.ZIP_DEFLATED)
+        return infos
+
+    def test_seekable_output(self):
+        for workers in (1, 3):
+            with self.subTest(workers=workers):
+                output = io.BytesIO()
+                self.write_archive(output, workers)
+                infos = self.check_archive(output.getvalue())
+                # Sizes were patched into the local headers, not left to
+                # data descriptors.
+                self.assertFalse(any(info.flag_bits & 0x08 for info in infos))
+
+    def test_pipe_output(self):
+        read_fd, write_fd = os.pipe()
+        received = []
+
+        def drain():
+            with os.fdopen(read_fd, "rb") as pipe:
+                received.append(pipe.read())
+
+        reader = threading.Thread(target=drain)
+        reader.start()
+        with os.fdopen(write_fd, "wb") as pipe:
+            self.write_archive(pipe)
+        reader.join()
+        infos = self.check_archive(received[0])
+        flags = {info.filename: info.flag_bits & 0x08 for info in infos}
+        # Known sizes keep a plain header; streamed ones need a descriptor.
+        self.assertFalse(flags["mimetype"])
+        self.assertFalse(flags["OEBPS/copied.html"])
+        self.assertTrue(flags["OEBPS/game.html"])
+
+    def test_one_write_handle_at_a_time(self):
+        with EaglePub.open_epub(io.BytesIO())[0] as epub:
+            with EaglePub.RawMemberWriter(epub, EaglePub.new_zipinfo("a", zipfile.ZIP_STORED)) as member:
+                with self.assertRaises(ValueError):
+                    EaglePub.RawMemberWriter(epub, EaglePub.new_zipinfo("b", zipfile.ZIP_STORED))
+                member.write(b"a")
+                member.finish(zlib.crc32(b"a"), 1)
+            self.assertEqual(epub.read("a"), b"a")
+
+    def test_wrong_compressed_size_is_an_error(self):
+        with EaglePub.open_epub(io.BytesIO())[0] as epub:
+            with self.assertRaises(RuntimeError):
+                with EaglePub.RawMemberWriter(epub, EaglePub.new_zipinfo("a", zipfile.ZIP_STORED),
+                                              zlib.crc32(b"abc"), 3, 3) as member:
+                    member.write(b"ab")
+
+
+if __name__ == "__main__":
+    unittest.main()